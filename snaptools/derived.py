@@ -0,0 +1,324 @@
+import numpy as np
+from contextlib import contextmanager
+from functools import partial
+from threading import RLock
+import weakref
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+from . import lazydict
+
+"""
+Derived quantities (radii, velocity components, energies...) of the particles in a snapshot.
+They are computed from the datablocks when first used, cached in lazy dictionaries and
+recomputed when a datablock they depend on is replaced or changed or the center changes.
+
+snap.derived['r']['stars']  # distance of every star from snap.derived.center
+snap.derived.select('stars', rows)['r']  # the same for some stars only
+"""
+
+
+# name: (dependencies, function)
+# dependencies are datablocks (e.g. 'pos'), other derived quantities, 'center' or 'vcenter'
+DERIVED = {}
+
+
+def register(name, depends):
+    """
+    Decorator adding a derived quantity. The function is called with the DerivedFields
+    and the particle type and gets its inputs through derived.get(dependency, ptype).
+    """
+    def decorator(function):
+        DERIVED[name] = (list(depends), function)
+        return function
+    return decorator
+
+
+@register('dpos', ['pos', 'center'])
+def _dpos(derived, ptype):
+    return derived.get('pos', ptype) - derived.center
+
+
+@register('dvel', ['vel', 'vcenter'])
+def _dvel(derived, ptype):
+    return derived.get('vel', ptype) - derived.vcenter
+
+
+@register('r', ['dpos'])
+def _r(derived, ptype):
+    return np.sqrt(np.sum(derived.get('dpos', ptype)**2, axis=1))
+
+
+@register('R', ['dpos'])
+def _R(derived, ptype):
+    dpos = derived.get('dpos', ptype)
+    return np.sqrt(dpos[:, 0]**2 + dpos[:, 1]**2)
+
+
+@register('theta', ['dpos'])
+def _theta(derived, ptype):
+    dpos = derived.get('dpos', ptype)
+    # Y and X are reversed by definition in np.arctan2
+    return np.arctan2(dpos[:, 1], dpos[:, 0])
+
+
+@register('vr', ['dpos', 'dvel', 'r'])
+def _vr(derived, ptype):
+    return np.sum(derived.get('dpos', ptype)*derived.get('dvel', ptype), axis=1)/derived.get('r', ptype)
+
+
+@register('vtheta', ['dpos', 'dvel', 'R'])
+def _vtheta(derived, ptype):
+    # rotation in the x-y plane
+    dpos = derived.get('dpos', ptype)
+    dvel = derived.get('dvel', ptype)
+    return (-dpos[:, 1]*dvel[:, 0] + dpos[:, 0]*dvel[:, 1])/derived.get('R', ptype)
+
+
+@register('vphi', ['dpos', 'dvel', 'r', 'R'])
+def _vphi(derived, ptype):
+    x, y, z = derived.get('dpos', ptype).T
+    vx, vy, vz = derived.get('dvel', ptype).T
+    return (x*(vx*z - x*vz) + y*(vy*z - y*vz))/(derived.get('r', ptype)*derived.get('R', ptype))
+
+
+@register('ke', ['masses', 'dvel'])
+def _ke(derived, ptype):
+    return 0.5*derived.get('masses', ptype)*np.sum(derived.get('dvel', ptype)**2, axis=1)
+
+
+@register('binding_energy', ['ke', 'pot', 'masses'])
+def _binding_energy(derived, ptype):
+    # Binding energy is the sum of the grav. potential and the kinetic energies
+    return derived.get('ke', ptype) + 0.5*derived.get('pot', ptype)*derived.get('masses', ptype)
+
+
+def _computed(function, derived, ptype):
+    # cached values are shared, so they are read-only (and can be dropped by a memory budget)
+    value = function(derived, ptype)
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    return value
+
+
+def _written(ref, block, ptype, event):
+    """
+    Listener of the lazy dictionary of a datablock (see DerivedFields._watch)
+    """
+    derived = ref()
+    if (derived is not None) and (event == 'written'):
+        derived.invalidate(block, ptype)
+
+
+class _Input(object):
+    """
+    Weak reference to a datablock a value was computed from. Equal only to the
+    reference of the very same object, which must still be alive.
+    """
+    def __init__(self, value):
+        try:
+            self.ref = weakref.ref(value)
+        except TypeError:
+            self.ref = lambda: value
+
+    def __eq__(self, other):
+        value = self.ref()
+        return isinstance(other, _Input) and (value is not None) and (value is other.ref())
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class DerivedField(Mapping):
+    """
+    One derived quantity for every particle type, e.g. snap.derived['r']
+    """
+    def __init__(self, derived, name):
+        self.derived = derived
+        self.name = name
+
+    def __getitem__(self, ptype):
+        return self.derived.get(self.name, ptype)
+
+    def __iter__(self):
+        return iter(self.derived.ptypes(self.name))
+
+    def __len__(self):
+        return len(self.derived.ptypes(self.name))
+
+
+class DerivedSelection(Mapping):
+    """
+    Derived quantities of some particles (rows) of one particle type, e.g.
+    snap.derived.select('halo', rows)['r']. They are computed from those particles only,
+    relative to the center when the selection was made, and are not cached in the snapshot.
+    """
+    def __init__(self, derived, ptype, rows):
+        self.snap = derived.snap
+        self.ptype = ptype
+        self.rows = rows
+        self.center = derived.center
+        self.vcenter = derived.vcenter
+        self.values = {}
+
+    def __getitem__(self, name):
+        if name not in DERIVED:
+            raise KeyError(name)
+        return self.get(name, self.ptype)
+
+    def __iter__(self):
+        return iter(DERIVED)
+
+    def __len__(self):
+        return len(DERIVED)
+
+    def get(self, name, ptype):
+        if name not in self.values:
+            if name in DERIVED:
+                self.values[name] = DERIVED[name][1](self, ptype)
+            else:
+                self.values[name] = getattr(self.snap, name)[ptype][self.rows]
+        return self.values[name]
+
+
+class DerivedFields(Mapping):
+    """
+    Registry of the derived quantities of a snapshot (see DERIVED), computed relative to
+    center (positions) and vcenter (velocities). Values are cached until a datablock they
+    depend on is replaced or changed or the center changes. Changes to lazily loaded
+    datablocks are seen, call invalidate() after changing any other datablock in place.
+    """
+    def __init__(self, snap, budget=None):
+        self.snap = snap
+        self.center = np.zeros(3, dtype=np.float32)
+        self.vcenter = np.zeros(3, dtype=np.float32)
+        self.lock = RLock()
+        self.budget = budget  # memory budget of the cached values, None for the default
+        self.values = {}  # name: lazy dictionary of particle type: value
+        self.stamps = {}  # (name, particle type): inputs the cached value was computed from
+        self.watched = set()  # ids of the lazy dictionaries of datablocks we listen to
+
+    def __getitem__(self, name):
+        if name not in DERIVED:
+            raise KeyError(name)
+        return DerivedField(self, name)
+
+    def __iter__(self):
+        return iter(DERIVED)
+
+    def __len__(self):
+        return len(DERIVED)
+
+    def ptypes(self, name):
+        """
+        Particle types that have every datablock name depends on
+        """
+        blocks = self._datablocks(name)
+        return [p for p in self.snap.part_names
+                if all(p in getattr(self.snap, block, {}) for block in blocks)]
+
+    def _datablocks(self, name):
+        if name not in DERIVED:
+            return [name]
+        blocks = []
+        for dep in DERIVED[name][0]:
+            if dep not in ('center', 'vcenter'):
+                blocks += [b for b in self._datablocks(dep) if b not in blocks]
+        return blocks
+
+    def _centered(self, name):
+        """
+        Does name depend on center or vcenter?
+        """
+        if name in ('center', 'vcenter'):
+            return True
+        return (name in DERIVED) and any(self._centered(dep) for dep in DERIVED[name][0])
+
+    def _stamp(self, name, ptype):
+        # the inputs (and the center) of a value
+        if name in ('center', 'vcenter'):
+            return tuple(np.ravel(getattr(self, name)).tolist())
+        if name not in DERIVED:
+            self._watch(name)
+            return _Input(getattr(self.snap, name)[ptype])
+        return tuple(self._stamp(dep, ptype) for dep in DERIVED[name][0])
+
+    def _watch(self, block):
+        """
+        Listen for in-place changes to a lazily loaded datablock
+        """
+        lazy = getattr(self.snap, block, None)
+        if isinstance(lazy, lazydict.LazyDictionary) and (id(lazy) not in self.watched):
+            self.watched.add(id(lazy))
+            lazy.listeners.append(partial(_written, weakref.ref(self), block))
+
+    def select(self, ptype, rows):
+        """
+        Derived quantities of the particles rows (a slice or row numbers) of type ptype only
+        """
+        return DerivedSelection(self, ptype, rows)
+
+    def set_budget(self, budget):
+        """
+        Move the cached values to another lazydict.MemoryBudget
+        """
+        with self.lock:
+            self.budget = budget
+            for values in self.values.values():
+                values.set_budget(budget)
+
+    def get(self, name, ptype):
+        """
+        Value of a datablock or derived quantity name for particle type ptype
+        """
+        if name not in DERIVED:
+            return getattr(self.snap, name)[ptype]
+        stamp = self._stamp(name, ptype)
+        with self.lock:
+            if name not in self.values:
+                self.values[name] = lazydict.MutableLazyDictionary(budget=self.budget)
+            values = self.values[name]
+            if self.stamps.get((name, ptype)) != stamp:
+                values[ptype] = partial(_computed, DERIVED[name][1], self, ptype)
+                self.stamps[(name, ptype)] = stamp
+        return values[ptype]
+
+    def set_center(self, center=None, vcenter=None):
+        """
+        Measure positions (and velocities) from here on. Cached values that depend on them
+        are recomputed when they are used.
+        """
+        if center is not None:
+            self.center = np.asarray(center)
+        if vcenter is not None:
+            self.vcenter = np.asarray(vcenter)
+
+    @contextmanager
+    def centered(self, center=None, vcenter=None):
+        """
+        Temporarily set the center: with snap.derived.centered(com): ...
+        """
+        old = (self.center, self.vcenter)
+        self.set_center(center, vcenter)
+        try:
+            yield self
+        finally:
+            self.center, self.vcenter = old
+            # values measured from the temporary center won't be used again
+            self._drop(lambda name, ptype: (self._centered(name) and
+                                            (self.stamps[(name, ptype)] != self._stamp(name, ptype))))
+
+    def invalidate(self, field=None, ptype=None):
+        """
+        Drop the cached values (that depend on datablock field, of particle type ptype)
+        """
+        self._drop(lambda name, p: (((field is None) or (field in self._datablocks(name))) and
+                                    ((ptype is None) or (p == ptype))))
+
+    def _drop(self, select):
+        with self.lock:
+            for name, ptype in list(self.stamps):
+                if select(name, ptype):
+                    del self.stamps[(name, ptype)]
+                    del self.values[name][ptype]
@@ -2,9 +2,14 @@ try:
     from collections import MutableMapping
 except ImportError:
     from collections.abc import MutableMapping
-from threading import RLock
-from inspect import getargspec
+from threading import RLock, get_ident
+from concurrent.futures import Future
+from collections import OrderedDict
 from copy import copy
+from functools import partial
+import weakref
+import time
+import numpy as np
 
 def get_version(): # pragma: no cover
     VERSION = (     # SEMANTIC
@@ -33,11 +38,157 @@ class CircularReferenceError(LazyDictionaryError):
 class ConstantRedefinitionError(LazyDictionaryError):
     pass
 
+def resident_bytes(value):
+    """
+    Bytes of memory held by an evaluated value.
+    Memory maps and broadcast (constant) arrays hold (almost) nothing,
+    objects with a resident_bytes attribute (e.g. lazy datasets) report their own.
+    """
+    size = getattr(value, 'resident_bytes', None)
+    if size is not None:
+        return size
+    if isinstance(value, np.memmap):
+        return 0
+    if isinstance(value, np.ndarray) and (0 in value.strides):
+        return value.itemsize
+    return getattr(value, 'nbytes', 0)
+
+
+def _writable(value):
+    """
+    Is value an array in memory that can be changed in place?
+    Memory maps hold nothing and are reloaded as they were.
+    """
+    return (isinstance(value, np.ndarray) and (not isinstance(value, np.memmap)) and
+            value.flags.writeable and (resident_bytes(value) > 0))
+
+
+class MemoryBudget(object):
+    """
+    Memory budget shared by lazy dictionaries.
+    When the evaluated values take more than max_bytes the least recently used ones are
+    evicted: they go back to the 'defined' state with their loader and are reloaded when
+    they are used again. Values that were changed or handed out as writable arrays
+    (see LazyDictionary.mark_dirty) are never evicted. A max_bytes of None means no limit.
+    """
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.lock = RLock()
+        self.entries = OrderedDict()  # least recently used first
+        self.finalizers = {}  # id of each lazy dictionary: finalizer dropping its entries
+
+    def touch(self, lazy, key):
+        """
+        Mark the entry key of the lazy dictionary as used, then evict entries if over budget
+        """
+        with self.lock:
+            entry = (id(lazy), key)
+            if entry in self.entries:
+                self.entries.move_to_end(entry)
+            else:
+                self.entries[entry] = (weakref.ref(lazy), key)
+                if id(lazy) not in self.finalizers:
+                    # ids are reused, so entries must go with their dictionary
+                    self.finalizers[id(lazy)] = weakref.finalize(lazy, self._drop, id(lazy))
+            if self.max_bytes is not None:
+                self.shrink(self.max_bytes, keep=entry)
+
+    def forget(self, lazy, key):
+        with self.lock:
+            self.entries.pop((id(lazy), key), None)
+
+    def discard(self, lazy):
+        """
+        Forget all entries of the lazy dictionary
+        """
+        with self.lock:
+            finalizer = self.finalizers.get(id(lazy))
+            if finalizer is not None:
+                finalizer.detach()
+            self._drop(id(lazy))
+
+    def _drop(self, ident):
+        with self.lock:
+            self.finalizers.pop(ident, None)
+            for entry in [entry for entry in self.entries if entry[0] == ident]:
+                del self.entries[entry]
+
+    def _live(self):
+        for entry, (ref, key) in list(self.entries.items()):
+            lazy = ref()
+            if lazy is None:
+                del self.entries[entry]
+            else:
+                yield entry, lazy, key
+
+    def resident_bytes(self):
+        """
+        Bytes held by the evaluated values in the budget
+        """
+        with self.lock:
+            return sum(lazy.resident_bytes(key) for entry, lazy, key in self._live())
+
+    def shrink(self, max_bytes, keep=None):
+        """
+        Evict least recently used values until at most max_bytes are resident
+        """
+        with self.lock:
+            sizes = [(entry, lazy, key, lazy.resident_bytes(key)) for entry, lazy, key in self._live()]
+            total = sum(size for _, _, _, size in sizes)
+            for entry, lazy, key, size in sizes:
+                if total <= max_bytes:
+                    break
+                if (entry == keep) or (size == 0):
+                    continue
+                if lazy.evict(key):
+                    total -= size
+                    self.entries.pop(entry, None)
+            return total
+
+
+_default_budget = MemoryBudget()
+
+
+def set_default_budget(max_bytes):
+    """
+    Set the memory budget shared by all lazy dictionaries that don't have their own
+    """
+    _default_budget.max_bytes = max_bytes
+    if max_bytes is not None:
+        _default_budget.shrink(max_bytes)
+
+
+def default_budget():
+    return _default_budget
+
+
+def _changed(ref, key, value, event):
+    """
+    Listener of a lazily read value (see LazyDictionary.__getitem__)
+    """
+    lazy = ref()
+    if (lazy is None) or (lazy.values.get(key) is not value):
+        return
+    if event in ('written', 'pinned'):
+        lazy.mark_dirty(key)
+    if event == 'written':
+        for listener in list(lazy.listeners):
+            listener(key, event)
+    # the value may have grown, check the budget again
+    lazy.budget.touch(lazy, key)
+
+
 class LazyDictionary(MutableMapping):
-    def __init__(self, values={}):
+    def __init__(self, values={}, budget=None):
         self.lock = RLock()
         self.values = copy(values)
         self.states = {}
+        self.loaders = {}  # loaders of the evaluated values, for eviction
+        self.futures = {}  # pending evaluations
+        self.dirty = set()  # evaluated values that were changed in place (or may be), never evicted
+        self.recorder = None  # called with the key, value and seconds of every evaluation
+        self.listeners = []  # called with the key and event ('written') of values changed in place
+        self.budget = _default_budget if budget is None else budget
         for key in self.values:
             self.states[key] = 'defined'
 
@@ -48,37 +199,110 @@ class LazyDictionary(MutableMapping):
         return iter(self.values)
 
     def __getitem__(self, key):
+        # the dictionary lock is only held to look at and change states,
+        # loaders run outside of it so that different keys can load at the same time
+        # and requests for a key that is already loading wait for that load
         with self.lock:
-            if key in self.states:
-                if self.states[key] == 'evaluating':
+            if key not in self.states:
+                raise KeyError(key)
+            state = self.states[key]
+            if state == 'error':
+                raise self.values[key]
+            elif state == 'evaluating':
+                future = self.futures[key]
+                if future.owner == get_ident():
                     raise CircularReferenceError('value of "%s" depends on itself' % key)
-                elif self.states[key] == 'error':
-                    raise self.values[key]
-                elif self.states[key] == 'defined':
-                    value = self.values[key]
-                    if callable(value):
-                        args = []
-                        #args, _, _, _ = getargspec(value)
-                        if len(args) == 0:
-                            self.states[key] = 'evaluating'
-                            try:
-                                self.values[key] = value()
-                            except Exception as ex:
-                                self.values[key] = ex
-                                self.states[key] = 'error'
-                                raise ex
-                        elif len(args) == 1:
-                            self.states[key] = 'evaluating'
-                            try:
-                                self.values[key] = value(self)
-                            except Exception as ex:
-                                self.values[key] = ex
-                                self.states[key] = 'error'
-                                raise ex
-                    self.states[key] = 'evaluated'
+                loader = None
+            elif state == 'defined' and callable(self.values[key]):
+                loader = self.values[key]
+                future = Future()
+                future.owner = get_ident()
+                self.futures[key] = future
+                self.states[key] = 'evaluating'
             else:
-                raise KeyError(key)
-            return self.values[key]
+                self.states[key] = 'evaluated'
+                value = self.values[key]
+                future = loader = None
+
+        if loader is not None:
+            start = time.time()
+            try:
+                value = loader()
+            except Exception as ex:
+                with self.lock:
+                    if self.futures.get(key) is future:
+                        del self.futures[key]
+                        self.values[key] = ex
+                        self.states[key] = 'error'
+                future.set_exception(ex)
+                raise ex
+            with self.lock:
+                # unless the key was redefined while loading
+                if self.futures.get(key) is future:
+                    del self.futures[key]
+                    self.values[key] = value
+                    self.states[key] = 'evaluated'
+                    self.loaders[key] = loader
+            # values that are read later (lazy datasets) report their loads and writes
+            watch = getattr(type(value), 'watch', None)
+            if watch is not None:
+                watch(value, partial(_changed, weakref.ref(self), key, value))
+            elif _writable(value):
+                # changes to a plain array can't be seen, keep it once it is handed out
+                self.mark_dirty(key)
+            future.set_result(value)
+            if self.recorder is not None:
+                self.recorder(key, value, time.time() - start)
+        elif future is not None:
+            value = future.result()
+
+        # outside of our lock, the budget may evict entries of other dictionaries
+        if key in self.loaders:
+            self.budget.touch(self, key)
+        return value
+
+    def resident_bytes(self, key=None):
+        """
+        Bytes held by the evaluated value of key, or by all evaluated values
+        """
+        with self.lock:
+            if key is None:
+                return sum(self.resident_bytes(k) for k in self.values)
+            if self.states.get(key) != 'evaluated':
+                return 0
+            return resident_bytes(self.values[key])
+
+    def mark_dirty(self, key):
+        """
+        The evaluated value of key was (or may have been) changed in place, so it must not be evicted
+        """
+        with self.lock:
+            if self.states.get(key) == 'evaluated':
+                self.dirty.add(key)
+
+    def evict(self, key):
+        """
+        Send an evaluated value back to its loader. Returns True if it was evicted.
+        Values changed in place are kept.
+        """
+        with self.lock:
+            if ((self.states.get(key) != 'evaluated') or (key not in self.loaders) or
+                    (key in self.dirty)):
+                return False
+            self.values[key] = self.loaders.pop(key)
+            self.states[key] = 'defined'
+            return True
+
+    def set_budget(self, budget):
+        """
+        Move the evaluated values to another MemoryBudget
+        """
+        with self.lock:
+            keys = list(self.loaders)
+            old, self.budget = self.budget, budget
+        for key in keys:
+            old.forget(self, key)
+            budget.touch(self, key)
 
     def __contains__(self, key):
         return key in self.values
@@ -89,6 +313,9 @@ class LazyDictionary(MutableMapping):
                 raise ConstantRedefinitionError('"%s" is immutable' % key)
             self.values[key] = value
             self.states[key] = 'defined'
+            self.loaders.pop(key, None)
+            self.dirty.discard(key)
+        self.budget.forget(self, key)
 
     def __delitem__(self, key):
         with self.lock:
@@ -96,6 +323,9 @@ class LazyDictionary(MutableMapping):
                 raise ConstantRedefinitionError('"%s" is immutable' % key)
             del self.values[key]
             del self.states[key]
+            self.loaders.pop(key, None)
+            self.dirty.discard(key)
+        self.budget.forget(self, key)
 
     def __str__(self):
         return str(self.values)
@@ -108,8 +338,16 @@ class MutableLazyDictionary(LazyDictionary):
         with self.lock:
             self.values[key] = value
             self.states[key] = 'defined'
+            self.loaders.pop(key, None)
+            self.dirty.discard(key)
+            self.futures.pop(key, None)
+        self.budget.forget(self, key)
 
     def __delitem__(self, key):
         with self.lock:
             del self.values[key]
-            del self.states[key]
\ No newline at end of file
+            del self.states[key]
+            self.loaders.pop(key, None)
+            self.dirty.discard(key)
+            self.futures.pop(key, None)
+        self.budget.forget(self, key)
@@ -1,5 +1,6 @@
 import numpy as np
 from fast_histogram import histogram2d
+from . import utils
 
 """
 Contains routines for manipulating and deriving quantities from data
@@ -51,11 +52,17 @@ def bin_particles(p1,
         else:
             extents2 = extents2_in
             length2 = extents2_in[1] - extents2_in[0]
-    Z2 = histogram2d(
-        p1, p2, 
-        range=[extents1, extents2],
-        weights=mass * 1E10,
-        bins=BINS).astype(np.float32)
+    m = utils.constant_value(mass)
+    if m is not None:
+        # all particles have the same mass, no need for weights
+        Z2 = (histogram2d(p1, p2, range=[extents1, extents2],
+                          bins=BINS)*(m*1E10)).astype(np.float32)
+    else:
+        Z2 = histogram2d(
+            p1, p2, 
+            range=[extents1, extents2],
+            weights=mass * 1E10,
+            bins=BINS).astype(np.float32)
     """Z2, ind1, ind2 = np.histogram2d(p1, p2, range=[extents1,
                                                    extents2],
                                     weights=mass * 1E10,
@@ -64,12 +71,111 @@ def bin_particles(p1,
     ind2 = np.linspace(extents2[0], extents2[1], BINS+1)
     # Log scale the data
     if scale:
-        Z2[Z2 < 0] = np.nan
-        Z2[Z2 > 0] = np.log10(Z2[Z2 > 0])
+        Z2 = log_scale(Z2)
 
     return Z2, ind1, ind2
 
 
+def log_scale(Z2):
+    """
+    Log scale a binned map in place, leaving empty bins at zero
+    """
+    Z2[Z2 < 0] = np.nan
+    Z2[Z2 > 0] = np.log10(Z2[Z2 > 0])
+    return Z2
+
+
+def group_centers(values, labels, ngroups=None, weights=None):
+    """
+    (Weighted) mean of values for every group of particles in one pass
+    Args:
+        values: N x D array, e.g. positions or velocities
+        labels: group number of each particle, negative to leave a particle out
+    kwargs:
+        ngroups: number of groups, default is the largest label + 1
+        weights: e.g. particle masses, None for an unweighted mean
+    Returns:
+        ngroups x D array of centers (nan for empty groups)
+    """
+    values = np.asarray(values)
+    labels = np.asarray(labels)
+    # equal weights (e.g. masses from the header) give the unweighted mean
+    if (weights is not None) and (utils.constant_value(weights) is not None):
+        weights = None
+
+    keep = labels >= 0
+    if not np.all(keep):
+        labels = labels[keep]
+        values = values[keep]
+        if weights is not None:
+            weights = np.asarray(weights)[keep]
+    if ngroups is None:
+        ngroups = labels.max() + 1 if len(labels) > 0 else 0
+
+    if weights is None:
+        norm = np.bincount(labels, minlength=ngroups).astype(np.float64)
+    else:
+        weights = np.asarray(weights, dtype=np.float64)
+        norm = np.bincount(labels, weights=weights, minlength=ngroups)
+
+    sums = np.empty((ngroups, values.shape[1]))
+    for axis in range(values.shape[1]):
+        column = values[:, axis]
+        sums[:, axis] = np.bincount(labels, weights=column if weights is None else column*weights,
+                                    minlength=ngroups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums/norm[:, None]
+
+
+def shrinking_sphere(pos, weights=None, center=None, radius=None, shrink=0.75,
+                     min_particles=100, max_iter=100):
+    """
+    Find the center of a particle distribution by repeatedly shrinking a sphere
+    about the (weighted) center of the particles inside it (Power et al. 2003).
+    Each iteration only looks at the particles inside the previous sphere.
+    Args:
+        pos: N x 3 positions
+    kwargs:
+        weights: e.g. particle masses, None for equal weights
+        center: starting center, default is the center of mass
+        radius: starting radius, default is the distance of the furthest particle
+        shrink: factor the radius is multiplied by each iteration
+        min_particles: stop before the sphere holds fewer particles than this
+        max_iter: maximum number of iterations
+    Returns:
+        center, rows of pos inside the final sphere
+    """
+    if (weights is not None) and (utils.constant_value(weights) is not None):
+        weights = None
+
+    def mean(p, w):
+        if w is None:
+            return p.mean(axis=0, dtype=np.float64)
+        return np.dot(w, p.astype(np.float64))/np.sum(w, dtype=np.float64)
+
+    rows = np.arange(len(pos))
+    sub = np.asarray(pos)
+    w = None if weights is None else np.asarray(weights)
+    if center is None:
+        center = mean(sub, w)
+    r2 = np.sum((sub - center)**2, axis=1)
+    if radius is None:
+        radius = np.sqrt(r2.max())
+
+    for i in range(max_iter):
+        radius *= shrink
+        inside = np.flatnonzero(r2 <= radius**2)
+        if len(inside) < min_particles:
+            break
+        sub = sub[inside]
+        rows = rows[inside]
+        w = None if w is None else w[inside]
+        center = mean(sub, w)
+        r2 = np.sum((sub - center)**2, axis=1)
+
+    return np.asarray(center), rows
+
+
 def measure_fourier(r, theta, length, BINS_r, BINS_theta):
 
     Z2, x, y = np.histogram2d(r, theta, range=[[0, length],
@@ -20,15 +20,18 @@ def find_centers_helper(settings):
     try:
         settings = settings
         try:
-            snap = snapshot.Snapshot(settings['filename'])
+            snap = snapshot.Snapshot(settings['filename'],
+                                     fields=settings.get('fields'),
+                                     parttypes=settings.get('parttypes'))
         except KeyError:
             raise StandardError
-        return snap.find_centers(settings,
-                                 Rd=Rd,
-                                 numcontours=num_contours,
-                                 plot=plot,
-                                 num_centers=num_centers,
-                                 measure_fourier=measure_fourier)
+        with snap:  # closes its files and prefetch threads
+            return snap.find_centers(settings,
+                                     Rd=Rd,
+                                     numcontours=num_contours,
+                                     plot=plot,
+                                     num_centers=num_centers,
+                                     measure_fourier=measure_fourier)
 
     except KeyboardInterrupt:
         raise KeyboardInterruptError()
@@ -43,7 +46,9 @@ def loop_centers(snaps,
                  parttype='stars',
                  filename='./',
                  output='./snap',
-                 num_centers=1):
+                 num_centers=1,
+                 fields=None,
+                 parttypes=None):
 
     """
     Measure the centers of the bar, disk, and halo over a range of snapshots.
@@ -60,6 +65,9 @@ def loop_centers(snaps,
         contours: How many contours per snapshot.
         measure_fourier: Measure the Fourier modes in the bar? (Currently broken)
         parttype: Which particle type to use for making the measurements.
+        fields: Datablocks to read from each snapshot. By default only those that
+                find_centers needs with these settings.
+        parttypes: Particle types to read from each snapshot. Default as for fields.
 
     """
     import re
@@ -81,6 +89,9 @@ def loop_centers(snaps,
     settings['plot'] = plot
     settings['num_centers'] = num_centers
     settings['measure_fourier'] = measure_fourier
+    default_fields, default_parttypes = utils.projection_from_settings(settings, centers=True)
+    settings['fields'] = default_fields if fields is None else fields
+    settings['parttypes'] = default_parttypes if parttypes is None else parttypes
 
     settings_array = []
     for i, s in enumerate(snaps):
@@ -153,7 +153,9 @@ def plot_single(name,
             settings['parttype'] = parttype
     else:
         raise RuntimeError("Not a valid particle type")
-    binSnap = snapshot.Snapshot(fname).bin_snap(settings, doLog=False)
+    fields, parttypes = utils.projection_from_settings(settings)
+    binSnap = snapshot.Snapshot(fname, fields=fields,
+                                parttypes=parttypes).bin_snap(settings, doLog=False)
     plot_stars(binSnap, outname, settings, doLog=True)
     return binSnap, settings
 
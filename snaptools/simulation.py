@@ -11,6 +11,40 @@ import re
 import numbers
 
 
+def _call_with_snapshot(function, snapname, fields=None, parttypes=None):
+    """
+    Open a snapshot with only the requested fields and particle types, then apply function to it
+    """
+    with snapshot.Snapshot(snapname, fields=fields, parttypes=parttypes) as snap:
+        return function(snap)
+
+
+def _call_with_stats(function, snapname):
+    """
+    Apply function to snapname and also return what the snapshots it opened loaded
+    """
+    from . import snapshot_io
+
+    with snapshot_io.collect_stats() as collected:
+        result = function(snapname)
+    return result, snapshot_io.merge_stats([load_stats.report() for load_stats in collected])
+
+
+def _export_fits(snapname, folder=None, products=['map', 'cube', 'velfield'], parttype='stars',
+                 **kwargs):
+    """
+    Open only what the fits products of one snapshot need and write them (see Snapshot.export_fits)
+    """
+    fields = ['pos', 'masses']
+    if ('cube' in products) or ('velfield' in products):
+        fields.append('vel')
+    if folder is None:
+        folder = os.path.dirname(snapname)
+    stub = os.path.join(folder, os.path.splitext(os.path.basename(snapname))[0])
+    with snapshot.Snapshot(snapname, fields=fields, parttypes=[parttype]) as snap:
+        return snap.export_fits(stub, products=products, parttype=parttype, **kwargs)
+
+
 class Simulation(object):
     """
     This class holds a folder with snapshots belonging to a single simulation
@@ -85,11 +119,87 @@ class Simulation(object):
     def get_stats(self):
         """
         Work in progress
+        Returns the times of the first and last snapshots
+        """
+        time_begin = snapshot.read_header(self.snaps[0])['time']
+        time_end = snapshot.read_header(self.snaps[-1])['time']
+        return time_begin, time_end
+
+
+    def catalog_name(self):
+        """
+        Where the header catalog of this simulation is kept.
+        In the simulation folder if possible, otherwise in the temporary directory.
+        """
+        import tempfile
+
+        name = os.path.join(self.folder, self.snapbase + 'catalog.hdf5')
+        if os.path.exists(name) or os.access(self.folder, os.W_OK):
+            return name
+        return os.path.join(tempfile.gettempdir(), name.strip(os.sep).replace(os.sep, '_'))
+
+
+    def catalog(self, refresh=False):
+        """
+        Table of the time, redshift, nall, size and modification time of every snapshot,
+        kept in a single file (see catalog_name) so that a folder only has to be scanned once.
+        Snapshots that are new or have changed since the catalog was written are re-read
+        (headers only) and the catalog is updated.
+        kwargs:
+            refresh: Re-read every header
+        Returns:
+            dictionary of arrays with one entry per snapshot in self.snaps, e.g.
+            sim.snaps[cat['time'] > 1.0]
         """
-        snap = snapshot.Snapshot(self.snaps[0])
-        time_begin = snap.header['time']
-        snap = snapshot.Snapshot(self.snaps[-1])
-        time_end = snap.header['time']
+        import h5py
+
+        fname = self.catalog_name()
+        names = [os.path.basename(f) for f in self.snaps]
+        stats = np.array([[os.stat(f).st_size, os.stat(f).st_mtime] for f in self.snaps],
+                         dtype=np.float64).reshape(-1, 2)
+
+        old = {}
+        if (not refresh) and os.path.exists(fname):
+            try:
+                with h5py.File(fname, 'r') as f:
+                    old_names = f['names'].asstr()[()]
+                    cols = {key: f[key][()] for key in ['time', 'redshift', 'nall', 'stats']}
+                for j, name in enumerate(old_names):
+                    old[name] = {key: val[j] for key, val in cols.items()}
+            except (OSError, KeyError):
+                old = {}
+
+        cat = {'time': np.zeros(self.nsnaps),
+               'redshift': np.zeros(self.nsnaps),
+               'nall': np.zeros((self.nsnaps, 6), dtype=np.uint64)}
+        changed = len(old) != self.nsnaps
+        for j, (snapname, name) in enumerate(zip(self.snaps, names)):
+            row = old.get(name)
+            if (row is None) or np.any(row['stats'] != stats[j]):
+                header = snapshot.read_header(snapname)
+                nall = np.zeros(6, dtype=np.uint64)
+                nall[:len(header['nall'])] = header['nall']
+                if 'nall_highword' in header:
+                    nall[:len(header['nall'])] += (np.asarray(header['nall_highword'],
+                                                              dtype=np.uint64) << np.uint64(32))
+                row = {'time': header['time'], 'redshift': header['redshift'], 'nall': nall}
+                changed = True
+            for key in cat:
+                cat[key][j] = row[key]
+
+        if changed:
+            tmpname = fname + '.%d.tmp' % os.getpid()
+            with h5py.File(tmpname, 'w') as f:
+                f.create_dataset('names', data=np.array(names, dtype=h5py.string_dtype()))
+                f.create_dataset('stats', data=stats)
+                for key, val in cat.items():
+                    f.create_dataset(key, data=val)
+            os.replace(tmpname, fname)
+
+        cat['snaps'] = np.array(self.snaps)
+        cat['size'] = stats[:, 0].astype(np.int64)
+        cat['mtime'] = stats[:, 1]
+        return cat
 
 
     def measure_centers_of_mass(self, indices=None):
@@ -98,10 +208,12 @@ class Simulation(object):
         """
         def center_of_mass_(snapname, indices=None):
             try:
-                snap = snapshot.Snapshot(snapname)
+                snap = snapshot.Snapshot(snapname, fields=['pos', 'masses'], parttypes=['stars'])
                 if indices is None:
-                    indices = snap.split_galaxies('stars')
-                com1s, com2s = snap.measure_com('stars', indices)
+                    # all galaxies in one pass
+                    com1s, com2s = snap.measure_centers('stars')[:2]
+                else:
+                    com1s, com2s = snap.measure_com('stars', indices)
                 return com1s
             except KeyboardInterrupt:
                 pass
@@ -116,12 +228,15 @@ class Simulation(object):
         """
         def centers_(snapname, indices=None):
             try:
-                snap = snapshot.Snapshot(snapname)
+                snap = snapshot.Snapshot(snapname, fields=['pos', 'vel', 'masses'],
+                                         parttypes=['stars'])
                 if indices is None:
-                    indices = snap.split_galaxies('stars')
-                coms = snap.measure_com('stars', indices)
-                v1 = snap.vel['stars'][indices[0], :].mean(axis=0)
-                v2 = snap.vel['stars'][indices[1], :].mean(axis=0)
+                    coms = snap.measure_centers('stars')
+                    v1, v2 = snap.measure_centers('stars', field='vel')[:2]
+                else:
+                    coms = snap.measure_com('stars', indices)
+                    v1 = snap.vel['stars'][indices[0], :].mean(axis=0)
+                    v2 = snap.vel['stars'][indices[1], :].mean(axis=0)
                 time = snap.header['time']
                 return [coms[0], coms[1], v1, v2, time]
             except KeyboardInterrupt:
@@ -144,15 +259,34 @@ class Simulation(object):
         return distances, velocities, times
 
 
-    def apply_function(self, function, *args):
+    def apply_function(self, function, *args, fields=None, parttypes=None, stats=False):
         """
         Map a user supplied function over the snapshots.
         Uses pathos.multiprocessing (https://github.com/uqfoundation/pathos.git).
+        kwargs:
+            fields, parttypes: If either is given then the function is called with
+                               Snapshot(snapname, fields=fields, parttypes=parttypes)
+                               instead of the snapshot filename.
+            stats: Also return what the snapshots opened in the workers loaded, added up
+                   (see stats()): results, stats = sim.apply_function(f, stats=True)
         """
+        from . import snapshot_io
+
         pool = Pool()
 
+        if (fields is not None) or (parttypes is not None):
+            function = partial(_call_with_snapshot, function,
+                               fields=fields, parttypes=parttypes)
+        if stats:
+            function = partial(_call_with_stats, function)
+
         try:
             val = pool.map(function, self.snaps)
+            if stats:
+                val, reports = zip(*val)
+                reports = snapshot_io.merge_stats(reports)
+                self.load_stats = snapshot_io.merge_stats([self.stats(), reports])
+                return list(val), reports
             return val
         except KeyboardInterrupt:
             print('got ^C while pool mapping, terminating the pool')
@@ -164,6 +298,54 @@ class Simulation(object):
             print('pool is terminated')
 
 
+    def stats(self):
+        """
+        Datablocks loaded by all the snapshots that apply_function(..., stats=True) processed,
+        added up over snapshots (see Snapshot.stats)
+        """
+        return getattr(self, 'load_stats', {})
+
+
+    def build_cache(self, workers=None):
+        """
+        Convert every snapshot to the .npy cache format (see snapshot_io.write_cache),
+        which Snapshot() then memory maps instead of reading the HDF5 files.
+        kwargs:
+            workers: Number of snapshots to convert at the same time. Default is one per CPU.
+        """
+        from . import snapshot_io
+
+        pool = Pool(workers)
+        try:
+            return pool.map(snapshot_io.write_cache, self.snaps)
+        finally:
+            pool.terminate()
+
+
+    def export_fits(self, products=['map', 'cube', 'velfield'], angles=[0], workers=None,
+                    folder=None, **kwargs):
+        """
+        Write fits products (see Snapshot.export_fits) for every snapshot.
+        Each snapshot is read once and all of its products and angles are made from the same
+        rotated coordinates. Snapshots are processed in parallel.
+        kwargs:
+            products: Any of 'map', 'cube' and 'velfield'
+            angles: Rotation angles about the y axis in degrees
+            workers: Number of snapshots processed at the same time. Default is one per CPU.
+            folder: Where to write the files. Default is next to each snapshot.
+            Other kwargs (lengthX, lengthY, BINS, parttype, first_only, com) are passed on
+            to Snapshot.export_fits
+        Returns:
+            list of the files written for each snapshot
+        """
+        export = partial(_export_fits, folder=folder, products=products, angles=angles, **kwargs)
+        pool = Pool(workers)
+        try:
+            return pool.map(export, self.snaps)
+        finally:
+            pool.terminate()
+
+
     def print_settings(self):
         """
         Print the current settings
@@ -5,6 +5,11 @@ import numpy as np
 import copy
 import warnings
 import os
+from collections import defaultdict
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 
 
 """
@@ -14,11 +19,56 @@ This class contains all snapshot methods. These methods should act directly on a
 """
 
 
+def read_header(filename):
+    """
+    Read only the header of a snapshot, without looking at any of its datablocks.
+    Accepts the same file names as Snapshot (HDF5, multi-part HDF5 or Gadget binary).
+    The header of a multi-part HDF5 snapshot is that of its first part, so npart is
+    the number of particles in that part (nall has the totals).
+    """
+    from . import snapshot_io
+    import h5py
+
+    if os.path.exists(filename):
+        curfilename = filename
+    elif os.path.exists(filename + ".hdf5"):
+        curfilename = filename + ".hdf5"
+    elif os.path.exists(filename + ".0.hdf5"):
+        curfilename = filename + ".0.hdf5"
+    elif os.path.exists(filename + ".0"):
+        curfilename = filename + ".0"
+    else:
+        raise IOError("[error] file not found : %s" % filename)
+
+    if h5py.is_hdf5(curfilename):
+        with h5py.File(curfilename, 'r') as s:
+            return snapshot_io.hdf5_header(s)
+    elif snapshot_io.gadget_binary_format(curfilename) is not None:
+        parts = snapshot_io.binary_parts(curfilename)
+        header = snapshot_io.read_binary_header(parts[0])
+        # the particle numbers of all the parts
+        header['npart'] = np.sum([snapshot_io.read_binary_header(part)['npart'] for part in parts],
+                                 axis=0).astype(header['npart'].dtype)
+        return header
+    else:
+        raise RuntimeError("Filetype is not HDF5 or Gadget binary. Other file types are not implemented in this version of SnapTools.")
+
+
 class Snapshot(object):
 
-    def __new__(cls, filename=None, lazy=True, part_names=None, **kwargs):
+    def __new__(cls, filename=None, lazy=True, part_names=None, fields=None, parttypes=None,
+                galaxy=None, id_file=None, mmap=False, cache=True, **kwargs):
         """
         Factory method for calling proper subclass or empty object
+        kwargs:
+            lazy: Only read datablocks when they are first used
+            fields: Only register (or read) these datablocks, e.g. ['pos', 'masses']
+            parttypes: Only register (or read) these particle types, e.g. ['stars']
+            galaxy: Only load the particles of this galaxy, as listed in id_file
+            id_file: File of particle ids for each galaxy written by make_id_file
+            mmap: Memory map uncompressed, contiguous datasets (read-only) instead of reading them
+            cache: Use the .npy cache of the snapshot (see snapshot_io.write_cache) if there
+                   is an up to date one
         """
         if filename is not None:
 
@@ -32,30 +82,52 @@ class Snapshot(object):
             elif os.path.exists(filename + ".hdf5"):
                 curfilename = filename + ".hdf5"
             elif os.path.exists(filename + ".0.hdf5"):
-                if lazy:
-                    # allow multi-part files only in the lazy eval mode
-                    import glob
-                    filelist = list(sorted(glob.glob(filename+".[0-9].hdf5")))
-                    multi = True
-
-                curfilename = filename + ".0.hdf5"
+                # multi-part files are read through a manifest that is built once
+                manifest = snapshot_io.load_manifest(filename)
+                filelist = manifest['filenames']
+                multi = True
+                curfilename = manifest['file']
+            elif os.path.exists(filename + ".0"):
+                # Gadget binary snapshot in several parts
+                filelist = snapshot_io.binary_parts(filename + ".0")
+                multi = True
+                curfilename = filelist[0]
             else:
                 raise IOError("[error] file not found : %s" % filename)
 
+            # memory map the columnar cache if there is one for the current files
+            if cache and (galaxy is None):
+                cachedir = snapshot_io.find_cache(filename, filelist if multi else [curfilename])
+                if cachedir is not None:
+                    snapclass = super(Snapshot, cls).__new__(snapshot_io.SnapCache)
+                    snapclass.init(cachedir, part_names, fields=fields, parttypes=parttypes,
+                                   lazy=lazy, mmap=mmap, **kwargs)
+                    return snapclass
+
             if h5py.is_hdf5(curfilename):
                 if lazy:
                     snapclass = super(Snapshot, cls).__new__(snapshot_io.SnapLazy)
                     if multi:
-                        snapclass.init(filelist, part_names, **kwargs)  # replaces standard __init__ method
+                        snapclass.init(filelist, part_names, fields=fields, parttypes=parttypes,
+                                       galaxy=galaxy, id_file=id_file, manifest=manifest,
+                                       mmap=mmap, **kwargs)  # replaces standard __init__ method
                     else:
-                        snapclass.init(curfilename, part_names, **kwargs)
+                        snapclass.init(curfilename, part_names, fields=fields, parttypes=parttypes,
+                                       galaxy=galaxy, id_file=id_file, mmap=mmap, **kwargs)
                     return snapclass
                 else:
                     snapclass = super(Snapshot, cls).__new__(snapshot_io.SnapHDF5)
-                    snapclass.init(curfilename)  # replaces standard __init__ method
+                    # replaces standard __init__ method
+                    snapclass.init(curfilename, fields=fields, parttypes=parttypes,
+                                   galaxy=galaxy, id_file=id_file, mmap=mmap)
                     return snapclass
+            elif snapshot_io.gadget_binary_format(curfilename) is not None:
+                snapclass = super(Snapshot, cls).__new__(snapshot_io.SnapGadgetBinary)
+                snapclass.init(filelist if multi else curfilename, part_names, fields=fields,
+                               parttypes=parttypes, **kwargs)
+                return snapclass
             else:
-                raise RuntimeError("Filetype is not HDF5. Other file types are not implemented in this version of SnapTools.")
+                raise RuntimeError("Filetype is not HDF5 or Gadget binary. Other file types are not implemented in this version of SnapTools.")
 
         else:
             return super(Snapshot, cls).__new__(cls)
@@ -76,6 +148,145 @@ class Snapshot(object):
         self.bin_dict = None
 
 
+    @property
+    def derived(self):
+        """
+        Derived quantities of the particles, computed when first used and cached,
+        e.g. snap.derived['r']['stars'] (see derived.DerivedFields)
+        """
+        fields = self.__dict__.get('derived_fields')
+        if fields is None:
+            from .derived import DerivedFields
+            fields = self.__dict__['derived_fields'] = DerivedFields(
+                self, budget=self.__dict__.get('memory_budget'))
+        return fields
+
+
+    def close(self):
+        """
+        Close any files held open (and stop any reader processes started) by the snapshot.
+        Lazy datablocks will reopen them if they are accessed again.
+        """
+        prefetch_pool = getattr(self, 'prefetch_pool', None)
+        if prefetch_pool is not None:
+            prefetch_pool.shutdown()
+            self.prefetch_pool = None
+        file_pool = getattr(self, 'file_pool', None)
+        if file_pool is not None:
+            file_pool.close()
+        read_pool = getattr(self, 'read_pool', None)
+        if read_pool is not None:
+            read_pool.close()
+        # loaded datablocks stay usable but no longer count towards a memory budget
+        attrs = list(self.__dict__.values())
+        derived_fields = self.__dict__.get('derived_fields')
+        if derived_fields is not None:
+            attrs += list(derived_fields.values.values())
+        for attr in attrs:
+            budget = getattr(attr, 'budget', None)
+            if budget is not None:
+                budget.discard(attr)
+
+
+    def prefetch(self, fields=None, parttypes=None, workers=4):
+        """
+        Start loading lazy datablocks in background threads and return immediately.
+        Using a datablock that is being prefetched waits until it has been read.
+        Has no effect on datablocks that are already loaded.
+        kwargs:
+            fields: datablocks to load, e.g. ['pos', 'masses']. Default is all of them.
+            parttypes: particle types to load. Default is all of them.
+            workers: number of threads reading at the same time
+        Returns:
+            list of futures, one for each datablock
+        """
+        from . import lazydict
+        from concurrent.futures import ThreadPoolExecutor
+
+        def load(lazy, part):
+            value = lazy[part]
+            # lazy datasets are only proxies until they are loaded
+            read = getattr(type(value), 'load', None)
+            if read is not None:
+                read(value)
+            return value
+
+        if getattr(self, 'prefetch_pool', None) is None:
+            self.prefetch_pool = ThreadPoolExecutor(workers)
+        futures = []
+        for name, attr in list(self.__dict__.items()):
+            if (not isinstance(attr, lazydict.LazyDictionary)) or (
+                    (fields is not None) and (name not in fields)):
+                continue
+            for part in list(attr.keys()):
+                if (parttypes is None) or (part in parttypes):
+                    futures.append(self.prefetch_pool.submit(load, attr, part))
+        return futures
+
+
+    def set_memory_budget(self, max_bytes):
+        """
+        Limit the memory held by the lazily loaded datablocks of this snapshot.
+        Least recently used datablocks are dropped when over budget and reloaded when used again.
+        Use lazydict.set_default_budget for a budget shared by all snapshots.
+        Args:
+            max_bytes: Budget in bytes, None for no limit
+        """
+        from . import lazydict
+
+        budget = lazydict.MemoryBudget(max_bytes)
+        for attr in list(self.__dict__.values()):
+            if isinstance(attr, lazydict.LazyDictionary):
+                attr.set_budget(budget)
+        derived_fields = self.__dict__.get('derived_fields')
+        if derived_fields is not None:
+            derived_fields.set_budget(budget)
+        self.memory_budget = budget
+        if max_bytes is not None:
+            budget.shrink(max_bytes)
+
+
+    def stats(self):
+        """
+        What this snapshot has loaded so far. For every datablock and particle type:
+        loads (number of reads), bytes (read), seconds (spent reading), sources (files read)
+        and whether it is still resident in memory (resident, resident_bytes).
+        Returns:
+            dictionary of datablock: particle type: statistics
+        """
+        load_stats = getattr(self, 'load_stats', None)
+        if load_stats is None:
+            return {}
+        return load_stats.report(self)
+
+
+    def resident_bytes(self):
+        """
+        Bytes of memory held by the datablocks that have been loaded
+        """
+        from . import lazydict
+
+        total = 0
+        for name, attr in list(self.__dict__.items()):
+            if isinstance(attr, lazydict.LazyDictionary):
+                total += attr.resident_bytes()
+            elif isinstance(attr, dict) and (name not in ('header', 'settings', 'bin_dict')):
+                for val in attr.values():
+                    if isinstance(val, dict):  # misc datablocks of SnapHDF5
+                        total += sum(lazydict.resident_bytes(v) for v in val.values())
+                    else:
+                        total += lazydict.resident_bytes(val)
+        return total
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
     def set_settings(self, **kwargs):
         """
         Set the settings used by analysis and plotting tools.
@@ -86,6 +297,29 @@ class Snapshot(object):
             self.settings[name] = val
 
 
+    def iter_chunks(self, ptype, fields=['pos', 'masses'], chunk_size=2**20):
+        """
+        Iterate over aligned blocks of several datablocks.
+        Datablocks that are still on disk are read one block at a time,
+        so reductions can run over particle types that do not fit in memory.
+        Args:
+            ptype: A string or iterable of particle types. Blocks never span particle types.
+        kwargs:
+            fields: datablocks to include in each block
+            chunk_size: maximum number of particles in a block
+        Yields:
+            dictionary of field: array with the same (at most chunk_size) particles
+        """
+        if (getattr(ptype, '__iter__', None) is None) or (isinstance(ptype, (str, bytes))):
+            ptype = [ptype]
+
+        for p in ptype:
+            arrays = {field: getattr(self, field)[p] for field in fields}
+            npart = min(len(arr) for arr in arrays.values())
+            for start in range(0, npart, chunk_size):
+                yield {field: arr[start:start+chunk_size] for field, arr in arrays.items()}
+
+
     def split_galaxies(self, ptype, mass_list=None):
         """Split galaxies based on particles that have the same mass
         Args:
@@ -97,42 +331,129 @@ class Snapshot(object):
         if (getattr(ptype, '__iter__', None) is None) or (isinstance(ptype, (str, bytes))):
             ptype = [ptype]
 
+        if mass_list is None:
+            # largest galaxy first, see segment_galaxies
+            n = sum(len(self.masses[p]) for p in ptype)
+            return [utils.as_rows(rows, n) for rows in self.segment_galaxies(ptype)]
+
         indices = []
 
         nlast = 0
 
         for i, p in enumerate(ptype):
             mass = self.masses[p]
-            if mass_list is not None:
-                for j, m in enumerate(mass_list):
-                    if i == 0:
-                        indices.append(np.where(mass == m)[0])
-                        nlast = len(mass)
-                    else:
-                        indices[j] = np.append(indices[j], np.where(mass == m)[0] + nlast)
-                        nlast = len(mass)
-
+            # particle types with their mass in the header don't need to be searched
+            const = utils.constant_value(mass)
+            if const is not None:
+                def where(m):
+                    return np.arange(len(mass)) if m == const else np.array([], dtype=int)
             else:
-                unq = np.unique(mass)
+                def where(m):
+                    return np.where(mass == m)[0]
+
+            for j, m in enumerate(mass_list):
                 if i == 0:
-                    ngals = len(unq)
+                    indices.append(where(m))
+                    nlast = len(mass)
+                else:
+                    indices[j] = np.append(indices[j], where(m) + nlast)
+                    nlast = len(mass)
 
-                # Add negatives to make list same size as galaxy list.
-                #Assume that larger galaxies have more parts for now
-                while len(unq) < ngals:
-                        unq = np.insert(unq, 0, -1.0)
+        return indices
 
-                masses = np.argsort([np.sum(mass == u)*u for u in unq])[::-1]
-                #invert the order so that the largest galaxy is first, as was the case in the old code
-                for j, m in enumerate(masses):
-                    if i == 0:
-                        indices.append(np.where(mass == unq[m])[0])
-                        nlast = len(mass)
-                    else:
-                        indices[j] = np.append(indices[j], np.where(mass == unq[m])[0] + nlast)
-                        nlast = len(mass)
 
-        return indices
+    def segment_galaxies(self, ptype, refresh=False):
+        """
+        Split galaxies based on particles that have the same mass, largest galaxy first.
+        Returns a slice for each galaxy whose particles are one contiguous range of rows
+        (the usual case for merger ICs) and an array of row numbers otherwise.
+        The segmentation is computed in one pass over the masses and cached
+        until the masses datablock is replaced.
+        Args:
+            ptype: A string or iterable of particle types
+        kwargs:
+            refresh: recompute even if cached, e.g. after changing masses in place
+        """
+        if (getattr(ptype, '__iter__', None) is None) or (isinstance(ptype, (str, bytes))):
+            ptype = [ptype]
+        ptype = tuple(ptype)
+
+        segments = self.__dict__.setdefault('galaxy_segments', {})
+        # the mass arrays the segmentation was made from
+        masses = [self.masses[p] for p in ptype]
+        if ((not refresh) and (ptype in segments) and
+                all(old is new for old, new in zip(segments[ptype][0], masses))):
+            return list(segments[ptype][1])
+
+        indices = []
+        nlast = 0
+        for i, p in enumerate(ptype):
+            rows = self._segment_masses(self.masses[p], None if i == 0 else len(indices))
+            if i == 0:
+                indices = rows
+            else:
+                while len(indices) < len(rows):
+                    indices.append(np.array([], dtype=np.intp))
+                for j, r in enumerate(rows):
+                    r = utils.as_rows(r, len(self.masses[p])) + nlast
+                    indices[j] = utils.as_slice(np.append(utils.as_rows(indices[j], nlast), r))
+            nlast += len(self.masses[p])
+
+        segments[ptype] = (masses, indices)
+        return list(indices)
+
+
+    @staticmethod
+    def _segment_masses(mass, ngals=None):
+        """
+        Rows of each galaxy (particles of the same mass) of one particle type, largest galaxy first.
+        If ngals is given empty galaxies are added to make that many.
+        """
+        const = utils.constant_value(mass)
+        if const is not None:
+            unq = np.array([const])
+            counts = np.array([len(mass)])
+            rows = [slice(0, len(mass))]
+        else:
+            mass = np.asarray(mass)
+            unq, inverse, counts = np.unique(mass, return_inverse=True, return_counts=True)
+            inverse = inverse.ravel()
+            starts = np.flatnonzero(np.diff(inverse)) + 1
+            if len(starts) == len(unq) - 1:
+                # every galaxy is one run of rows
+                bounds = np.concatenate([[0], starts, [len(mass)]])
+                rows = [None]*len(unq)
+                for k in range(len(unq)):
+                    rows[inverse[bounds[k]]] = slice(int(bounds[k]), int(bounds[k + 1]))
+            else:
+                order = np.argsort(inverse, kind='stable')
+                bounds = np.concatenate([[0], np.cumsum(counts)])
+                rows = [utils.as_slice(order[bounds[k]:bounds[k + 1]]) for k in range(len(unq))]
+
+        # Add negatives to make list same size as galaxy list.
+        #Assume that larger galaxies have more parts for now
+        if ngals is not None:
+            while len(unq) < ngals:
+                unq = np.insert(unq, 0, -1.0)
+                counts = np.insert(counts, 0, 0)
+                rows.insert(0, slice(0, 0))
+
+        #invert the order so that the largest galaxy is first, as was the case in the old code
+        order = np.argsort([c*u for c, u in zip(counts, unq)])[::-1]
+        return [rows[k] for k in order]
+
+
+    def galaxy(self, gal_num):
+        """
+        A view of one galaxy of the snapshot (see GalaxyView). Its datablocks are slices
+        of the snapshot's datablocks (or gathers, cached, when the galaxy's rows are not
+        contiguous), so nothing is copied or read until it is used.
+        Args:
+            gal_num: number of the galaxy, largest first (see segment_galaxies)
+        """
+        view = super(Snapshot, GalaxyView).__new__(GalaxyView)
+        view.init(self, gal_num)
+        return view
 
 
 
@@ -152,11 +473,15 @@ class Snapshot(object):
         else:
             pos = self.pos[ptype]
 
+        # one galaxy given as a range of rows (see segment_galaxies)
+        if isinstance(indices_list, slice):
+            return np.mean(pos[indices_list], axis=0)
+
         centers = []
         for indices in indices_list:  # change this logic
             #First check to see if we have a list lists or just one galaxy
             y = getattr(indices, '__iter__', None)
-            if y is None:
+            if (y is None) and (not isinstance(indices, slice)):
                 centers = np.mean(pos[indices_list], axis=0)
                 break
 
@@ -165,6 +490,59 @@ class Snapshot(object):
         return np.array(centers)
 
 
+    def measure_centers(self, ptype, field='pos', mass_weighted=True, method='com', **kwargs):
+        """
+        Measure the centers of all galaxies (see segment_galaxies) at once
+        Args:
+            ptype: A string or list of particle types
+        kwargs:
+            field: 'pos' for the positions of the centers, 'vel' for their velocities
+            mass_weighted: weight the particles by their masses
+            method: 'com' for centers of mass, measured together in one pass, or
+                    'shrink' for shrinking sphere centers (see manipulate.shrinking_sphere).
+                    With 'vel' the velocity is that of the particles in the final sphere.
+            other kwargs are passed to manipulate.shrinking_sphere
+        Returns:
+            ngals x 3 array
+        """
+        if (getattr(ptype, '__iter__', None) is None) or (isinstance(ptype, (str, bytes))):
+            ptype = [ptype]
+
+        def combined(name):
+            blocks = [getattr(self, name)[p] for p in ptype]
+            if len(blocks) == 1:
+                return blocks[0]
+            return np.concatenate([np.asarray(b) for b in blocks])
+
+        values = combined(field)
+        pos = values if field == 'pos' else combined('pos')
+        mass = combined('masses') if mass_weighted else None
+        gals = self.segment_galaxies(ptype)
+
+        if method == 'com':
+            labels = np.full(len(values), -1, dtype=np.intp)
+            for k, rows in enumerate(gals):
+                labels[rows] = k
+            return man.group_centers(values, labels, len(gals), mass)
+        elif method == 'shrink':
+            centers = np.full((len(gals), 3), np.nan)
+            for k, rows in enumerate(gals):
+                if len(utils.as_rows(rows, len(pos))) == 0:
+                    continue
+                weights = None if mass is None else mass[rows]
+                center, inside = man.shrinking_sphere(pos[rows], weights, **kwargs)
+                if field == 'pos':
+                    centers[k] = center
+                else:
+                    inside = utils.as_rows(rows, len(pos))[inside]
+                    weights = None if mass is None else mass[inside]
+                    centers[k] = man.group_centers(values[inside], np.zeros(len(inside), dtype=np.intp),
+                                                   1, weights)[0]
+            return centers
+        else:
+            raise ValueError("Unknown centering method: %s" % method)
+
+
     def center_of_mass(self, parttype):
         """
         DEPRECATED
@@ -177,24 +555,19 @@ class Snapshot(object):
         # We cannot rely on each galaxy having different mass particles
         # Especially when we run more massive mergers
 
-        idgal1 = np.where(self.masses[parttype] ==
-                          self.masses[parttype][0])[0]
-        idgal2 = np.where(self.masses[parttype] !=
-                          self.masses[parttype][0])[0]
+        mass = self.masses[parttype]
+        first = np.asarray(mass == mass[0])
+        idgal1 = np.flatnonzero(first)
+        idgal2 = np.flatnonzero(~first)
         if len(idgal1) < len(idgal2):
             idgal1, idgal2 = idgal2, idgal1
+            first = ~first
 
         if len(idgal2) > 0:
-            com1 = np.array([np.mean(self.pos[parttype][idgal1, 0]),
-                             np.mean(self.pos[parttype][idgal1, 1]),
-                             np.mean(self.pos[parttype][idgal1, 2])])
-            com2 = np.array([np.mean(self.pos[parttype][idgal2, 0]),
-                             np.mean(self.pos[parttype][idgal2, 1]),
-                             np.mean(self.pos[parttype][idgal2, 2])])
+            # both centers (all three axes) in one pass
+            com1, com2 = man.group_centers(self.pos[parttype], (~first).astype(np.intp), 2)
         else:
-            com1 = [np.mean(self.pos[parttype][:, 0]),
-                    np.mean(self.pos[parttype][:, 1]),
-                    np.mean(self.pos[parttype][:, 2])]
+            com1 = list(np.mean(self.pos[parttype], axis=0))
             com2 = [0, 0, 0]
 
         return com1, com2, idgal1, idgal2
@@ -226,6 +599,19 @@ class Snapshot(object):
         if settings is None:
             settings = self.settings
 
+        # read the halo (and star) datablocks needed below while the stars are binned,
+        # unless they are read in chunks or must stay within a memory budget
+        from . import lazydict
+        budget = self.__dict__.get('memory_budget', lazydict.default_budget())
+        star_futures, halo_futures = [], []
+        if (settings['chunk_size'] is None) and (budget.max_bytes is None):
+            fields, parttypes = utils.projection_from_settings(settings)
+            star_futures = self.prefetch(fields, list(set(parttypes + ['stars'])))
+            halo_fields = ['pos', 'masses']
+            if settings['halo_center_method'] == 'pot':
+                halo_fields += ['vel', 'pot']
+            halo_futures = self.prefetch(halo_fields, ['halo'])
+
         bin_dict = self.bin_snap(settings, doLog=True)
         Z2 = bin_dict['Z2']
         measurements = man.fit_contours(Z2,
@@ -240,10 +626,13 @@ class Snapshot(object):
         xCenters = measurements['xCenters']
         yCenters = measurements['yCenters']
 
-        indices = self.split_galaxies('halo', mass_list=None)
+        # raise any errors of the prefetched reads
+        for future in star_futures + halo_futures:
+            future.result()
+        indices = self.segment_galaxies('halo')
         com = self.measure_com('halo', indices[settings['gal_num']])
 
-        indices_stars = self.split_galaxies('stars', mass_list=None)
+        indices_stars = self.segment_galaxies('stars')
         com_stars = self.measure_com('stars', indices_stars[settings['gal_num']])
 
         # If we have info on the potential then use the particle with lowest energy
@@ -344,11 +733,10 @@ class Snapshot(object):
         else:
             x_cent, y_cent, z_cent = com1
 
-        px2 = pos[gal1id, 0] - x_cent
-        py2 = pos[gal1id, 1] - y_cent
-        r = np.sqrt(px2**2 + py2**2)
-        # Y and X are reversed by definition in np.arctan2
-        theta = np.arctan2(py2, px2)
+        with self.derived.centered(np.array([x_cent, y_cent, z_cent])):
+            gal1 = self.derived.select(parttype, gal1id)
+            r = gal1['R']
+            theta = gal1['theta']
 
         return man.measure_fourier(r, theta, lengthX, BINS_r, BINS_theta)
 
@@ -357,13 +745,11 @@ class Snapshot(object):
         """
         Measure the center of the dark matter potential
         """
-        r = np.sqrt(np.sum((self.pos['halo'][idgal, :]-com1)**2, axis=1))
-        pot = (self.pot['halo'][idgal[r < 100]])
-
-        ke = (0.5*self.masses['halo'][idgal[r < 100]] *
-              np.sum(self.vel['halo'][idgal[r < 100], :]**2, axis=1))
+        with self.derived.centered(com1):
+            r = self.derived.select('halo', idgal)['r']
+        idgal = utils.as_rows(idgal, len(self.pos['halo']))
         # Binding energy is the sum of the grav. potential and the kinetic energies
-        binding_energy = ke+0.5*pot*self.masses['halo'][idgal[r < 100]]
+        binding_energy = self.derived.select('halo', idgal[r < 100])['binding_energy']
         most_bound = np.argsort(binding_energy)[:100]
 
         # Take the center to be the center of mass of these 100 most bound particles
@@ -375,17 +761,21 @@ class Snapshot(object):
         return x_pot, y_pot, z_pot
 
 
-    def bin_snap(self, settings=None, doLog=True):
+    def bin_snap(self, settings=None, doLog=True, chunk_size=None):
         """
         Create 2D density projection of snapshot in one or more projections.
 
         kwargs:
             settings: settings dictionary
                     if None then use self.settings
+            chunk_size: if set, read and bin at most this many particles at a time
+                        (see iter_chunks). Default is settings['chunk_size'].
         """
 
         if settings is None:
             settings = self.settings
+        if chunk_size is None:
+            chunk_size = settings.get('chunk_size')
 
         bin_dict = {}
         lengthX = settings['xlen']
@@ -397,77 +787,80 @@ class Snapshot(object):
         head = self.header
         if ptype not in self.part_names:
             raise ValueError('Invalid parttype: %s' % ptype + '. Part not present in snapshot')
-        if ((getattr(ptype, '__iter__', None) is not None) and  # add additional check due to python3
-            (not isinstance(ptype, (str, bytes)))):
-            pos = np.append(*[self.pos[k] for k in ptype], axis=0)
-            mass = np.append(*[self.masses[k] for k in ptype])
+        if chunk_size is not None:
+            bin_dict.update(self._bin_chunks(settings, doLog, chunk_size))
         else:
-            pos = self.pos[ptype]
-            mass = self.masses[ptype]
-
-    #size in units of scale length
-        Zmin = settings['in_min']
-        Zmax = settings['in_max']
-        if settings['com'] or (settings['gal_num'] > -1):
-            indices = self.split_galaxies(ptype, mass_list=None)
-
-        # User supplied offsets
-        if any(settings['offset']):
-            x_cent, y_cent, z_cent = settings['offset']
-        # Offset from com of ptype
-        elif settings['com']:
-            if settings['gal_num'] < 0:
-                x_cent, y_cent, z_cent = self.measure_com(ptype, indices[0])
+            if ((getattr(ptype, '__iter__', None) is not None) and  # add additional check due to python3
+                (not isinstance(ptype, (str, bytes)))):
+                pos = np.append(*[self.pos[k] for k in ptype], axis=0)
+                mass = np.append(*[self.masses[k] for k in ptype])
             else:
-                x_cent, y_cent, z_cent = self.measure_com(ptype, indices[settings['gal_num']])
-        # Don't offset
-        else:
-            x_cent = y_cent = z_cent = 0
-
-        if settings['first_only'] or (settings['gal_num'] > -1):
-            mass = mass[indices[settings['gal_num']]]
-            px = (pos[indices[settings['gal_num']], 0] - x_cent).T
-            py = (pos[indices[settings['gal_num']], 1] - y_cent).T
-            pz = (pos[indices[settings['gal_num']], 2] - z_cent).T
-        else:
-            px = pos[:, 0] - x_cent
-            py = pos[:, 1] - y_cent
-            pz = pos[:, 2] - z_cent
-
-        if settings['plotCompanionCOM']:
-            #currently only records second galaxy
-            if not (settings['com'] or (settings['gal_num'] > -1)):
-                indices = self.split_galaxies(ptype, mass_list=None)
-
-            #currently will plot gal_num + 1, but change this
-
-            bin_dict['companionCOM'] = [np.mean(pos[indices[settings['gal_num'] + 1], 0]
-                                                - x_cent),
-                                        np.mean(pos[indices[settings['gal_num'] + 1], 1]
-                                                - y_cent),
-                                        np.mean(pos[indices[settings['gal_num'] + 1], 2]
-                                                - z_cent)]
-
-
-        # All panelmodes need this perspective
-        Z2, x, y = man.bin_particles(px, py, lengthX,
-                                     lengthY, mass, BINS, doLog)
-        bin_dict['Z2'] = Z2
-        bin_dict['Z2x'] = x
-        bin_dict['Z2y'] = y
+                pos = self.pos[ptype]
+                mass = self.masses[ptype]
+
+        #size in units of scale length
+            Zmin = settings['in_min']
+            Zmax = settings['in_max']
+            if settings['com'] or (settings['gal_num'] > -1):
+                indices = self.segment_galaxies(ptype)
+
+            # User supplied offsets
+            if any(settings['offset']):
+                x_cent, y_cent, z_cent = settings['offset']
+            # Offset from com of ptype
+            elif settings['com']:
+                if settings['gal_num'] < 0:
+                    x_cent, y_cent, z_cent = self.measure_com(ptype, indices[0])
+                else:
+                    x_cent, y_cent, z_cent = self.measure_com(ptype, indices[settings['gal_num']])
+            # Don't offset
+            else:
+                x_cent = y_cent = z_cent = 0
 
-        # Need other perspectives
-        if (panels == "three") or (panels == "small"):
-            H, x, z = man.bin_particles(px, pz, lengthX,
-                                        lengthZ, mass, BINS, scale)
-            bin_dict['H'] = H
-            bin_dict['Hx'] = x
-            bin_dict['Hy'] = z
-            H2, y, z = man.bin_particles(py, pz, lengthY,
-                                         lengthZ, mass, BINS, scale)
-            bin_dict['H2'] = H2
-            bin_dict['H2x'] = y
-            bin_dict['H2y'] = z
+            if settings['first_only'] or (settings['gal_num'] > -1):
+                mass = mass[indices[settings['gal_num']]]
+                px = (pos[indices[settings['gal_num']], 0] - x_cent).T
+                py = (pos[indices[settings['gal_num']], 1] - y_cent).T
+                pz = (pos[indices[settings['gal_num']], 2] - z_cent).T
+            else:
+                px = pos[:, 0] - x_cent
+                py = pos[:, 1] - y_cent
+                pz = pos[:, 2] - z_cent
+
+            if settings['plotCompanionCOM']:
+                #currently only records second galaxy
+                if not (settings['com'] or (settings['gal_num'] > -1)):
+                    indices = self.segment_galaxies(ptype)
+
+                #currently will plot gal_num + 1, but change this
+
+                bin_dict['companionCOM'] = [np.mean(pos[indices[settings['gal_num'] + 1], 0]
+                                                    - x_cent),
+                                            np.mean(pos[indices[settings['gal_num'] + 1], 1]
+                                                    - y_cent),
+                                            np.mean(pos[indices[settings['gal_num'] + 1], 2]
+                                                    - z_cent)]
+
+
+            # All panelmodes need this perspective
+            Z2, x, y = man.bin_particles(px, py, lengthX,
+                                         lengthY, mass, BINS, doLog)
+            bin_dict['Z2'] = Z2
+            bin_dict['Z2x'] = x
+            bin_dict['Z2y'] = y
+
+            # Need other perspectives
+            if (panels == "three") or (panels == "small"):
+                H, x, z = man.bin_particles(px, pz, lengthX,
+                                            lengthZ, mass, BINS, doLog)
+                bin_dict['H'] = H
+                bin_dict['Hx'] = x
+                bin_dict['Hy'] = z
+                H2, y, z = man.bin_particles(py, pz, lengthY,
+                                             lengthZ, mass, BINS, doLog)
+                bin_dict['H2'] = H2
+                bin_dict['H2x'] = y
+                bin_dict['H2y'] = z
 
         if (panels == "starsgas") and (ptype != 'gas'):
             # Need both stars and gas
@@ -475,7 +868,7 @@ class Snapshot(object):
             settings_copy = copy.deepcopy(settings)
             settings_copy['parttype'] = 'gas'
             settings_copy['panel_mode'] = 'xy'
-            gasDict = self.bin_snap(settings_copy)
+            gasDict = self.bin_snap(settings_copy, chunk_size=chunk_size)
             bin_dict['G'] = gasDict['Z2']
             bin_dict['Gx'] = gasDict['Z2x']
             bin_dict['Gy'] = gasDict['Z2y']
@@ -484,6 +877,108 @@ class Snapshot(object):
         bin_dict['snapredshift'] = head['redshift']
         return bin_dict
     
+    def _galaxy_masses(self, ptype, chunk_size):
+        """
+        Streaming version of the galaxy ordering in split_galaxies (with mass_list=None)
+        Returns the particle mass of each galaxy for each particle type,
+        largest galaxy first.
+        """
+        gal_masses = []
+        for i, p in enumerate(ptype):
+            counts = defaultdict(int)
+            for chunk in self.iter_chunks(p, ['masses'], chunk_size):
+                const = utils.constant_value(chunk['masses'])
+                if const is not None:
+                    counts[const] += len(chunk['masses'])
+                    continue
+                unq, cnt = np.unique(chunk['masses'], return_counts=True)
+                for u, c in zip(unq, cnt):
+                    counts[u] += c
+            unq = np.array(sorted(counts))
+            if i == 0:
+                ngals = len(unq)
+            while len(unq) < ngals:
+                unq = np.insert(unq, 0, -1.0)
+            order = np.argsort([counts.get(u, 0)*u for u in unq])[::-1]
+            gal_masses.append(unq[order])
+        return gal_masses
+
+
+    def _bin_chunks(self, settings, doLog, chunk_size):
+        """
+        The projections of bin_snap accumulated over blocks of at most chunk_size particles.
+        Galaxy masses and centers of mass are measured in streaming passes first.
+        """
+        lengthX = settings['xlen']
+        lengthY = settings['ylen']
+        lengthZ = settings['zlen']
+        BINS = settings['NBINS']
+        ptype = settings['parttype']
+        panels = settings['panel_mode']
+        gal_num = settings['gal_num']
+        if (getattr(ptype, '__iter__', None) is None) or (isinstance(ptype, (str, bytes))):
+            ptype = [ptype]
+
+        gal_masses = None
+        if settings['com'] or (gal_num > -1) or settings['plotCompanionCOM']:
+            gal_masses = self._galaxy_masses(ptype, chunk_size)
+
+        # streaming centers of mass of the galaxies that are needed
+        cent = np.zeros(3)
+        want = []
+        if (not any(settings['offset'])) and settings['com']:
+            want.append(0 if gal_num < 0 else gal_num)
+        if settings['plotCompanionCOM']:
+            want.append(gal_num + 1)
+        sums = {g: np.zeros(3) for g in want}
+        counts = {g: 0 for g in want}
+        if want:
+            for k, p in enumerate(ptype):
+                for chunk in self.iter_chunks(p, ['pos', 'masses'], chunk_size):
+                    for g in want:
+                        sel = chunk['masses'] == gal_masses[k][g]
+                        sums[g] += chunk['pos'][sel].sum(axis=0, dtype=np.float64)
+                        counts[g] += np.count_nonzero(sel)
+        coms = {g: sums[g]/counts[g] for g in want}
+
+        if any(settings['offset']):
+            cent = np.asarray(settings['offset'], dtype=np.float64)
+        elif settings['com']:
+            cent = coms[want[0]]
+
+        # start from empty maps so the bin edges are set even without particles
+        bin_dict = {}
+        empty = np.zeros(0)
+        maps = [('Z2', 0, 1, lengthX, lengthY)]
+        if (panels == "three") or (panels == "small"):
+            maps += [('H', 0, 2, lengthX, lengthZ), ('H2', 1, 2, lengthY, lengthZ)]
+        for key, i, j, length1, length2 in maps:
+            (bin_dict[key], bin_dict[key + 'x'],
+             bin_dict[key + 'y']) = man.bin_particles(empty, empty, length1, length2, empty, BINS)
+
+        for k, p in enumerate(ptype):
+            for chunk in self.iter_chunks(p, ['pos', 'masses'], chunk_size):
+                pos = chunk['pos']
+                mass = chunk['masses']
+                if settings['first_only'] or (gal_num > -1):
+                    sel = mass == gal_masses[k][gal_num]
+                    pos = pos[sel]
+                    mass = mass[sel]
+                pos = pos - cent
+                for key, i, j, length1, length2 in maps:
+                    bin_dict[key] += man.bin_particles(pos[:, i], pos[:, j], length1, length2,
+                                                       mass, BINS)[0]
+
+        if doLog:
+            for key, i, j, length1, length2 in maps:
+                bin_dict[key] = man.log_scale(bin_dict[key])
+
+        if settings['plotCompanionCOM']:
+            bin_dict['companionCOM'] = list(coms[gal_num + 1] - cent)
+
+        return bin_dict
+
+
     def bin_snap_3D(self, settings=None, doLog=True):
         """
         Create 3D density projection of snapshot in one or more projections.
@@ -516,7 +1011,7 @@ class Snapshot(object):
 
     #size in units of scale length
         if settings['com'] or (settings['gal_num'] > -1):
-            indices = self.split_galaxies(ptype, mass_list=None)
+            indices = self.segment_galaxies(ptype)
 
         # User supplied offsets
         if any(settings['offset']):
@@ -544,7 +1039,7 @@ class Snapshot(object):
         if settings['plotCompanionCOM']:
             #currently only records second galaxy
             if not (settings['com'] or (settings['gal_num'] > -1)):
-                indices = self.split_galaxies(ptype, mass_list=None)
+                indices = self.segment_galaxies(ptype)
 
             #currently will plot gal_num + 1, but change this
 
@@ -608,6 +1103,83 @@ class Snapshot(object):
         bin_dict['snapredshift'] = head['redshift']
         return bin_dict
 
+    def _rotated(self, parttype, theta=0, first_only=False, com=False):
+        """
+        Positions, velocities and masses of parttype rotated by theta (degrees) about the y axis.
+        Copies are made where needed, the snapshot itself is never changed.
+        kwargs:
+            first_only: Only the first galaxy (see center_of_mass)
+            com: Center the first galaxy on its center of mass (with first_only)
+        """
+        pos = self.pos[parttype]
+        vel = getattr(self, 'vel', {}).get(parttype)
+        mass = self.masses[parttype]
+
+        if first_only:
+            com1, com2, gal1id, gal2id = self.center_of_mass(parttype)
+            pos = pos[gal1id, :]
+            vel = None if vel is None else vel[gal1id, :]
+            mass = mass[gal1id]
+            if com:
+                pos = pos - com1
+
+        if theta:  # first check to see if this is even necessary
+            theta = theta * (np.pi / 180.)
+            rotation_matrix = np.array([[np.cos(theta), 0, np.sin(theta)],
+                                        [0, 1, 0],
+                                        [-np.sin(theta), 0, np.cos(theta)]])
+            pos = np.dot(pos, rotation_matrix.T)
+            vel = None if vel is None else np.dot(vel, rotation_matrix.T)
+
+        return pos, vel, mass
+
+    @staticmethod
+    def _fits_cube(pos, vel, mass, lengthX, lengthY, BINS):
+        velz = vel[:, 2] - np.median(vel[:, 2])
+        return np.histogramdd((pos[:, 0], pos[:, 1], velz),
+                              range=((-lengthX, lengthX),
+                                     (-lengthY, lengthY),
+                                     (-200, 200)),
+                              weights=mass * 1E10,
+                              bins=(BINS, BINS, 100))
+
+    @staticmethod
+    def _fits_map(pos, mass, lengthX, lengthY, BINS):
+        return np.histogram2d(pos[:, 0], pos[:, 1],
+                              range=[[-lengthX, lengthX],
+                                     [-lengthY, lengthY]],
+                              weights=mass * 1E10,
+                              bins=BINS)
+
+    @staticmethod
+    def _fits_velfield(pos, vel, lengthX, lengthY, BINS, axes=[0, 1]):
+        from scipy.stats import binned_statistic_2d
+
+        return binned_statistic_2d(pos[:, axes[0]], pos[:, axes[1]], vel[:, axes[1]],
+                                   statistic='mean',
+                                   range=[[-lengthX, lengthX],
+                                          [-lengthY, lengthY]],
+                                   bins=BINS)[:3]
+
+    @staticmethod
+    def _write_fits(fname, data, naxis):
+        from astropy.io import fits
+
+        hdu = fits.PrimaryHDU()
+        hdu.header['BITPIX'] = -64
+        hdu.header['NAXIS'] = len(naxis)
+        for i, n in enumerate(naxis):
+            hdu.header['NAXIS%d' % (i + 1)] = n
+        if len(naxis) == 3:
+            hdu.header['CTYPE3'] = 'VELOCITY'
+            #hdu.header['CTYPE3'] = 'VELO-LSR'
+            hdu.header['CRVAL3'] = 0.0000000000000E+00
+            hdu.header['CDELT3'] = 0.4000000000000E+04
+            hdu.header['CRPIX3'] = 0.5000000000000E+02
+            hdu.header['CROTA3'] = 0.0000000000000E+00
+        hdu.data = data
+        hdu.writeto(fname, overwrite=True)
+
     def to_cube(self,
                 filename='snap',
                 theta=0,
@@ -626,70 +1198,11 @@ class Snapshot(object):
             filename: Filename stub to save to disk.
                       Will append '_cube.fits'.
         """
+        pos, vel, mass = self._rotated(parttype, theta, first_only, com)
+        H, Edges = self._fits_cube(pos, vel, mass, lengthX, lengthY, BINS)
 
         if write:
-            from astropy.io import fits
-        theta *= (np.pi / 180.)
-    #    head=rs.snapshot_header(filename)
-        pos2 = self.pos[parttype]
-        vel2 = self.vel[parttype]
-        mass2 = self.masses[parttype]
-
-        if first_only:
-            com1, com2, gal1id, gal2id = self.center_of_mass(parttype)
-            pos2 = pos2[gal1id, :]
-            vel2 = vel2[gal1id, :]
-            mass2 = mass2[gal1id]
-            if com:
-                pos2 -= com1
-
-        if theta:  # first check to see if this is even necessary
-            rotation_matrix = [
-                [np.cos(theta), 0, np.sin(theta)],
-                [0, 1, 0],
-                [-np.sin(theta), 0, np.cos(theta)]]
-            for i in range(len(pos2[:, 0])):
-                pos_vector = np.array([[pos2[i, 0]],
-                                       [pos2[i, 1]],
-                                       [pos2[i, 2]]])
-                vel_vector = np.array([[vel2[i, 0]],
-                                       [vel2[i, 1]],
-                                       [vel2[i, 2]]])
-                pos_rotated = np.dot(rotation_matrix, pos_vector)
-                vel_rotated = np.dot(rotation_matrix, vel_vector)
-                pos2[i, :] = pos_rotated.T[0]
-                vel2[i, :] = vel_rotated.T[0]
-
-        px2 = pos2[:, 0]
-        py2 = pos2[:, 1]
-        velz = vel2[:, 2]
-        galvel = np.median(velz)
-        velz -= galvel
-        #    pz2=pos2[:,zax]
-        H, Edges = np.histogramdd((px2, py2, velz),
-                                  range=((-lengthX, lengthX),
-                                         (-lengthY, lengthY),
-                                         (-200, 200)),
-                                  weights=mass2 * 1E10,
-                                  bins=(BINS, BINS, 100),
-                                  normed=False)
-
-
-        if write:
-            hdu = fits.PrimaryHDU()
-            hdu.header['BITPIX'] = -64
-            hdu.header['NAXIS'] = 3
-            hdu.header['NAXIS1'] = 512
-            hdu.header['NAXIS2'] = 512
-            hdu.header['NAXIS3'] = 100
-            hdu.header['CTYPE3'] = 'VELOCITY'
-            #hdu.header['CTYPE3'] = 'VELO-LSR'
-            hdu.header['CRVAL3'] = 0.0000000000000E+00
-            hdu.header['CDELT3'] = 0.4000000000000E+04
-            hdu.header['CRPIX3'] = 0.5000000000000E+02
-            hdu.header['CROTA3'] = 0.0000000000000E+00
-            hdu.data = H.T
-            hdu.writeto(filename + '_cube.fits', clobber=True)
+            self._write_fits(filename + '_cube.fits', H.T, (BINS, BINS, 100))
         else:
             return H, Edges
 
@@ -706,42 +1219,11 @@ class Snapshot(object):
         """
         Write snapshot to a fits map
         """
+        pos, vel, mass = self._rotated(parttype, theta, first_only, com)
+        Z2, x, y = self._fits_map(pos, mass, lengthX, lengthY, BINS)
 
         from astropy.io import fits
-        theta *= (np.pi / 180.)
-    #    head=rs.snapshot_header(filename)
-
-        pos2 = self.pos[parttype]
-        mass2 = self.masses[parttype]
-
-        if first_only:
-            com1, com2, gal1id, gal2id = self.center_of_mass(parttype)
-            pos2 = pos2[gal1id, :]
-            mass2 = mass2[gal1id]
-            if com:
-                pos2 -= com1
-
-        if theta:  # first check to see if this is even necessary
-            rotation_matrix = [[np.cos(theta), 0, np.sin(theta)],
-                               [0, 1, 0],
-                               [-np.sin(theta), 0, np.cos(theta)]]
-            for i in range(len(pos2[:, 0])):
-                vector = np.array([[pos2[i, 0]], [pos2[i, 1]], [pos2[i, 2]]])
-                rotated = np.dot(rotation_matrix, vector)
-                pos2[i, :] = rotated.T[0]
-
-        px2 = pos2[:, 0]
-        py2 = pos2[:, 1]
-        # pz2=pos2[:,zax]
-
-        Z2, x, y = np.histogram2d(px2, py2,
-                                  range=[[-lengthX, lengthX],
-                                         [-lengthY, lengthY]],
-                                  weights=mass2 * 1E10,
-                                  bins=BINS,
-                                  normed=False)
-
-        fits.writeto(filename + '_map.fits', Z2, clobber=True)
+        fits.writeto(filename + '_map.fits', Z2, overwrite=True)
 
     def to_velfield(self,
                     filename='snap',
@@ -760,64 +1242,63 @@ class Snapshot(object):
         where each pixel contains the average velocity
         in the y direction.
         """
-
-        from astropy.io import fits
-        from scipy.stats import binned_statistic_2d
-
-        pos2 = self.pos[parttype]
-        vel2 = self.vel[parttype]
-
-        if first_only:
-            com1, com2, gal1id, gal2id = self.center_of_mass(parttype)
-            px2 = pos2[gal1id, axes[0]]
-            py2 = pos2[gal1id, axes[1]]
-            vy2 = vel2[gal1id, axes[1]]
-            if com:
-                px2 -= com1[axes[0]]
-                py2 -= com1[axes[1]]
-        else:
-            px2 = pos2[:, axes[0]]
-            py2 = pos2[:, axes[1]]
-            vy2 = vel2[:, axes[1]]
-
-        (Z2,
-         xedges,
-         yedges,
-         binnum) = binned_statistic_2d(px2, py2, vy2,
-                                       statistic='mean',
-                                       range=[[-lengthX, lengthX],
-                                              [-lengthY, lengthY]],
-                                       bins=BINS)
-
-        hdu = fits.PrimaryHDU()
-        hdu.header['BITPIX'] = -64
-        hdu.header['NAXIS'] = 2
-        hdu.header['NAXIS1'] = 512
-        hdu.header['NAXIS2'] = 512
+        pos, vel, mass = self._rotated(parttype, 0, first_only, com)
+        Z2, xedges, yedges = self._fits_velfield(pos, vel, lengthX, lengthY, BINS, axes)
 
         if write:
-            hdu.data = Z2.T
-            hdu.writeto(filename + '_velfield.fits', clobber=True)
+            self._write_fits(filename + '_velfield.fits', Z2.T, (BINS, BINS))
         else:
             return Z2, xedges, yedges
 
+    def export_fits(self,
+                    filename='snap',
+                    products=['map', 'cube', 'velfield'],
+                    angles=[0],
+                    lengthX=15,
+                    lengthY=15,
+                    BINS=512,
+                    first_only=False,
+                    com=False,
+                    parttype='stars'):
+        """
+        Write several fits products at several viewing angles.
+        The particles are rotated once per angle and every product is made from the same coordinates.
+        Files are named filename + '_{angle}deg_{product}.fits'
+
+        kwargs:
+            products: Any of 'map', 'cube' and 'velfield' (see to_fits, to_cube and to_velfield)
+            angles: Rotation angles about the y axis in degrees
+        Returns:
+            list of the files written
+        """
+        written = []
+        for theta in angles:
+            pos, vel, mass = self._rotated(parttype, theta, first_only, com)
+            stub = '{:s}_{:g}deg'.format(filename, theta)
+            for product in products:
+                fname = '{:s}_{:s}.fits'.format(stub, product)
+                if product == 'map':
+                    Z2, x, y = self._fits_map(pos, mass, lengthX, lengthY, BINS)
+                    self._write_fits(fname, Z2, (BINS, BINS))
+                elif product == 'cube':
+                    H, Edges = self._fits_cube(pos, vel, mass, lengthX, lengthY, BINS)
+                    self._write_fits(fname, H.T, (BINS, BINS, 100))
+                elif product == 'velfield':
+                    Z2, xedges, yedges = self._fits_velfield(pos, vel, lengthX, lengthY, BINS)
+                    self._write_fits(fname, Z2.T, (BINS, BINS))
+                else:
+                    raise ValueError("Unknown fits product: %s" % product)
+                written.append(fname)
+        return written
+
     def velocity_anisotropy(self,
                             parttype):
         """
         Measure velocity anisotropy of a snapshot
         """
-        vel = self.vel[parttype]
-        pos = self.pos[parttype]
-        vx = vel[:, 0]
-        vy = vel[:, 1]
-        vz = vel[:, 2]
-        x = pos[:, 0]
-        y = pos[:, 1]
-        z = pos[:, 2]
-        r = np.sqrt(x**2 + y**2 + z**2)
-        vr = (x*vx + y*vy + z*vz)/r
-        vtheta = (-y*vx + x*vy)/np.sqrt(x**2 + y**2)
-        vphi = (x*(vx*z - x * vz) + y*(vy*z-y*vz))/(r*np.sqrt(x**2 + y**2))
+        vr = self.derived['vr'][parttype]
+        vtheta = self.derived['vtheta'][parttype]
+        vphi = self.derived['vphi'][parttype]
         Beta = 1-(np.std(vtheta)**2+np.std(vphi)**2)/(2*np.std(vr)**2)
         return Beta
 
@@ -827,8 +1308,8 @@ class Snapshot(object):
         Measure the concentration parameter - uses separation between 20% and 80% of the light
         """
         com1, com2, idgal1, idgal2 = self.center_of_mass('stars')
-        r = np.sort(np.sqrt(np.sum( (self.pos['stars'][idgal1, :] -
-                                     com1 - center)**2, axis=1)))
+        with self.derived.centered(com1 + center):
+            r = np.sort(self.derived.select('stars', idgal1)['r'])
         pmf = np.cumsum(r)
         tot_light = np.sum(r)
         where_80perc = np.argmin(np.abs(pmf - 0.8*tot_light))
@@ -955,19 +1436,30 @@ class Snapshot(object):
                     for i, gal in enumerate(mass_list):
                         ids = self.ids[ptype][self.masses[ptype] == unq[masses[i]]]
                         if len(ids) > 0:
-                            dset = grps[i].create_dataset(ptype, ids.shape)
-                            dset[:] = ids
+                            # keep the id type so that large ids match exactly
+                            grps[i].create_dataset(ptype, data=ids)
         id_file.close()
 
 
     def save(self, fname, userblock_size=0,
-             part_names=['gas', 'halo', 'stars', 'bulge', 'sfr', 'other']):
+             part_names=['gas', 'halo', 'stars', 'bulge', 'sfr', 'other'],
+             chunks=None, compression=None, compression_opts=None, shuffle=False,
+             single_precision=False, workers=1):
         """
         Save a snapshot object to an hdf5 file. Overload base case
         Note: Must have matching header and data.
         Todo: Gracefully handle mismatches between header and data
+        kwargs:
+            chunks: Rows per chunk, a chunk shape, or True for about 1 MB chunks.
+                    Default is unchunked unless compression is used.
+            compression: 'gzip', 'lzf' or None
+            compression_opts: gzip compression level
+            shuffle: Apply the shuffle filter before compressing
+            single_precision: Write float64 datablocks as float32
+            workers: Number of threads compressing (gzip) datablocks at the same time
         """
         import h5py
+        from . import snapshot_io
 
         # A list of header attributes, their key names, and data types
         head_attrs = {'npart': (np.int32, 'NumPart_ThisFile'),
@@ -1039,8 +1531,15 @@ class Snapshot(object):
             # create the groups for all particles in the snapshot
             grps = [f.create_group('PartType{:d}'.format(i))  if n > 0 else None
                     for i, n in enumerate(self.header['nall'])]
+            writer = snapshot_io.DatablockWriter(chunks=chunks,
+                                                 compression=compression,
+                                                 compression_opts=compression_opts,
+                                                 shuffle=shuffle,
+                                                 single_precision=single_precision,
+                                                 workers=workers)
             # iterate through datablocks first
 
+            massarr = np.array(self.header['massarr'], dtype=np.float64)
             for attr_name, attr in self.__dict__.items():
                 x = getattr(attr, 'states', None)
                 if (x is None) and (attr_name not in datablocks):  # only want lazy-dict things
@@ -1048,15 +1547,21 @@ class Snapshot(object):
                 for p, val in attr.items():  # then through particle types
 
                     i = part_names.index(p)
-                    try:
-                        dset = grps[i].create_dataset(datablocks[attr_name], val.shape,
-                                                      dtype=val.dtype)
-                    except KeyError:
-                        dset = grps[i].create_dataset(attr_name, val.shape, dtype=val.dtype)
-                    dset[:] = val
-
-
-    def write_csv(self, gal_num=-1, ptypes=['stars'], stepsize=100, columns=['pos', 'vel']):
+                    if (attr_name == 'masses') and (massarr[i] != 0):
+                        # constant masses are already in the MassTable
+                        if ((utils.constant_value(val) == massarr[i]) or
+                                (isinstance(val, np.ndarray) and np.all(val == massarr[i]))):
+                            continue
+                        # edited masses, the Masses datablock is only read when the MassTable entry is 0
+                        massarr[i] = 0
+                    writer.write(grps[i], datablocks.get(attr_name, attr_name), val)
+            writer.close()
+            if 'massarr' in self.header:
+                grp.attrs.create('MassTable', massarr, dtype=np.float64)
+
+
+    def write_csv(self, gal_num=-1, ptypes=['stars'], stepsize=100, columns=['pos', 'vel'],
+                  fname=None, compress=False, chunk_size=100000):
         """
         Write a csv version of the snapshot. Helpful for paraview or sharing simple versions with collaborators.
         Particles are sorted by ID number, so that the same particles are always in the same row of the file.
@@ -1065,59 +1570,83 @@ class Snapshot(object):
             ptypes: Particle types to save.
             stepsize: Save every nth particle.
             columns: Which properties to save. Properties must be in every particle type you request.
+            fname: Output file. Default is the snapshot filename + .csv (.csv.gz if compressed)
+            compress: gzip the output
+            chunk_size: Number of rows formatted at a time
         """
-        if gal_num < 0:
-            idgal = list(range(len(self.ids[ptypes[0]])))
-        else:
-            idgal = self.split_galaxies(ptypes[0], mass_list=None)[gal_num]
-
-        all_data = {}
-        allids = self.ids[ptypes[0]][idgal]
-        for column in columns:
+        import gzip
+
+        ptypes = [p for p in ptypes if (p in self.ids.keys()) and (len(self.ids[p]) > 0)]
+        # rows of each particle type that are in the galaxy
+        rows = []
+        for ptype in ptypes:
+            if gal_num < 0:
+                rows.append(np.arange(len(self.ids[ptype])))
+            else:
+                rows.append(np.asarray(self.split_galaxies(ptype, mass_list=None)[gal_num]))
+        offsets = np.cumsum([0] + [len(r) for r in rows])
+
+        # every stepsize-th particle is written, sorted by ID
+        selected = np.arange(0, offsets[-1], stepsize)
+        which = np.searchsorted(offsets, selected, side='right') - 1
+        local = np.empty(len(selected), dtype=np.int64)
+        ids = np.empty(len(selected), dtype=np.int64)
+        for k, ptype in enumerate(ptypes):
+            sel = which == k
+            local[sel] = rows[k][selected[sel] - offsets[k]]
+            ids[sel] = self.ids[ptype][local[sel]]
+        order = np.argsort(ids, kind='stable')
+        which = which[order]
+        local = local[order]
+
+        def column(name, ptype):
             # Get an arbitrary name, first try in non-misc properties, then try in misc props
             try:
-                all_data[column] = self.__dict__[column][ptypes[0]][idgal]
+                return self.__dict__[name][ptype]
             except KeyError:
-                all_data[column] = self.misc[ptypes[0]][column][idgal]
-
-            for ptype in ptypes[1:]:
-                # check to make sure we have particles
-                if (ptype in self.pos.keys()) and (len(self.pos[ptype]) > 0):
-                    if gal_num < 0:
-                        idgal = list(range(len(self.ids[ptype])))
-                    else:
-                        idgal = self.split_galaxies(ptype, mass_list=None)[gal_num]
-                #first construc list of all ids
-                allids = np.concatenate((self.ids[ptype][idgal], allids), axis=0)
-                # construct lists of other properties
-                try:
-                    all_data[column] = np.concatenate((self.__dict__[column][ptypes[0]][idgal],
-                                                       all_data[column]), axis=0)
-                except KeyError:
-                    all_data[column] = np.concatenate((self.misc[ptypes[0]][column][idgal],
-                                                       all_data[column]), axis=0)
-
-        s = np.argsort(allids)
+                return self.misc[ptype][name]
 
         header = []
-        for column_name, column_data in all_data.items():
-            if len(column_data.shape) == 1:
-                header.append(column_name)
+        row_format = []
+        dtypes = []
+        for name in columns:
+            first = column(name, ptypes[0]) if len(ptypes) > 0 else np.empty(0)
+            # integer columns (e.g. ids) are written exactly
+            integer = np.issubdtype(first.dtype, np.integer)
+            dtypes.append(np.int64 if integer else np.float64)
+            if np.ndim(first) > 1:
+                header.append("{0}x,{0}y,{0}z".format(name))
+                row_format.append("%d,%d,%d" if integer else "%3.3f,%3.3f,%3.3f")
             else:
-                header.append("{0}x,{0}y,{0}z".format(column_name))
+                header.append(name)
+                row_format.append("%d" if integer else "%g")
         header = ','.join(header)
+        row_format = ','.join(row_format) + '\n'
 
-        with open(self.filename+".csv", "w") as f:
+        if fname is None:
+            fname = self.filename + (".csv.gz" if compress else ".csv")
+        opener = gzip.open if compress else open
+
+        with opener(fname, "wt") as f:
             f.write(header+'\n')
-            for si in s[::stepsize]:
-                column_text = ''
-                for _, column_data in all_data.items():
-                    if len(column_data.shape) > 1:
-                        column_text += "{:3.3f},{:3.3f},{:3.3f},".format(*column_data[si, :])
-                    else:
-                        column_text += "{:g},".format(column_data[si])
-                #Strip trailing comma and add newline break
-                f.write(column_text[:-1]+"\n")
+            for start in range(0, len(order), chunk_size):
+                block_which = which[start:start+chunk_size]
+                block_rows = local[start:start+chunk_size]
+                block = []
+                for name, dtype in zip(columns, dtypes):
+                    data = None
+                    for k, ptype in enumerate(ptypes):
+                        sel = block_which == k
+                        if not np.any(sel):
+                            continue
+                        values = column(name, ptype)[block_rows[sel]]
+                        if data is None:
+                            data = np.empty((len(block_rows),) + np.shape(values)[1:], dtype=dtype)
+                        data[sel] = values
+                    block.append(data.reshape(len(block_rows), -1).tolist())
+                # format the whole block at once, each column keeps its own type
+                values = [v for row in zip(*block) for col in row for v in col]
+                f.write((row_format*len(block_rows)) % tuple(values))
 
     def __repr__(self):
         if not self.header:  # empty dict evaluates to False
@@ -1134,3 +1663,116 @@ Header: {:s}""".format(str(self.filename), str(self.header))
                     return """Snapshot file - {:s}
 -------------------------------------------------
 Header: {:s}""".format(self.filename, str(self.header))
+
+
+class GalaxyBlock(Mapping):
+    """
+    One datablock of a GalaxyView: the rows of the galaxy in each particle type
+    of the parent snapshot's datablock
+    """
+    def __init__(self, view, name):
+        self.view = view
+        self.name = name
+        self.values = {}  # particle type: (parent value, value)
+
+    def __getitem__(self, ptype):
+        if ptype not in self.view.rows:
+            raise KeyError(ptype)
+        parent = getattr(self.view.parent, self.name)[ptype]
+        cached = self.values.get(ptype)
+        # recompute if the parent's datablock was replaced (or reloaded)
+        if (cached is None) or (cached[0] is not parent):
+            cached = self.values[ptype] = (parent, parent[self.view.rows[ptype]])
+        return cached[1]
+
+    def __iter__(self):
+        return (p for p in getattr(self.view.parent, self.name, {}) if p in self.view.rows)
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+
+class GalaxyView(Snapshot):
+    """
+    One galaxy of a snapshot, made by Snapshot.galaxy. Has the datablocks of the
+    parent snapshot restricted to the galaxy's particles and works with all
+    snapshot methods. Datablocks are not copied when the galaxy's particles are
+    contiguous in the parent.
+    """
+    def __init__(self, parent, gal_num):
+        pass
+
+    def init(self, parent, gal_num):
+        from . import snapshot_io
+
+        self.parent = parent
+        self.gal_num = gal_num
+        self.filename = parent.filename
+        self.part_names = parent.part_names
+        self.settings = copy.deepcopy(parent.settings)
+        self.settings['gal_num'] = -1  # there is only one galaxy in the view
+        self.bin_dict = None
+
+        # rows of the galaxy in each particle type
+        self.rows = {}
+        for p in self.part_names:
+            if p in getattr(parent, 'masses', {}):
+                gals = parent.segment_galaxies(p)
+                if gal_num < len(gals):
+                    self.rows[p] = gals[gal_num]
+
+        self.header = dict(parent.header)
+        if 'npart' in self.header:
+            snapshot_io.restrict_header(self.header, {
+                i: utils.as_rows(self.rows[p], len(parent.masses[p]))
+                for i, p in enumerate(self.part_names) if p in self.rows})
+
+        names = set(snapshot_io.DATABLOCKS.values()) | {'pos', 'vel', 'ids', 'masses', 'pot'}
+        for name, attr in list(parent.__dict__.items()):
+            if (name in names) and isinstance(attr, Mapping):
+                self.__dict__[name] = GalaxyBlock(self, name)
+        self.misc = {}
+
+    @property
+    def center(self):
+        """
+        Center of mass of the galaxy's particles of type settings['parttype'],
+        measured when first used. Setting it also moves the center of self.derived.
+        """
+        center = self.__dict__.get('galaxy_center')
+        if center is None:
+            ptype = self.settings['parttype']
+            center = self.__dict__['galaxy_center'] = np.mean(self.pos[ptype], axis=0)
+        return center
+
+    @center.setter
+    def center(self, center):
+        self.__dict__['galaxy_center'] = np.asarray(center)
+        if self.__dict__.get('derived_fields') is not None:
+            self.derived.set_center(center)
+
+    @property
+    def derived(self):
+        """
+        Derived quantities of the galaxy's particles, measured from self.center
+        """
+        fields = self.__dict__.get('derived_fields')
+        if fields is None:
+            from .derived import DerivedFields
+            fields = self.__dict__['derived_fields'] = DerivedFields(
+                self, budget=self.parent.__dict__.get('memory_budget'))
+            fields.set_center(self.center)
+        return fields
+
+    def prefetch(self, fields=None, parttypes=None, workers=4):
+        return self.parent.prefetch(fields, parttypes, workers)
+
+    def stats(self):
+        return self.parent.stats()
+
+    def close(self):
+        # the files belong to the parent snapshot
+        pass
+
+    def __repr__(self):
+        return "Galaxy {:d} of {:s}".format(self.gal_num, repr(self.parent))
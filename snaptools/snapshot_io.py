@@ -1,6 +1,17 @@
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, deque
 import numpy as np
+from numpy.lib.mixins import NDArrayOperatorsMixin
 import os
+import json
+import shutil
+import zlib
+import re
+import tempfile
+import time
+import warnings
+from contextlib import contextmanager
+from functools import partial
+from threading import RLock
 from .snapshot import Snapshot
 import h5py
 from . import utils
@@ -75,19 +86,1117 @@ DATABLOCKS = {"Coordinates": "pos",
 
 MISC_DATABLOCKS = DATABLOCKS  # backwards compatibility
 
-def load_dataset(filenames, group, variable):
-    dataset = None
 
-    for filename in filenames:
-        with h5py.File(filename) as f:
-            if dataset is None:
-                dataset = f[group][variable][()]
+def hdf5_header(s):
+    """
+    The Header attributes of the open HDF5 snapshot s, using the names in HEAD_ATTRS
+    """
+    header = {}
+    for head_key, head_val in s['Header'].attrs.items():
+        header[HEAD_ATTRS.get(head_key, head_key)] = head_val
+    return header
+
+
+def wanted(key, part, fields=None, parttypes=None):
+    """
+    Is the datablock key (HDF5 name) of particle type part included in the projection?
+    fields may use either the HDF5 names or the short names in DATABLOCKS.
+    """
+    if (parttypes is not None) and (part not in parttypes):
+        return False
+    if fields is None:
+        return True
+    return (key in fields) or (DATABLOCKS.get(key, key) in fields)
+
+class FilePool(object):
+    """
+    Pool of open HDF5 files shared by all the lazy loaders of one snapshot.
+    At most max_open files are kept open, the least recently used file is closed first.
+    Files in use are never closed by the pool. After a fork the child process
+    drops the handles it inherited and transparently reopens the files itself.
+    """
+    def __init__(self, max_open=16):
+        self.max_open = max_open
+        self.lock = RLock()
+        self.files = OrderedDict()
+        self.in_use = defaultdict(int)
+        self.npart = {}
+        self.pid = os.getpid()
+
+    def _check_fork(self):
+        # h5py handles must not be shared between processes
+        if self.pid != os.getpid():
+            self.files = OrderedDict()
+            self.in_use = defaultdict(int)
+            self.lock = RLock()
+            self.pid = os.getpid()
+
+    def _trim(self):
+        for filename in list(self.files.keys()):
+            if len(self.files) <= self.max_open:
+                break
+            if self.in_use[filename] == 0:
+                self.files.pop(filename).close()
+
+    @contextmanager
+    def open(self, filename):
+        """
+        Context manager returning an open h5py.File from the pool
+        """
+        self._check_fork()
+        with self.lock:
+            try:
+                f = self.files.pop(filename)
+            except KeyError:
+                f = h5py.File(filename, 'r')
+            self.files[filename] = f  # most recently used files are last
+            self.in_use[filename] += 1
+            self._trim()
+        try:
+            yield f
+        finally:
+            with self.lock:
+                self.in_use[filename] -= 1
+                self._trim()
+
+    def num_part(self, filename):
+        """
+        NumPart_ThisFile of a file. Only read once per file.
+        """
+        self._check_fork()
+        with self.lock:
+            if filename not in self.npart:
+                with self.open(filename) as f:
+                    self.npart[filename] = f['Header'].attrs['NumPart_ThisFile']
+            return self.npart[filename]
+
+    def close(self):
+        """
+        Close every file in the pool. Files are reopened if they are needed again.
+        """
+        self._check_fork()
+        with self.lock:
+            for filename in list(self.files.keys()):
+                if self.in_use[filename] == 0:
+                    self.files.pop(filename).close()
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getstate__(self):
+        # Open files and locks cannot be pickled, the copy starts out empty
+        return {'max_open': self.max_open, 'npart': self.npart}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_open'])
+        self.npart = state['npart']
+
+
+class ReadPool(object):
+    """
+    Worker processes reading the parts of multi-part datablocks at the same time, shared
+    by all the loads of one snapshot. The processes are started when first needed.
+    Daemonic processes (e.g. pool workers) can't have children, so they read serially.
+    """
+    def __init__(self, workers):
+        self.workers = workers
+        self.lock = RLock()
+        self.pool = None
+        self.pid = os.getpid()
+
+    def usable(self):
+        """
+        Can the parts be read in worker processes here?
+        """
+        return (self.workers > 1) and can_fork() and (not in_daemon())
+
+    def _pool(self):
+        from multiprocess import Pool
+
+        with self.lock:
+            if self.pid != os.getpid():  # the processes belong to the parent
+                self.pool = None
+                self.pid = os.getpid()
+            if self.pool is None:
+                self.pool = Pool(self.workers)
+            return self.pool
+
+    def read(self, filenames, counts, group, variable, shape, dtype):
+        """
+        Read all parts of a datablock at the same time, each worker process writing
+        straight into its own slice of a shared buffer.
+        Returns the datablock and the (filename, (bytes, seconds)) of every part read.
+        """
+        from multiprocessing import shared_memory
+
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape))*dtype.itemsize
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        try:
+            tasks = [(shm.name, filename, group, variable, int(offset), int(n), shape, dtype)
+                     for filename, offset, n in zip(filenames, offsets, counts) if n > 0]
+            reports = self._pool().map(_read_part, tasks)
+            shared = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            dataset = shared.copy()
+            del shared
+        finally:
+            shm.close()
+            shm.unlink()
+        return dataset, [(task[1], report) for task, report in zip(tasks, reports)]
+
+    def close(self):
+        """
+        Stop the worker processes. They are started again if they are needed.
+        """
+        with self.lock:
+            if (self.pool is not None) and (self.pid == os.getpid()):
+                self.pool.terminate()
+            self.pool = None
+
+    def __getstate__(self):
+        # processes cannot be pickled, the copy starts its own
+        return {'workers': self.workers}
+
+    def __setstate__(self, state):
+        self.__init__(state['workers'])
+
+
+# lists collecting the LoadStats made in this process, see collect_stats
+_collectors = []
+
+
+@contextmanager
+def collect_stats():
+    """
+    Collect the LoadStats of every snapshot opened in the with block:
+    with collect_stats() as collected: ...
+    merge_stats([load_stats.report() for load_stats in collected])
+    """
+    collected = []
+    _collectors.append(collected)
+    try:
+        yield collected
+    finally:
+        _collectors.remove(collected)
+
+
+class LoadStats(object):
+    """
+    What a snapshot loaded: for every (datablock, particle type) the number of loads,
+    bytes read, wall time and source files. Lazy dictionaries and lazy datasets report to it.
+    """
+    def __init__(self, sources=()):
+        self.sources = [sources] if isinstance(sources, str) else list(sources)
+        self.lock = RLock()
+        self.records = {}
+        for collected in _collectors:
+            collected.append(self)
+
+    def record(self, name, part, nbytes, seconds, sources=None):
+        with self.lock:
+            rec = self.records.setdefault((name, part), {'loads': 0, 'bytes': 0, 'seconds': 0.0,
+                                                         'sources': []})
+            rec['loads'] += 1
+            rec['bytes'] += int(nbytes)
+            rec['seconds'] += seconds
+            for source in (self.sources if sources is None else sources):
+                if source not in rec['sources']:
+                    rec['sources'].append(source)
+
+    def lazy_recorder(self, name):
+        """
+        Recorder for the lazy dictionary of datablock name
+        """
+        def recorder(part, value, seconds):
+            # lazy datasets report their own reads
+            if isinstance(value, LazyDataset):
+                return
+            # memory maps are read when used and constant (header) masses are never read
+            if isinstance(value, np.memmap) or (utils.constant_value(value) is not None):
+                nbytes = 0
             else:
-                dataset = np.append(dataset, f[group][variable][()], axis=0)
+                nbytes = getattr(value, 'nbytes', 0)
+            self.record(name, part, nbytes, seconds)
+        return recorder
+
+    def dataset_recorder(self, name, part):
+        """
+        Recorder for the reads of a lazy dataset
+        """
+        return partial(self.record, name, part)
+
+    def report(self, snap=None):
+        """
+        Dictionary of datablock: particle type: statistics.
+        If snap is given, also whether each datablock is still in memory and how many bytes it holds.
+        """
+        from . import lazydict
+
+        with self.lock:
+            report = defaultdict(dict)
+            for (name, part), rec in self.records.items():
+                rec = dict(rec, sources=list(rec['sources']))
+                if snap is not None:
+                    lazy = getattr(snap, name, {})
+                    if isinstance(lazy, lazydict.LazyDictionary):
+                        nbytes = lazy.resident_bytes(part)
+                    else:
+                        nbytes = lazydict.resident_bytes(lazy.get(part)) if part in lazy else 0
+                    rec['resident'] = nbytes > 0
+                    rec['resident_bytes'] = nbytes
+                report[name][part] = rec
+            return dict(report)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = RLock()
+
+
+def merge_stats(reports):
+    """
+    Add up the stats() reports of several snapshots
+    """
+    total = defaultdict(dict)
+    for report in reports:
+        for name, parts in report.items():
+            for part, rec in parts.items():
+                agg = total[name].setdefault(part, {'loads': 0, 'bytes': 0, 'seconds': 0.0,
+                                                    'sources': [], 'resident_bytes': 0})
+                for key in ['loads', 'bytes', 'seconds', 'resident_bytes']:
+                    agg[key] += rec.get(key, 0)
+                agg['sources'] += [f for f in rec['sources'] if f not in agg['sources']]
+    return dict(total)
+
+
+def _read_part(args):
+    """
+    Read one file of a datablock into its slice of a shared output buffer (runs in a worker process)
+    """
+    from multiprocessing import shared_memory
+
+    name, filename, group, variable, offset, n, shape, dtype = args
+    start = time.time()
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        dataset = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        with h5py.File(filename, 'r') as f:
+            f[group][variable].read_direct(dataset, dest_sel=np.s_[offset:offset+n])
+        nbytes = dataset[offset:offset+n].nbytes
+        del dataset
+    finally:
+        shm.close()
+    return nbytes, time.time()-start
+
+
+def load_dataset(filenames, group, variable, verbose=False, pool=None, workers=1, read_pool=None):
+    """
+    Read a datablock spread over one or more snapshot files.
+    The number of particles in each file is taken from its header (NumPart_ThisFile),
+    so the output is allocated once and every file is read straight into its slice.
+    Args:
+        filenames: A filename or list of filenames (one per part of the snapshot)
+        group: HDF5 group to read from (e.g. 'PartType1')
+        variable: Name of the dataset within the group (e.g. 'Coordinates')
+    kwargs:
+        verbose: Print the number of bytes read and the time taken for each file.
+        pool: FilePool to take open files from. If None the files are opened and closed here.
+        workers: Number of processes reading the parts of a multi-part snapshot at the same time.
+                 Needs the fork start method, otherwise the parts are read one after another.
+        read_pool: ReadPool to read the parts with. If None and workers > 1 one is started here.
+    """
+    if not isinstance(filenames, (list, tuple)):
+        filenames = [filenames]
+
+    if pool is None:
+        pool = FilePool(max_open=len(filenames))
+        try:
+            return load_dataset(filenames, group, variable, verbose=verbose, pool=pool,
+                                workers=workers, read_pool=read_pool)
+        finally:
+            pool.close()
+
+    ptype = int(group.replace('PartType', ''))
+    counts = [int(pool.num_part(filename)[ptype]) for filename in filenames]
+
+    # Take the row shape and type from the first part that has this datablock
+    nonzero = [filename for filename, n in zip(filenames, counts) if n > 0]
+    with pool.open(nonzero[0] if nonzero else filenames[0]) as f:
+        if not nonzero:
+            return f[group][variable][()]
+        dset = f[group][variable]
+        shape = (sum(counts),) + dset.shape[1:]
+        dtype = dset.dtype
+
+    if (read_pool is None) and (workers > 1) and (len(nonzero) > 1):
+        read_pool = ReadPool(workers)
+        try:
+            return load_dataset(filenames, group, variable, verbose=verbose, pool=pool,
+                                read_pool=read_pool)
+        finally:
+            read_pool.close()
+
+    if (read_pool is not None) and (len(nonzero) > 1) and read_pool.usable():
+        dataset, reports = read_pool.read(filenames, counts, group, variable, shape, dtype)
+        if verbose:
+            for filename, (nbytes, seconds) in reports:
+                print("{:s}: read {:d} bytes of {:s}/{:s} in {:.3f} s".format(
+                    filename, nbytes, group, variable, seconds))
+        return dataset
+
+    dataset = np.empty(shape, dtype=dtype)
+    offset = 0
+    for filename, n in zip(filenames, counts):
+        if n == 0:
+            continue
+        start = time.time()
+        with pool.open(filename) as f:
+            f[group][variable].read_direct(dataset, dest_sel=np.s_[offset:offset+n])
+        if verbose:
+            print("{:s}: read {:d} bytes of {:s}/{:s} in {:.3f} s".format(
+                filename, dataset[offset:offset+n].nbytes, group, variable, time.time()-start))
+        offset += n
 
     return dataset
 
 
+def memmap_dataset(filename, dset):
+    """
+    Return a read-only np.memmap of an HDF5 dataset, or None if the dataset cannot be mapped.
+    Only datasets stored contiguously, without filters (e.g. compression) and in native
+    byte order can be mapped.
+    Args:
+        filename: File that holds the dataset
+        dset: The open h5py dataset
+    """
+    if dset.is_virtual or (dset.size == 0):
+        return None
+    plist = dset.id.get_create_plist()
+    if (plist.get_layout() != h5py.h5d.CONTIGUOUS) or (plist.get_nfilters() > 0):
+        return None
+    if (not dset.dtype.isnative) or (plist.get_external_count() > 0):
+        return None
+    offset = dset.id.get_offset()
+    if offset is None:  # space not allocated yet
+        return None
+    return np.memmap(filename, mode='r', dtype=dset.dtype, shape=dset.shape, offset=offset)
+
+
+def can_fork():
+    """
+    Will worker processes be forked (and so share memory allocated before they start)?
+    """
+    import multiprocess
+    return multiprocess.get_start_method() == 'fork'
+
+
+def in_daemon():
+    """
+    Is this a daemonic process (e.g. a pool worker)? They can't start processes of their own.
+    """
+    import multiprocessing
+    import multiprocess
+    return multiprocessing.current_process().daemon or multiprocess.current_process().daemon
+
+
+def find_parts(filename):
+    """
+    Find the parts filename.0.hdf5, filename.1.hdf5, ... of a multi-part snapshot, in numerical order.
+    Raises IOError if a part is missing.
+    """
+    folder, base = os.path.split(filename)
+    pattern = re.compile(re.escape(base) + r'\.([0-9]+)\.hdf5$')
+    parts = {}
+    for f in os.listdir(folder or '.'):
+        m = pattern.match(f)
+        if m is not None:
+            parts[int(m.group(1))] = os.path.join(folder, f)
+    missing = sorted(set(range(max(parts) + 1)) - set(parts)) if parts else [0]
+    if missing:
+        raise IOError("[error] missing parts {:s} of snapshot {:s}".format(str(missing), filename))
+    return [parts[n] for n in range(len(parts))]
+
+
+def manifest_name(filename):
+    """
+    Where the manifest of a multi-part snapshot is kept.
+    Next to the snapshot if possible, otherwise in the temporary directory.
+    """
+    name = filename + '.manifest.h5'
+    folder = os.path.dirname(os.path.realpath(name))
+    if os.path.exists(name) or os.access(folder, os.W_OK):
+        return name
+    return os.path.join(tempfile.gettempdir(),
+                        os.path.realpath(name).strip(os.sep).replace(os.sep, '_'))
+
+
+def build_manifest(filename, fname=None):
+    """
+    Write the manifest of the multi-part snapshot filename.N.hdf5 to fname.
+    The manifest holds the per-file particle numbers (counts) of each type and their global offsets,
+    the header of the first part with NumPart_ThisFile set to the totals, and a virtual dataset
+    for every datablock that spans all the parts. It can be opened like a single-file snapshot.
+    """
+    if fname is None:
+        fname = manifest_name(filename)
+    filenames = [os.path.realpath(f) for f in find_parts(filename)]
+
+    counts = []
+    blocks = {}  # shapes and types of each datablock, taken from the first part that has it
+    sources = defaultdict(list)
+    for f in filenames:
+        with h5py.File(f, 'r') as s:
+            if f == filenames[0]:
+                header = dict(s['Header'].attrs.items())
+            npart = s['Header'].attrs['NumPart_ThisFile'].astype(np.int64)
+            counts.append(npart)
+            for i, n in enumerate(npart):
+                if n == 0:
+                    continue
+                group = 'PartType%d' % i
+                for key, dset in s[group].items():
+                    blocks.setdefault((group, key), (dset.shape[1:], dset.dtype))
+                    sources[(group, key)].append((f, dset.shape))
+
+    counts = np.array(counts)
+    nfiles = header.get('NumFilesPerSnapshot', 0)
+    if (nfiles > 0) and (nfiles != len(filenames)):
+        raise IOError("[error] {:s} should have {:d} parts but {:d} were found".format(
+            filename, nfiles, len(filenames)))
+
+    # written next to fname and moved into place, so readers never see a partial manifest
+    tmpname = fname + '.%d.tmp' % os.getpid()
+    try:
+        _write_manifest(tmpname, filenames, counts, header, blocks, sources)
+        os.replace(tmpname, fname)
+    finally:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+    return fname
+
+
+def _write_manifest(fname, filenames, counts, header, blocks, sources):
+    with h5py.File(fname, 'w') as m:
+        m.attrs['filenames'] = np.array(filenames, dtype=h5py.string_dtype())
+        m.attrs['stats'] = _file_stats(filenames)
+        m.create_dataset('counts', data=counts)
+        m.create_dataset('offsets', data=np.concatenate([np.zeros((1, counts.shape[1]), dtype=np.int64),
+                                                         np.cumsum(counts, axis=0)]))
+        grp = m.create_group('Header')
+        for key, val in header.items():
+            grp.attrs[key] = val
+        grp.attrs['NumPart_ThisFile'] = counts.sum(axis=0).astype(header['NumPart_ThisFile'].dtype)
+        for (group, key), (shape, dtype) in blocks.items():
+            layout = h5py.VirtualLayout(shape=(int(sum(sh[0] for _, sh in sources[(group, key)])),) + shape,
+                                        dtype=dtype)
+            offset = 0
+            for f, sh in sources[(group, key)]:
+                layout[offset:offset+sh[0]] = h5py.VirtualSource(f, group + '/' + key, shape=sh)
+                offset += sh[0]
+            m.require_group(group).create_virtual_dataset(key, layout)
+
+
+def load_manifest(filename):
+    """
+    Manifest of the multi-part snapshot filename.N.hdf5 (see build_manifest).
+    The manifest is built the first time and rebuilt when any of the parts change.
+    Returns:
+        dict with the manifest file ('file'), the parts ('filenames'),
+        particles of each type in each part ('counts') and their global offsets ('offsets')
+    """
+    fname = manifest_name(filename)
+    for attempt in range(2):
+        if os.path.exists(fname):
+            try:
+                with h5py.File(fname, 'r') as m:
+                    filenames = [f.decode() if isinstance(f, bytes) else f for f in m.attrs['filenames']]
+                    if np.array_equal(m.attrs['stats'], _file_stats(filenames)):
+                        return {'file': fname,
+                                'filenames': filenames,
+                                'counts': m['counts'][()],
+                                'offsets': m['offsets'][()]}
+            except (OSError, KeyError):
+                pass
+        build_manifest(filename, fname)
+    raise IOError("[error] could not build a manifest for %s" % filename)
+
+
+def _rows_to_ranges(rows):
+    """
+    Compress a sorted array of rows into the starts and stops of runs of consecutive rows
+    """
+    if len(rows) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+    starts = rows[np.concatenate([[0], breaks])]
+    stops = rows[np.concatenate([breaks - 1, [len(rows) - 1]])] + 1
+    return starts, stops
+
+
+def _ranges_to_rows(starts, stops):
+    """
+    Inverse of _rows_to_ranges
+    """
+    lengths = stops - starts
+    ends = np.cumsum(lengths)
+    return np.arange(ends[-1] if len(ends) else 0, dtype=np.int64) + np.repeat(starts - ends + lengths,
+                                                                               lengths)
+
+
+def _file_stats(filenames):
+    return np.array([[os.path.getsize(f), os.path.getmtime(f)] for f in filenames])
+
+
+def galaxy_rows(filenames, id_file, galaxy, part_names, pool=None):
+    """
+    Find the rows of each particle type that belong to a galaxy in an id file (see Snapshot.make_id_file).
+    The rows are cached as ranges in <id_file>.rows.hdf5 so that they only have to be found once per snapshot
+    (and found again when the snapshot or the id file changes).
+    Args:
+        filenames: Filename or list of filenames of the snapshot
+        id_file: HDF5 file with a group of particle ids for each galaxy
+        galaxy: Name of the galaxy
+        part_names: Names of the particle types (as used in the id file)
+    Returns:
+        A dict of sorted row arrays keyed by particle type number
+    """
+    if id_file is None:
+        raise ValueError("Need an id_file to load galaxy %s" % galaxy)
+    if not isinstance(filenames, (list, tuple)):
+        filenames = [filenames]
+
+    cache_name = os.path.splitext(id_file)[0] + '.rows.hdf5'
+    key = '{:s}/{:s}'.format(os.path.basename(filenames[0]), galaxy)
+    stats = _file_stats(list(filenames) + [id_file])
+
+    # Use the cached rows if neither the snapshot nor the id file has changed since
+    if os.path.exists(cache_name):
+        try:
+            with h5py.File(cache_name, 'r') as f:
+                if (key in f) and np.array_equal(f[key].attrs['stats'], stats):
+                    return {int(name.replace('PartType', '')): _ranges_to_rows(grp['starts'][()],
+                                                                              grp['stops'][()])
+                            for name, grp in f[key].items()}
+        except (OSError, KeyError):
+            pass
+
+    if pool is None:
+        pool = FilePool()
+    rows = {}
+    with h5py.File(id_file, 'r') as f:
+        if galaxy not in f:
+            raise KeyError("Galaxy %s is not in %s" % (galaxy, id_file))
+        for i, part in enumerate(part_names):
+            if part not in f[galaxy]:
+                continue
+            ids = LazyDataset(filenames, 'PartType%d' % i, 'ParticleIDs', pool=pool).materialize()
+            members = np.isin(ids, f[galaxy][part][()].astype(ids.dtype))
+            rows[i] = np.flatnonzero(members)
+
+    try:
+        with h5py.File(cache_name, 'a') as f:
+            if key in f:
+                del f[key]
+            grp = f.create_group(key)
+            grp.attrs['stats'] = stats
+            for i, r in rows.items():
+                starts, stops = _rows_to_ranges(r)
+                grp.create_dataset('PartType%d/starts' % i, data=starts)
+                grp.create_dataset('PartType%d/stops' % i, data=stops)
+    except OSError:
+        warnings.warn("Could not write the galaxy row cache %s" % cache_name, RuntimeWarning)
+
+    return rows
+
+
+def restrict_header(header, rows):
+    """
+    Set the particle numbers in header to those of a subset of rows (dict keyed by particle type number)
+    """
+    npart = np.zeros_like(header['npart'])
+    for i, r in rows.items():
+        npart[i] = len(r)
+    header['npart'] = npart
+    header['nall'] = npart.astype(header['nall'].dtype)
+    if 'nall_highword' in header:
+        header['nall_highword'] = np.zeros_like(header['nall_highword'])
+
+
+class LazyDataset(NDArrayOperatorsMixin):
+    """
+    Array-like proxy for a datablock that is still on disk.
+    Indexing with slices (including strided ones) or index arrays reads only the
+    selected particles, using HDF5 hyperslab or point selections.
+    The whole array is only read (and then kept) when all of it is needed,
+    e.g. for arithmetic, numpy functions or indexing with [:].
+    If rows (a sorted array of row numbers in the files) is given then the
+    datablock only holds those particles.
+    With mmap=True a single-file datablock that can be memory mapped (see memmap_dataset)
+    is returned as a read-only np.memmap instead of being read into memory.
+    A listener set with watch() is told when the whole array is read ('loaded') and
+    when it is changed through the proxy ('written'), e.g. pos[:, 0] -= 1 or pos += 1.
+    Indexing returns copies and numpy functions get a read-only view, so changes always
+    go through the proxy. materialize() hands out the array itself ('pinned').
+    """
+    # Read the bounding range of an index array when it is at least this dense
+    DENSE_FRACTION = 0.125
+    # Read each run of consecutive indices separately when there are at most this many runs
+    MAX_RUNS = 64
+
+    def __init__(self, filenames, group, variable, verbose=False, pool=None, rows=None, workers=1,
+                 mmap=False, stats=None, read_pool=None):
+        if not isinstance(filenames, (list, tuple)):
+            filenames = [filenames]
+        if pool is None:
+            pool = FilePool()
+        self.filenames = filenames
+        self.group = group
+        self.variable = variable
+        self.verbose = verbose
+        self.pool = pool
+        self.rows = rows
+        self.workers = workers
+        self.read_pool = read_pool  # shared by the datablocks of a snapshot, see ReadPool
+        self.mmap = mmap
+        self.stats = stats  # called with the bytes, seconds and files of every read
+        self.listener = None  # see watch
+        self.lock = RLock()
+        self._array = None
+
+        ptype = int(group.replace('PartType', ''))
+        self.counts = np.array([pool.num_part(filename)[ptype] for filename in filenames],
+                               dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(self.counts)])
+        nonzero = [filename for filename, n in zip(filenames, self.counts) if n > 0]
+        with pool.open(nonzero[0] if nonzero else filenames[0]) as f:
+            dset = f[group][variable]
+            nrows = int(self.offsets[-1]) if rows is None else len(rows)
+            self.shape = (nrows,) + dset.shape[1:]
+            self.dtype = dset.dtype
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size*self.dtype.itemsize
+
+    @property
+    def loaded(self):
+        """
+        Has the whole array been read?
+        """
+        return self._array is not None
+
+    @property
+    def resident_bytes(self):
+        """
+        Memory held by the proxy (memory maps hold none)
+        """
+        if (self._array is None) or isinstance(self._array, np.memmap):
+            return 0
+        return self._array.nbytes
+
+    def __len__(self):
+        return self.shape[0]
+
+    def watch(self, listener):
+        """
+        Call listener('loaded') once the whole array has been read and
+        listener('written') when the array is changed through the proxy
+        """
+        self.listener = listener
+
+    def _notify(self, event):
+        if self.listener is not None:
+            self.listener(event)
+
+    def materialize(self):
+        """
+        Read the whole datablock (once) and return it.
+        Changes to the returned array can't be seen, so it is kept in memory from now on.
+        """
+        array = self._load()
+        self._notify('pinned')
+        return array
+
+    def load(self):
+        """
+        Read the whole datablock (once)
+        """
+        self._load()
+
+    def _readonly(self):
+        """
+        Read-only view of the whole datablock
+        """
+        view = self._load().view()
+        view.flags.writeable = False
+        return view
+
+    def _detached(self, out):
+        """
+        A copy of out if it is a view of the (writable) loaded array
+        """
+        if (isinstance(out, np.ndarray) and self._array.flags.writeable and
+                np.may_share_memory(out, self._array)):
+            return out.copy()
+        return out
+
+    def _load(self):
+        with self.lock:
+            start = time.time()
+            loaded = self._array is not None
+            self._try_memmap()
+            if self._array is None:
+                if self.rows is None:
+                    self._array = load_dataset(self.filenames, self.group, self.variable,
+                                               verbose=self.verbose, pool=self.pool,
+                                               workers=self.workers, read_pool=self.read_pool)
+                else:
+                    self._array = self._read_sorted(self.rows)
+                self._record(self._array.nbytes, start)
+            array = self._array
+        if not loaded:
+            self._notify('loaded')
+        return array
+
+    def _record(self, nbytes, start):
+        if self.stats is not None:
+            self.stats(nbytes, time.time() - start,
+                       [filename for filename, n in zip(self.filenames, self.counts) if n > 0])
+
+    def _try_memmap(self):
+        """
+        Memory map the datablock if it was asked for and it is in a single file that can be mapped
+        """
+        with self.lock:
+            if (self._array is not None) or (not self.mmap) or (self.rows is not None):
+                return
+            nonzero = [filename for filename, n in zip(self.filenames, self.counts) if n > 0]
+            if len(nonzero) == 1:
+                with self.pool.open(nonzero[0]) as f:
+                    self._array = memmap_dataset(nonzero[0], f[self.group][self.variable])
+            # only try once
+            self.mmap = self._array is not None
+
+    def __getitem__(self, key):
+        self._try_memmap()
+        return self._getitem(key)
+
+    def __array__(self, dtype=None, copy=None):
+        array = self._readonly()
+        if dtype is not None:
+            return array.astype(dtype)
+        return array
+
+    def _read(self, filename, source_sel, out, dest_sel):
+        start = time.time()
+        with self.pool.open(filename) as f:
+            f[self.group][self.variable].read_direct(out, source_sel=source_sel,
+                                                     dest_sel=dest_sel)
+        if self.verbose:
+            print("{:s}: read {:d} bytes of {:s}/{:s} in {:.3f} s".format(
+                filename, out[dest_sel].nbytes, self.group, self.variable, time.time()-start))
+
+    def _read_slice(self, start, stop, step):
+        """
+        Read rows start:stop:step (step > 0) as one hyperslab per file
+        """
+        nrows = len(range(start, stop, step))
+        out = np.empty((nrows,) + self.shape[1:], dtype=self.dtype)
+        for filename, first, last in zip(self.filenames, self.offsets[:-1], self.offsets[1:]):
+            # first selected row within this file
+            lo = max(start, first)
+            lo += (start - lo) % step
+            hi = min(stop, last)
+            if lo >= hi:
+                continue
+            n = len(range(lo, hi, step))
+            dest = (lo - start)//step
+            self._read(filename, np.s_[lo-first:hi-first:step], out, np.s_[dest:dest+n])
+        return out
+
+    def _read_sorted(self, index):
+        """
+        Read rows given by a sorted array of unique indices
+        """
+        out = np.empty((len(index),) + self.shape[1:], dtype=self.dtype)
+        bounds = np.searchsorted(index, self.offsets)
+        for filename, first, lo, hi in zip(self.filenames, self.offsets[:-1],
+                                           bounds[:-1], bounds[1:]):
+            if lo == hi:
+                continue
+            local = index[lo:hi] - first
+            span = local[-1] - local[0] + 1
+            breaks = np.flatnonzero(np.diff(local) != 1) + 1
+            if len(breaks) < self.MAX_RUNS:
+                # a few runs of consecutive particles, read each as a hyperslab
+                run_starts = np.concatenate([[0], breaks])
+                run_ends = np.concatenate([breaks, [len(local)]])
+                for a, b in zip(run_starts, run_ends):
+                    self._read(filename, np.s_[local[a]:local[a]+(b-a)],
+                               out, np.s_[lo+a:lo+b])
+            elif len(local) >= self.DENSE_FRACTION*span:
+                # dense enough that reading the bounding range is cheaper
+                block = np.empty((span,) + self.shape[1:], dtype=self.dtype)
+                self._read(filename, np.s_[local[0]:local[-1]+1], block, np.s_[:])
+                out[lo:hi] = block[local - local[0]]
+            else:
+                with self.pool.open(filename) as f:
+                    out[lo:hi] = f[self.group][self.variable][local]
+        return out
+
+    def _on_disk(self, index):
+        """
+        Rows in the files for rows of this datablock
+        """
+        if self.rows is None:
+            return index
+        return self.rows[index]
+
+    def _read_rows(self, rows):
+        """
+        Read the rows selected by an integer, slice or index array.
+        Returns None if the selection needs the whole array.
+        """
+        n = self.shape[0]
+        if isinstance(rows, slice) and (self.rows is None):
+            start, stop, step = rows.indices(n)
+            if step < 0:
+                # read the same rows forwards and flip them
+                positions = range(start, stop, step)
+                if len(positions) == 0:
+                    return self._read_slice(0, 0, 1)
+                return self._read_slice(positions[-1], positions[0]+1, -step)[::-1]
+            if (start == 0) and (stop == n) and (step == 1):
+                return None
+            return self._read_slice(start, stop, step)
+        if isinstance(rows, (int, np.integer)):
+            if not -n <= rows < n:
+                raise IndexError("index {:d} is out of bounds for axis 0 with size {:d}".format(rows, n))
+            rows = self._on_disk(rows % n)
+            return self._read_slice(rows, rows+1, 1)[0]
+        if isinstance(rows, slice):
+            index = np.arange(n)[rows]
+        else:
+            index = np.asarray(rows)
+        if index.dtype == bool:
+            if index.shape[0] != n:
+                raise IndexError("boolean index did not match indexed array along dimension 0")
+            index = np.flatnonzero(index)
+        if (index.dtype.kind not in 'iu') or (index.ndim != 1):
+            return None
+        if len(index) > 0 and (index.min() < -n or index.max() >= n):
+            raise IndexError("index is out of bounds for axis 0 with size {:d}".format(n))
+        index = index % n
+        if (len(index) > 1) and np.any(np.diff(index) <= 0):
+            # unsorted or repeated indices, read the unique ones and reorder
+            unique, inverse = np.unique(index, return_inverse=True)
+            if len(unique) == n:
+                return None
+            return self._read_sorted(self._on_disk(unique))[inverse]
+        if len(index) == n:
+            return None
+        return self._read_sorted(self._on_disk(index))
+
+    def _getitem(self, key):
+        if self._array is not None:
+            return self._detached(self._array[key])
+        if isinstance(key, tuple):
+            if (len(key) == 0) or (key[0] is Ellipsis) or (key[0] is None):
+                return self._detached(self._load()[key])
+            rows, rest = key[0], key[1:]
+        else:
+            rows, rest = key, ()
+        start = time.time()
+        out = self._read_rows(rows)
+        if out is None:
+            return self._detached(self._load()[key])
+        self._record(out.nbytes, start)
+        if rest:
+            if isinstance(rows, (int, np.integer)):
+                return out[rest]
+            return out[(slice(None),) + rest]
+        return out
+
+    def __setitem__(self, key, value):
+        self._load()[key] = value
+        self._notify('written')
+
+    def __iter__(self):
+        return iter(self._readonly())
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        inputs = tuple(x._load() if isinstance(x, LazyDataset) else x for x in inputs)
+        out = kwargs.get('out', ())
+        if out:
+            kwargs['out'] = tuple(x._load() if isinstance(x, LazyDataset) else x
+                                  for x in out)
+        result = getattr(ufunc, method)(*inputs, **kwargs)
+        # in-place operations (e.g. pos += 1) act on the loaded array and return the proxy
+        if out and any(x is self for x in out):
+            self._notify('written')
+            return self
+        return result
+
+    def __getattr__(self, name):
+        # anything else (mean, T, copy...) is taken from the loaded array
+        if name.startswith('_') or name in ('lock', 'pool', 'read_pool', 'listener'):
+            raise AttributeError(name)
+        if name in ('fill', 'sort', 'put', 'partition', 'itemset', 'setfield'):
+            # methods that change the array in place
+            self._notify('written')
+            return getattr(self._load(), name)
+        return getattr(self._readonly(), name)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        state['listener'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = RLock()
+
+    def __repr__(self):
+        if self._array is not None:
+            return repr(self._array)
+        return "LazyDataset({:s}/{:s}, shape={:s}, dtype={:s})".format(
+            self.group, self.variable, str(self.shape), str(self.dtype))
+
+
+class ConstantDataset(NDArrayOperatorsMixin):
+    """
+    Array-like proxy for the masses of a particle type that has its mass in the header.
+    Until it is changed it is one number broadcast to every particle (see utils.constant_array)
+    and slices of it are too. The first in-place change (masses[...] = x, masses *= 2...)
+    turns it into an ordinary writable array.
+    """
+    def __init__(self, value, n):
+        self.lock = RLock()
+        self.listener = None  # see LazyDataset.watch
+        self._array = utils.constant_array(value, n)
+
+    @property
+    def constant(self):
+        """
+        The mass of every particle, None once the array has been changed
+        """
+        return utils.constant_value(self._array)
+
+    @property
+    def resident_bytes(self):
+        if self.constant is not None:
+            return self._array.itemsize
+        return self._array.nbytes
+
+    @property
+    def shape(self):
+        return self._array.shape
+
+    @property
+    def dtype(self):
+        return self._array.dtype
+
+    @property
+    def ndim(self):
+        return self._array.ndim
+
+    @property
+    def size(self):
+        return self._array.size
+
+    @property
+    def nbytes(self):
+        return self._array.nbytes
+
+    def __len__(self):
+        return len(self._array)
+
+    def watch(self, listener):
+        self.listener = listener
+
+    def materialize(self):
+        """
+        The array, made writable if it is still constant.
+        Changes to it can't be seen, so it is kept in memory from now on.
+        """
+        with self.lock:
+            if not self._array.flags.writeable:
+                self._array = np.array(self._array)
+        if self.listener is not None:
+            self.listener('pinned')
+        return self._array
+
+    def _written(self):
+        if self.listener is not None:
+            self.listener('written')
+
+    def __getitem__(self, key):
+        return self._array[key]
+
+    def __setitem__(self, key, value):
+        self.materialize()[key] = value
+        self._written()
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is not None:
+            return self._array.astype(dtype)
+        return self._array
+
+    def __iter__(self):
+        return iter(self._array)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        out = kwargs.get('out', ())
+        inplace = any(x is self for x in out)
+        if inplace:
+            self.materialize()
+        inputs = tuple(x._array if isinstance(x, ConstantDataset) else x for x in inputs)
+        if out:
+            kwargs['out'] = tuple(x._array if isinstance(x, ConstantDataset) else x for x in out)
+        result = getattr(ufunc, method)(*inputs, **kwargs)
+        if inplace:
+            self._written()
+            return self
+        return result
+
+    def __getattr__(self, name):
+        # anything else (mean, strides, copy...) is taken from the array
+        if name.startswith('_') or name in ('lock', 'listener'):
+            raise AttributeError(name)
+        if name in ('fill', 'sort', 'put', 'partition', 'itemset', 'setfield'):
+            array = getattr(self.materialize(), name)
+            self._written()
+            return array
+        return getattr(self._array, name)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        state['listener'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = RLock()
+
+    def __repr__(self):
+        return repr(self._array)
+
+
 class SnapLazy(Snapshot):
     """
     lazydict implementation of HDF5 snapshot
@@ -95,7 +1204,8 @@ class SnapLazy(Snapshot):
     def __init__(self, fname, **kwargs):
         pass
 
-    def init(self, fname, part_names=None, **kwargs):
+    def init(self, fname, part_names=None, fields=None, parttypes=None, galaxy=None, id_file=None,
+             verbose=False, max_open_files=16, workers=1, manifest=None, mmap=False, **kwargs):
         from functools import partial
         from . import lazydict
 
@@ -116,47 +1226,605 @@ class SnapLazy(Snapshot):
             fname = [fname]
 
         self.filename = fname
+        self.fields = fields
+        self.parttypes = parttypes
+        self.galaxy_name = galaxy
+        # open files and reader processes are shared by all the loaders of this snapshot
+        self.file_pool = FilePool(max_open=max_open_files)
+        self.read_pool = ReadPool(workers) if workers > 1 else None
+        self.load_stats = LoadStats(fname)
+        # multi-part snapshots take their header and particle numbers from the manifest
+        header_file = fname[0]
+        if manifest is not None:
+            header_file = manifest['file']
+            for filename, npart in zip(fname, manifest['counts']):
+                self.file_pool.npart[filename] = npart
+
+        # only the particles of one galaxy
+        rows = None
+        if galaxy is not None:
+            rows = galaxy_rows(fname, id_file, galaxy, part_names, pool=self.file_pool)
 
         #load header only
-        with h5py.File(fname[0], 'r') as s:
-            self.header = {}
-            #header_keys = s['Header'].attrs.keys()
-            for head_key, head_val in s['Header'].attrs.items():
-                if head_key in HEAD_ATTRS.keys():
-                    self.header[HEAD_ATTRS[head_key]] = head_val
-                else:
-                    self.header[head_key] = head_val
+        with self.file_pool.open(header_file) as s:
+            self.header = hdf5_header(s)
+            if rows is not None:
+                restrict_header(self.header, rows)
             #only taking first elements coresponding to gadget NTYPES
             part_names = part_names[:len(self.header['nall'])]
             self.part_names = part_names
             # setup loaders for each particle type
             for i, part in enumerate(part_names):
                 if self.header['nall'][i] > 0:
+                    part_rows = None if rows is None else rows[i]
                     for key in s['PartType%d' % i].keys():
+                        # only register the datablocks in the projection
+                        if not wanted(key, part, fields, parttypes):
+                            continue
                         try:
                             attr_name = DATABLOCKS[key]
                         except KeyError:
                             attr_name = key
                         if attr_name not in self.__dict__.keys():
-                            self.__dict__[attr_name] = lazydict.MutableLazyDictionary()
-                        self.__dict__[attr_name][part] = partial(load_dataset, self.filename,
-                                                                 "PartType%d" % i, key)
-
-            if any(self.header['massarr']):
-                wmass, = np.where(self.header['massarr'])
-                for i in wmass:
-                    part = self.part_names[i]
-                    npart = self.header['npart'][i]#!changed from nall
-                    mass = self.header['massarr'][i]
-                    if 'masses' not in self.__dict__.keys():
-                        self.__dict__['masses'] = lazydict.MutableLazyDictionary()
-
-                    # here we are keeping things lazy by defining a function
-                    # that will make our array only when needed
-                    # the inner lambda function takes two arguments - a number of particles (n) and a mass (m)
-                    # the outer function (partial) freezes the arguments for the current particle type
-                    # the outer function is necessary or else arguments will be overwritten by other types
-                    self.masses[part] = partial(lambda n, m: np.ones(n)*m, npart, mass)
+                            self.__dict__[attr_name] = self._lazy_dict(attr_name)
+                        stats = self.load_stats.dataset_recorder(attr_name, part)
+                        self.__dict__[attr_name][part] = partial(LazyDataset, self.filename,
+                                                                 "PartType%d" % i, key,
+                                                                 verbose=verbose,
+                                                                 pool=self.file_pool,
+                                                                 rows=part_rows,
+                                                                 workers=workers,
+                                                                 mmap=mmap,
+                                                                 stats=stats,
+                                                                 read_pool=self.read_pool)
+
+        self._add_constant_masses(fields, parttypes)
+
+    def _lazy_dict(self, name):
+        """
+        New lazy dictionary for datablock name that reports its loads to self.load_stats
+        """
+        from . import lazydict
+
+        lazy = lazydict.MutableLazyDictionary()
+        lazy.recorder = self.load_stats.lazy_recorder(name)
+        return lazy
+
+    def _add_constant_masses(self, fields=None, parttypes=None):
+        """
+        Add lazy mass arrays for the particle types that have their mass in the header
+        """
+        from functools import partial
+        from . import lazydict
+
+        if any(self.header['massarr']):
+            wmass, = np.where(self.header['massarr'])
+            for i in wmass:
+                part = self.part_names[i]
+                if not wanted('Masses', part, fields, parttypes):
+                    continue
+                npart = self.header['npart'][i]#!changed from nall
+                mass = self.header['massarr'][i]
+                if 'masses' not in self.__dict__.keys():
+                    self.__dict__['masses'] = self._lazy_dict('masses')
+
+                # here we are keeping things lazy by defining a function
+                # that will make our array only when needed
+                # the function (partial) freezes the arguments for the current particle type
+                # the array is one number broadcast to every particle until it is changed
+                self.masses[part] = partial(ConstantDataset, mass, npart)
+
+
+def _encode_chunk(val, start, chunks, dtype, shuffle, level):
+    """
+    Compress the chunk of val starting at row start the way the HDF5 shuffle and deflate filters would
+    """
+    block = np.zeros(chunks, dtype=dtype)
+    rows = val[start:start+chunks[0]]
+    block[:len(rows)] = rows  # edge chunks are padded to the full chunk size
+    data = block.view(np.uint8).reshape(-1, dtype.itemsize)
+    if shuffle:
+        data = np.ascontiguousarray(data.T)
+    return zlib.compress(data, level)
+
+
+class DatablockWriter(object):
+    """
+    Write datablocks to HDF5 groups, optionally chunked, compressed and downcast to float32.
+    Each datablock is written from its source array once, type conversion is done by HDF5.
+    With workers > 1 and gzip compression the chunks of all datablocks are compressed
+    (and shuffled) by a pool of threads, since h5py runs its filters one at a time,
+    and the compressed chunks are then written directly.
+    Call close() after the last write.
+    """
+    def __init__(self, chunks=None, compression=None, compression_opts=None, shuffle=False,
+                 single_precision=False, workers=1):
+        """
+        kwargs:
+            chunks: Rows per chunk, a chunk shape or True for about 1 MB chunks.
+                    Default is contiguous datasets unless compression is used.
+            compression: 'gzip', 'lzf' or None
+            compression_opts: gzip level (default 4)
+            shuffle: Use the HDF5 shuffle filter (improves compression of floats)
+            single_precision: Store float64 datablocks as float32
+            workers: Threads compressing gzip chunks
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.chunks = chunks
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.shuffle = shuffle
+        self.single_precision = single_precision
+        self.workers = workers
+        self.pending = deque()
+        self.executor = None
+        if (workers > 1) and (compression == 'gzip'):
+            self.executor = ThreadPoolExecutor(workers)
+
+    def _chunks(self, shape, itemsize):
+        if (self.chunks is None) and (self.compression is None) and (not self.shuffle):
+            return None
+        if isinstance(self.chunks, tuple):
+            return self.chunks
+        if isinstance(self.chunks, (int, np.integer)) and not isinstance(self.chunks, bool):
+            rows = self.chunks
+        else:
+            rows = 2**20 // (itemsize*int(np.prod(shape[1:])))
+        return (int(max(1, min(rows, shape[0]))),) + tuple(shape[1:])
+
+    def write(self, group, name, val):
+        """
+        Write the array val as dataset name in group
+        """
+        val = np.asarray(val)
+        dtype = val.dtype
+        if self.single_precision and (dtype == np.float64):
+            dtype = np.dtype(np.float32)
+
+        chunks = self._chunks(val.shape, dtype.itemsize) if val.size > 0 else None
+        if chunks is None:
+            dset = group.create_dataset(name, val.shape, dtype=dtype)
+        else:
+            dset = group.create_dataset(name, val.shape, dtype=dtype, chunks=chunks,
+                                        compression=self.compression,
+                                        compression_opts=self.compression_opts,
+                                        shuffle=self.shuffle)
+        if val.size == 0:
+            return dset
+
+        if (self.executor is None) or (chunks[1:] != val.shape[1:]):
+            dset.write_direct(np.ascontiguousarray(val))
+            return dset
+
+        level = 4 if self.compression_opts is None else self.compression_opts
+        for start in range(0, val.shape[0], chunks[0]):
+            future = self.executor.submit(_encode_chunk, val, start, chunks, dtype,
+                                          self.shuffle, level)
+            self.pending.append((dset, start, future))
+            # bound the number of compressed chunks waiting in memory
+            if len(self.pending) >= 4*self.workers:
+                self._drain(2*self.workers)
+        return dset
+
+    def _drain(self, keep=0):
+        while len(self.pending) > keep:
+            dset, start, future = self.pending.popleft()
+            dset.id.write_direct_chunk((start,) + (0,)*(dset.ndim - 1), future.result())
+
+    def close(self):
+        """
+        Write any chunks that are still being compressed
+        """
+        self._drain()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+# Gadget binary block labels: HDF5 name, components and the particle types that have the block
+# 'all' is every type, 'mass' the types without a mass in the header and 'gas' type 0
+BINARY_BLOCKS = {"POS": ("Coordinates", 3, 'all'),
+                 "VEL": ("Velocities", 3, 'all'),
+                 "ID": ("ParticleIDs", 1, 'all'),
+                 "MASS": ("Masses", 1, 'mass'),
+                 "U": ("InternalEnergy", 1, 'gas'),
+                 "RHO": ("Density", 1, 'gas'),
+                 "HSML": ("SmoothingLength", 1, 'gas'),
+                 "NE": ("ElectronAbundance", 1, 'gas'),
+                 "NH": ("NeutralHydrogenAbundance", 1, 'gas'),
+                 "SFR": ("StarFormationRate", 1, 'gas'),
+                 "AGE": ("StellarFormationTime", 1, [4]),
+                 "Z": ("Metallicity", 1, [0, 4]),
+                 "POT": ("Potential", 1, 'all'),
+                 "ACCE": ("Acceleration", 3, 'all'),
+                 "ENDT": ("RateOfChangeOfEntropy", 1, 'gas'),
+                 "TSTP": ("TimeStep", 1, 'all')}
+
+# blocks of a format 1 file (which has no labels) in the order Gadget-2 writes them
+BINARY_ORDER = ["HEAD", "POS", "VEL", "ID", "MASS", "U", "RHO", "HSML"]
+
+
+def gadget_binary_format(filename):
+    """
+    Return the format (1 or 2) and byte order of a Gadget binary snapshot,
+    or None if filename is not one.
+    """
+    with open(filename, 'rb') as f:
+        head = f.read(4)
+    if len(head) < 4:
+        return None
+    for order in '<>':
+        size = np.frombuffer(head, dtype=order + 'i4')[0]
+        if size == 256:
+            return 1, order
+        if size == 8:
+            return 2, order
+    return None
+
+
+def _binary_records(filename, order):
+    """
+    Offset and size of the data of each Fortran record in a Gadget binary file
+    """
+    filesize = os.path.getsize(filename)
+    records = []
+    with open(filename, 'rb') as f:
+        start = 0
+        while start + 4 <= filesize:
+            f.seek(start)
+            size = int(np.frombuffer(f.read(4), dtype=order + 'i4')[0])
+            f.seek(start + 4 + size)
+            end = f.read(4)
+            if (size < 0) or (len(end) < 4) or (np.frombuffer(end, dtype=order + 'i4')[0] != size):
+                raise IOError("Corrupt record at byte {:d} of {:s}".format(start, filename))
+            records.append((start + 4, size))
+            start += size + 8
+    return records
+
+
+def _binary_header(buf, order):
+    """
+    Parse the 256 byte header of a Gadget binary snapshot
+    """
+    dt = np.dtype([('npart', order + 'i4', 6),
+                   ('massarr', order + 'f8', 6),
+                   ('time', order + 'f8'),
+                   ('redshift', order + 'f8'),
+                   ('sfr', order + 'i4'),
+                   ('feedback', order + 'i4'),
+                   ('nall', order + 'u4', 6),
+                   ('cooling', order + 'i4'),
+                   ('filenum', order + 'i4'),
+                   ('boxsize', order + 'f8'),
+                   ('omega0', order + 'f8'),
+                   ('omega_l', order + 'f8'),
+                   ('hubble', order + 'f8'),
+                   ('stellar_age', order + 'i4'),
+                   ('metals', order + 'i4'),
+                   ('nall_highword', order + 'u4', 6),
+                   ('Flag_Entropy_ICs', order + 'i4'),
+                   ('double', order + 'i4')])
+    head = np.frombuffer(buf[:dt.itemsize], dtype=dt)[0]
+    header = {}
+    for name in dt.names:
+        val = head[name]
+        header[name] = val.astype(val.dtype.newbyteorder('=')) if val.ndim else val.item()
+    return header
+
+
+def read_binary_header(filename):
+    """
+    Read only the header of a Gadget binary snapshot
+    """
+    fmt, order = gadget_binary_format(filename)
+    with open(filename, 'rb') as f:
+        # format 2 files start with a 16 byte HEAD label record
+        f.seek(4 if fmt == 1 else 20)
+        return _binary_header(f.read(256), order)
+
+
+def binary_parts(filename):
+    """
+    Files of a Gadget binary snapshot: [filename] or, if its header says the snapshot
+    is split over several files, all of its parts (base.0, base.1, ...).
+    Accepts the name of the first part or of the snapshot without the .0
+    """
+    if not os.path.exists(filename) and os.path.exists(filename + '.0'):
+        filename = filename + '.0'
+    nfiles = read_binary_header(filename)['filenum']
+    if nfiles <= 1:
+        return [filename]
+    if not filename.endswith('.0'):
+        raise IOError("{:s} is one of {:d} parts of a snapshot, open it by its base name or "
+                      "the name of part 0".format(filename, nfiles))
+    parts = ['{:s}.{:d}'.format(filename[:-2], i) for i in range(nfiles)]
+    missing = [part for part in parts if not os.path.exists(part)]
+    if missing:
+        raise IOError("Missing parts of Gadget binary snapshot: {:s}".format(', '.join(missing)))
+    return parts
+
+
+def gadget_binary_layout(filename):
+    """
+    Parse the header and block layout of a Gadget binary snapshot (format 1 or 2).
+    Returns the header (with the names of HEAD_ATTRS) and a list of
+    (HDF5 name, particle type, offset, dtype, shape) for every block of every particle type.
+    Format 1 files have no block labels, so only the blocks in BINARY_ORDER are found.
+    """
+    fmt = gadget_binary_format(filename)
+    if fmt is None:
+        raise IOError("{:s} is not a Gadget binary snapshot".format(filename))
+    fmt, order = fmt
+    records = _binary_records(filename, order)
+
+    with open(filename, 'rb') as f:
+        def read(offset, size):
+            f.seek(offset)
+            return f.read(size)
+
+        if fmt == 2:
+            labels = [read(offset, 4).decode('ascii', 'replace').strip()
+                      for offset, size in records[0::2]]
+            records = records[1::2]
+        else:
+            labels = BINARY_ORDER
+        header = _binary_header(read(records[0][0], 256), order)
+
+    npart = header['npart']
+    types = {'all': list(range(6)),
+             'gas': [0],
+             'mass': [i for i in range(6) if (header['massarr'][i] == 0) and (npart[i] > 0)]}
+    if fmt == 1:
+        # the MASS block is only written if some particles have their own masses
+        # and the gas blocks only if there is gas
+        labels = [l for l in labels if ((l != 'MASS') or types['mass']) and
+                  ((BINARY_BLOCKS.get(l, (None, None, None))[2] != 'gas') or (npart[0] > 0))]
+
+    blocks = []
+    for label, (offset, size) in zip(labels[1:], records[1:]):
+        name, ncomp, ptypes = BINARY_BLOCKS.get(label, (label, 1, 'all'))
+        ptypes = types.get(ptypes, ptypes) if isinstance(ptypes, str) else ptypes
+        count = sum(npart[i] for i in ptypes)
+        if (count == 0) or (size % (count*ncomp) != 0):
+            warnings.warn("Skipping block {:s} of {:s} with unexpected size".format(label, filename))
+            continue
+        itemsize = size // (count*ncomp)
+        kind = 'u' if label == 'ID' else 'f'
+        dtype = np.dtype(order + kind + str(itemsize))
+        for i in ptypes:
+            if npart[i] > 0:
+                shape = (int(npart[i]), ncomp) if ncomp > 1 else (int(npart[i]),)
+                blocks.append((name, i, offset, dtype, shape))
+                offset += int(npart[i])*ncomp*itemsize
+    return header, blocks
+
+
+class SnapGadgetBinary(SnapLazy):
+    """
+    Gadget-2 binary snapshot (format 1 or 2), in one file or in several parts (snap.0, snap.1...).
+    Blocks are copy-on-write memory maps of the file, created when first used: they can be
+    changed in place without changing the file. Blocks of snapshots in several parts are
+    read into memory (joined) when first used.
+    """
+    def __init__(self, fname, **kwargs):
+        pass
+
+    def init(self, fname, part_names=None, fields=None, parttypes=None, **kwargs):
+        from functools import partial
+        from . import lazydict
+
+        if part_names is None:
+            part_names = ['gas',
+                          'halo',
+                          'stars',
+                          'bulge',
+                          'sfr',
+                          'other']
+
+        self.settings = utils.make_settings(**kwargs)
+        self.bin_dict = None
+        self.fields = fields
+        self.parttypes = parttypes
+        self.galaxy_name = None
+
+        filenames = fname if isinstance(fname, list) else binary_parts(fname)
+        self.filename = filenames if len(filenames) > 1 else filenames[0]
+        self.load_stats = LoadStats(filenames)
+
+        # the blocks of every particle type in every file, in file order
+        maps = defaultdict(list)
+        npart = None
+        for filename in filenames:
+            header, blocks = gadget_binary_layout(filename)
+            if npart is None:
+                self.header = header
+                npart = np.zeros_like(header['npart'])
+            npart += header['npart']
+            for name, i, offset, dtype, shape in blocks:
+                maps[(name, i)].append(partial(np.memmap, filename, dtype=dtype, mode='c',
+                                               offset=offset, shape=shape))
+        # the particle numbers of the whole snapshot
+        self.header['npart'] = npart
+
+        self.part_names = part_names[:len(self.header['nall'])]
+        for (name, i), parts in maps.items():
+            part = self.part_names[i]
+            if not wanted(name, part, fields, parttypes):
+                continue
+            attr_name = DATABLOCKS.get(name, name)
+            if attr_name not in self.__dict__.keys():
+                self.__dict__[attr_name] = self._lazy_dict(attr_name)
+            if len(parts) == 1:
+                self.__dict__[attr_name][part] = parts[0]
+            else:
+                self.__dict__[attr_name][part] = partial(_join_parts, parts)
+
+        self._add_constant_masses(fields, parttypes)
+
+
+def _join_parts(parts):
+    """
+    One array from the memory maps of a block in each file of a multi-part snapshot
+    """
+    return np.concatenate([part() for part in parts])
+
+
+def cache_name(filename):
+    """
+    Directory of the .npy cache of a snapshot, e.g. snap_000.hdf5 -> snap_000.snapcache
+    """
+    if filename.endswith('.hdf5'):
+        filename = filename[:-len('.hdf5')]
+    return filename + '.snapcache'
+
+
+def _header_to_json(header):
+    head = {}
+    for key, val in header.items():
+        val = np.asarray(val)
+        if val.dtype.kind == 'S':
+            val = val.astype(str)
+        head[key] = {'value': val.tolist(), 'dtype': val.dtype.str}
+    return head
+
+
+def _header_from_json(head):
+    return {key: np.array(val['value'], dtype=val['dtype'])[()] for key, val in head.items()}
+
+
+def find_cache(filename, sources):
+    """
+    Return the cache directory of a snapshot if it exists and was made from the current source files
+    """
+    dirname = cache_name(filename)
+    if not os.path.isdir(dirname):
+        return None
+    try:
+        with open(os.path.join(dirname, 'header.json')) as f:
+            info = json.load(f)
+        if np.array_equal(np.array(info['stats']), _file_stats(sources)):
+            return dirname
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+def write_cache(filename, dirname=None):
+    """
+    Convert a snapshot to the snaptools cache format: a directory with one .npy file
+    for each particle type and datablock and a JSON header. Snapshot() uses the cache
+    automatically (memory mapped) for as long as the source files are unchanged.
+    Args:
+        filename: Snapshot to convert (as passed to Snapshot())
+    kwargs:
+        dirname: Cache directory. Default is cache_name(filename).
+    Returns:
+        The cache directory
+    """
+    from . import lazydict
+
+    if dirname is None:
+        dirname = cache_name(filename)
+    snap = Snapshot(filename, cache=False)
+    sources = snap.filename if isinstance(snap.filename, list) else [snap.filename]
+
+    # write to a temporary directory first so that a half written cache is never used
+    tmpdir = tempfile.mkdtemp(prefix=os.path.basename(dirname), dir=os.path.dirname(os.path.abspath(dirname)))
+    os.chmod(tmpdir, 0o755)
+    blocks = defaultdict(dict)
+    for attr_name, attr in snap.__dict__.items():
+        if not isinstance(attr, lazydict.LazyDictionary):
+            continue
+        for part in attr.keys():
+            val = attr[part]
+            # constant masses are made again from the header
+            if utils.constant_value(val) is not None:
+                continue
+            # lazy datasets, memory maps (Gadget binary) or arrays
+            block_file = '{:s}_{:s}.npy'.format(part, attr_name.replace(' ', '_'))
+            np.save(os.path.join(tmpdir, block_file), np.asarray(val))
+            blocks[part][attr_name] = block_file
+    snap.close()
+
+    # a cache without datablocks would hide the snapshot from every later load
+    if not blocks:
+        shutil.rmtree(tmpdir)
+        raise IOError("No datablocks of {:s} could be cached".format(filename))
+
+    with open(os.path.join(tmpdir, 'header.json'), 'w') as f:
+        json.dump({'source': [os.path.realpath(src) for src in sources],
+                   'stats': _file_stats(sources).tolist(),
+                   'header': _header_to_json(snap.header),
+                   'blocks': blocks}, f)
+
+    if os.path.isdir(dirname):
+        shutil.rmtree(dirname)
+    os.rename(tmpdir, dirname)
+    return dirname
+
+
+class SnapCache(SnapLazy):
+    """
+    Snapshot read from the snaptools .npy cache (see write_cache).
+    Every datablock is a copy-on-write memory map of its .npy file: it can be changed
+    in place like any other datablock, without changing the cache.
+    With lazy=False the datablocks are read into memory instead and with mmap=True
+    they are read-only memory maps.
+    """
+    def __init__(self, fname, **kwargs):
+        pass
+
+    def init(self, dirname, part_names=None, fields=None, parttypes=None, verbose=False,
+             lazy=True, mmap=False, max_open_files=16, workers=1, manifest=None, **kwargs):
+        from functools import partial
+        from . import lazydict
+
+        if part_names is None:
+            part_names = ['gas',
+                          'halo',
+                          'stars',
+                          'bulge',
+                          'sfr',
+                          'other']
+
+        self.settings = utils.make_settings(**kwargs)
+        self.bin_dict = None
+        self.fields = fields
+        self.parttypes = parttypes
+        self.galaxy_name = None
+        self.cache = dirname
+        self.load_stats = LoadStats(dirname)
+
+        with open(os.path.join(dirname, 'header.json')) as f:
+            info = json.load(f)
+        self.filename = info['source'] if len(info['source']) > 1 else info['source'][0]
+        self.header = _header_from_json(info['header'])
+        self.part_names = part_names[:len(self.header['nall'])]
+
+        for part, blocks in info['blocks'].items():
+            for attr_name, block_file in blocks.items():
+                key = {val: key for key, val in DATABLOCKS.items()}.get(attr_name, attr_name)
+                if not wanted(key, part, fields, parttypes):
+                    continue
+                if attr_name not in self.__dict__.keys():
+                    self.__dict__[attr_name] = self._lazy_dict(attr_name)
+                if mmap:
+                    mode = 'r'
+                elif lazy:
+                    mode = 'c'
+                else:
+                    mode = None
+                self.__dict__[attr_name][part] = partial(np.load, os.path.join(dirname, block_file),
+                                                         mmap_mode=mode)
+
+        self._add_constant_masses(fields, parttypes)
+
+        if not lazy:
+            # read everything now and keep it (a memory budget never evicts these)
+            for attr in list(self.__dict__.values()):
+                if isinstance(attr, lazydict.LazyDictionary):
+                    for part in list(attr.keys()):
+                        attr[part] = attr[part]
 
 
 class SnapHDF5(Snapshot):
@@ -172,28 +1840,61 @@ class SnapHDF5(Snapshot):
         """
         pass
 
-    def init(self, fname, **kwargs):
+    def init(self, fname, fields=None, parttypes=None, galaxy=None, id_file=None, mmap=False,
+             **kwargs):
         """Read from an HDF5 file
+        kwargs:
+            fields: Only read these datablocks (e.g. ['pos', 'masses']). Default is everything.
+            parttypes: Only read these particle types (e.g. ['stars']). Default is everything.
+            galaxy: Only read the particles of this galaxy in id_file (see Snapshot.make_id_file)
+            id_file: File with the particle ids of each galaxy
+            mmap: Return read-only memory maps of datasets that are stored contiguously and
+                  uncompressed instead of reading them. Other datasets are read as usual.
         """
         self.settings = utils.make_settings(**kwargs)
         self.bin_dict = None
         self.filename = fname
+        self.fields = fields
+        self.parttypes = parttypes
+        self.galaxy_name = galaxy
 
-        with h5py.File(fname, 'r') as s:
-            self.header = {}
-            #header_keys = s['Header'].attrs.keys()
-            for head_key, head_val in s['Header'].attrs.items():
-                if head_key in HEAD_ATTRS.keys():
-                    self.header[HEAD_ATTRS[head_key]] = head_val
-                else:
-                    self.header[head_key] = head_val
+        pool = FilePool()
+        part_names = ['gas',
+                      'halo',
+                      'stars',
+                      'bulge',
+                      'sfr',
+                      'other']
+        rows = None
+        if galaxy is not None:
+            rows = galaxy_rows([fname], id_file, galaxy, part_names, pool=pool)
 
-            part_names = ['gas',
-                          'halo',
-                          'stars',
-                          'bulge',
-                          'sfr',
-                          'other']
+        self.load_stats = LoadStats(fname)
+
+        def read(group, key, i):
+            start = time.time()
+            value = _read(group, key, i)
+            # memory maps are read when used
+            nbytes = 0 if isinstance(value, np.memmap) else value.nbytes
+            self.load_stats.record(DATABLOCKS.get(key, key), part_names[i], nbytes,
+                                   time.time() - start)
+            return value
+
+        def _read(group, key, i):
+            if rows is None:
+                if mmap:
+                    mapped = memmap_dataset(fname, s[group][key])
+                    if mapped is not None:
+                        return mapped
+                return s[group][key][()]
+            return LazyDataset(fname, group, key, pool=pool, rows=rows[i]).materialize()
+
+        with pool.open(fname) as s:
+            self.header = hdf5_header(s)
+            if rows is not None:
+                restrict_header(self.header, rows)
+
+            self.part_names = part_names[:len(self.header['nall'])]
             self.pos = {}
             self.vel = {}
             self.ids = {}
@@ -205,26 +1906,33 @@ class SnapHDF5(Snapshot):
                     group = 'PartType%s' % i
                     part_name = part_names[i]
                     for key in s[group].keys():
+                        if not wanted(key, part_name, fields, parttypes):
+                            continue
                         if key == 'Coordinates':
-                            self.pos[part_name] = s[group]['Coordinates'][()]
+                            self.pos[part_name] = read(group, 'Coordinates', i)
                         elif key == 'Velocities':
-                            self.vel[part_name] = s[group]['Velocities'][()]
+                            self.vel[part_name] = read(group, 'Velocities', i)
                         elif key == 'ParticleIDs':
-                            self.ids[part_name] = s[group]['ParticleIDs'][()]
+                            self.ids[part_name] = read(group, 'ParticleIDs', i)
                         elif key == 'Potential':
-                            self.pot[part_name] = s[group]['Potential'][()]
+                            self.pot[part_name] = read(group, 'Potential', i)
                         elif key == 'Masses':
-                            self.masses[part_name] = s[group]['Masses'][()]
+                            # masses in the MassTable take precedence, as in SnapLazy
+                            if self.header['massarr'][i] == 0:
+                                self.masses[part_name] = read(group, 'Masses', i)
                         # If we find a misc. key then add it to the misc variable (a dict)
                         elif key in MISC_DATABLOCKS.keys():
                             if part_name not in self.misc.keys():
                                 self.misc[part_name] = {}
-                            self.misc[part_name][MISC_DATABLOCKS[key]] = s[group][key][()]
+                            self.misc[part_name][MISC_DATABLOCKS[key]] = read(group, key, i)
                         # We have an unidentified key, throw it in with the misc. keys
                         else:
                             if part_name not in self.misc.keys():
                                 self.misc[part_name] = {}
-                            self.misc[part_name][key] = s[group][key][()]
+                            self.misc[part_name][key] = read(group, key, i)
                     # If we never found the masses key then make one
-                    if part_name not in self.masses.keys():
-                        self.masses[part_name] = (np.ones(n) * self.header['massarr'][i])
+                    if (part_name not in self.masses.keys()) and wanted('Masses', part_name,
+                                                                        fields, parttypes):
+                        # a writable array, as eager snapshots are often changed in place
+                        self.masses[part_name] = np.ones(n)*self.header['massarr'][i]
+        pool.close()
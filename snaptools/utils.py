@@ -58,6 +58,7 @@ def make_settings(**kwargs):
                 'offset': [0, 0, 0],
                 'im_func': None,
                 'halo_center_method':'pot',
+                'chunk_size': None,
                 'UnitMass_in_g':1.989e43,  # 1.e10 solar masses
                 'UnitVelocity_in_cm_per_s':1e5,  # 1 km/s
                 'UnitLength_in_cm':3.085678e21}
@@ -77,6 +78,68 @@ def make_settings(**kwargs):
     return settings
 
 
+def projection_from_settings(settings, centers=False):
+    """
+    Return the fields and particle types that a snapshot needs for bin_snap
+    (or find_centers if centers is True) with the given settings.
+    Pass these to Snapshot(fname, fields=fields, parttypes=parttypes) to avoid reading anything else.
+    """
+    fields = ['pos', 'masses']
+    parttypes = settings['parttype']
+    if isinstance(parttypes, (str, bytes)):
+        parttypes = [parttypes]
+    parttypes = list(parttypes)
+    if settings['panel_mode'] == 'starsgas':
+        parttypes.append('gas')
+    if centers:
+        parttypes += ['halo', 'stars']
+        if settings['halo_center_method'] == 'pot':
+            fields += ['vel', 'pot']
+    return fields, list(set(parttypes))
+
+
+def constant_array(value, n):
+    """
+    A read-only array of n copies of value that only takes the memory of one number.
+    Used (through snapshot_io.ConstantDataset) for the masses of particle types that have
+    their mass in the header in lazily loaded snapshots.
+    """
+    return np.broadcast_to(np.float64(value), (int(n),))
+
+
+def constant_value(arr):
+    """
+    The value of an array made by constant_array (or any slice of one), otherwise None
+    """
+    if hasattr(type(arr), 'constant'):  # e.g. snapshot_io.ConstantDataset
+        return arr.constant
+    if isinstance(arr, np.ndarray) and (arr.ndim == 1) and (arr.size > 0) and (arr.strides[0] == 0):
+        return arr[0]
+    return None
+
+
+def as_slice(rows):
+    """
+    A slice selecting the same rows as a sorted array of unique row numbers
+    if they form one contiguous range, otherwise the array itself
+    """
+    rows = np.asarray(rows)
+    if len(rows) == 0:
+        return rows
+    if (rows[-1] - rows[0] + 1 == len(rows)) and np.all(np.diff(rows) == 1):
+        return slice(int(rows[0]), int(rows[-1]) + 1)
+    return rows
+
+
+def as_rows(rows, n):
+    """
+    Row numbers selected by a slice (or array of row numbers) from n rows
+    """
+    if isinstance(rows, slice):
+        return np.arange(*rows.indices(n))
+    return np.asarray(rows)
+
+
 def check_args(base_val, *args):
     # This function is mostly broken and likely unneccassary
     # Done this way because of https://hynek.me/articles/hasattr/
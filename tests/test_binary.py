@@ -0,0 +1,108 @@
+import os
+import tempfile
+import numpy as np
+from snaptools import snapshot
+
+
+def write_gadget_binary(snap, fname, fmt=2, order='<', nfiles=1):
+    """
+    Write a snapshot in Gadget-2 binary format, giving the stars their own masses.
+    With nfiles > 1 the particles are split over the files fname.0, fname.1...
+    """
+    for k in range(nfiles):
+        parts = [p for i, p in enumerate(snap.part_names) if snap.header['nall'][i] > 0]
+        rows = {p: np.array_split(np.arange(len(snap.pos[p])), nfiles)[k] for p in parts}
+        npart = np.array([len(rows[p]) if p in rows else 0 for p in snap.part_names],
+                         dtype=order + 'i4')
+        massarr = np.array(snap.header['massarr'], dtype=order + 'f8')
+        massarr[2] = 0
+        head = bytearray(256)
+        fields = [npart, massarr, np.array([0.5, 1.0], dtype=order + 'f8'),
+                  np.zeros(2, dtype=order + 'i4'), np.array(snap.header['nall'], dtype=order + 'u4'),
+                  np.array([0, nfiles], dtype=order + 'i4')]
+        head[:sum(x.nbytes for x in fields)] = b''.join(x.tobytes() for x in fields)
+
+        blocks = [('HEAD', bytes(head)),
+                  ('POS ', [snap.pos[p][rows[p]].astype(order + 'f4') for p in parts]),
+                  ('VEL ', [snap.vel[p][rows[p]].astype(order + 'f4') for p in parts]),
+                  ('ID  ', [snap.ids[p][rows[p]].astype(order + 'u4') for p in parts]),
+                  ('MASS', [snap.masses['stars'][rows['stars']].astype(order + 'f4')])]
+        with open(fname if nfiles == 1 else '{:s}.{:d}'.format(fname, k), 'wb') as f:
+            for label, data in blocks:
+                if not isinstance(data, bytes):
+                    data = b''.join(x.tobytes() for x in data)
+                if fmt == 2:
+                    f.write(np.array([8], dtype=order + 'i4').tobytes() + label.encode() +
+                            np.array([len(data) + 8, 8], dtype=order + 'i4').tobytes())
+                size = np.array([len(data)], dtype=order + 'i4').tobytes()
+                f.write(size + data + size)
+
+
+class TestBinary():
+
+    @classmethod
+    def setup_class(self):
+        self.snap = snapshot.Snapshot('tests/galaxies0.hdf5')
+        self.folder = tempfile.mkdtemp()
+
+    def test_formats(self):
+        for fmt, order in [(1, '<'), (2, '<'), (2, '>')]:
+            fname = os.path.join(self.folder, 'snap_{:d}{:s}'.format(fmt, order == '>' and 'be' or 'le'))
+            write_gadget_binary(self.snap, fname, fmt, order)
+            snap = snapshot.Snapshot(fname)
+            assert snap.header['time'] == 0.5
+            assert snapshot.read_header(fname)['redshift'] == 1.0
+            assert np.array_equal(snap.header['nall'], self.snap.header['nall'])
+            for p in ['halo', 'stars']:
+                assert isinstance(snap.pos[p], np.memmap)
+                assert np.array_equal(snap.pos[p], self.snap.pos[p])
+                assert np.array_equal(snap.ids[p], self.snap.ids[p])
+                assert np.allclose(snap.masses[p], self.snap.masses[p])
+            com = snap.measure_com('stars', [np.arange(10000)])
+            assert np.allclose(com[0], [-9.39480209e+01, -3.41116142e+01, -1.63059831e-02])
+
+    def test_projection(self):
+        fname = os.path.join(self.folder, 'snap_proj')
+        write_gadget_binary(self.snap, fname)
+        snap = snapshot.Snapshot(fname, fields=['pos'], parttypes=['stars'])
+        assert list(snap.pos.keys()) == ['stars']
+        assert getattr(snap, 'vel', {}) == {}
+
+    def test_multi_file(self):
+        fname = os.path.join(self.folder, 'snap_multi')
+        write_gadget_binary(self.snap, fname, nfiles=3)
+        assert np.array_equal(snapshot.read_header(fname)['npart'], self.snap.header['nall'])
+        for name in [fname, fname + '.0']:
+            snap = snapshot.Snapshot(name)
+            assert snap.filename == [fname + '.0', fname + '.1', fname + '.2']
+            assert np.array_equal(snap.header['npart'], self.snap.header['nall'])
+            for p in ['halo', 'stars']:
+                assert np.array_equal(snap.pos[p], self.snap.pos[p])
+                assert np.array_equal(snap.ids[p], self.snap.ids[p])
+            assert np.allclose(snap.masses['halo'], self.snap.masses['halo'])
+        try:
+            snapshot.Snapshot(fname + '.1')
+            assert False
+        except IOError:
+            pass
+
+    def test_writeable(self):
+        fname = os.path.join(self.folder, 'snap_write')
+        write_gadget_binary(self.snap, fname)
+        snap = snapshot.Snapshot(fname)
+        snap.pos['stars'] += 1
+        assert snap.stats()['pos']['stars']['bytes'] == 0  # memory mapped, not read
+        assert np.allclose(snap.pos['stars'], self.snap.pos['stars'] + 1)
+        # the file is unchanged
+        assert np.array_equal(snapshot.Snapshot(fname).pos['stars'], self.snap.pos['stars'])
+
+    def test_cache(self):
+        from snaptools import snapshot_io
+        fname = os.path.join(self.folder, 'snap_cache')
+        write_gadget_binary(self.snap, fname)
+        assert snapshot_io.write_cache(fname) == fname + '.snapcache'
+        snap = snapshot.Snapshot(fname)
+        assert snap.cache == fname + '.snapcache'
+        for p in ['halo', 'stars']:
+            assert np.array_equal(snap.pos[p], self.snap.pos[p])
+            assert np.allclose(snap.masses[p], self.snap.masses[p])
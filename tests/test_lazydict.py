@@ -0,0 +1,99 @@
+import time
+import threading
+import pytest
+from snaptools import lazydict
+
+
+def slow(value, calls=None):
+    if calls is not None:
+        calls.append(value)
+    time.sleep(0.3)
+    return value
+
+
+class TestLazyDictionary():
+
+    def test_concurrent_keys(self):
+        d = lazydict.MutableLazyDictionary()
+        d['a'] = lambda: slow(1)
+        d['b'] = lambda: slow(2)
+        results = {}
+        threads = [threading.Thread(target=lambda k=k: results.update({k: d[k]})) for k in 'ab']
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert results == {'a': 1, 'b': 2}
+        assert time.time() - start < 0.55  # loaded at the same time
+
+    def test_same_key(self):
+        calls = []
+        d = lazydict.MutableLazyDictionary()
+        d['a'] = lambda: slow(1, calls)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(d['a'])) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert results == [1]*4
+        assert calls == [1]  # one evaluation shared by every thread
+
+    def test_errors(self):
+        d = lazydict.MutableLazyDictionary()
+        d['a'] = lambda: d['a']
+        with pytest.raises(lazydict.CircularReferenceError):
+            d['a']
+        d['b'] = lambda: 1/0
+        for i in range(2):
+            with pytest.raises(ZeroDivisionError):
+                d['b']
+
+    def test_dirty(self):
+        import numpy as np
+
+        def readonly():
+            a = np.zeros(100)
+            a.flags.writeable = False
+            return a
+
+        budget = lazydict.MemoryBudget(1000)
+        d = lazydict.MutableLazyDictionary(budget=budget)
+        d['a'] = readonly
+        d['b'] = readonly
+        d['a']
+        d.mark_dirty('a')
+        d['b']  # over budget, but 'a' was changed and is kept
+        assert d.states['a'] == 'evaluated'
+        assert not d.evict('a')
+        assert d.evict('b')
+        # writable arrays may be changed once they are handed out, so they are kept
+        d['c'] = lambda: np.zeros(100)
+        d['c'][:] = 1
+        d['b']
+        assert d.states['c'] == 'evaluated'
+        assert np.all(d['c'] == 1)
+
+    def test_budget_entries(self):
+        import gc
+        import numpy as np
+
+        def readonly():
+            a = np.zeros(100)
+            a.flags.writeable = False
+            return a
+
+        budget = lazydict.MemoryBudget()
+        d = lazydict.MutableLazyDictionary(budget=budget)
+        d['a'] = readonly
+        d['a']
+        assert budget.resident_bytes() == 800
+        budget.discard(d)
+        assert budget.resident_bytes() == 0
+        d['a']
+        del d
+        gc.collect()
+        # entries go with their dictionary
+        assert len(budget.entries) == 0
+        assert len(budget.finalizers) == 0
@@ -1,4 +1,6 @@
 import numpy as np
+import copy
+import pytest
 from snaptools import snapshot
 
 
@@ -64,3 +66,339 @@ class TestSnapshot():
     def test_measure_m20(self):
         #assert self.snap.measure_m20() is not np.nan
         pass
+
+
+    def test_projection(self):
+        for lazy in [True, False]:
+            snap = snapshot.Snapshot('tests/galaxies0.hdf5', lazy=lazy,
+                                     fields=['pos', 'Masses'], parttypes=['stars'])
+            assert list(snap.pos.keys()) == ['stars']
+            assert list(snap.masses.keys()) == ['stars']
+            assert 'stars' not in getattr(snap, 'vel', {})
+            assert np.allclose(snap.pos['stars'], self.snap.pos['stars'])
+
+
+    def test_sliced_access(self):
+        snap = snapshot.Snapshot('tests/galaxies0.hdf5')
+        full = self.snap.pos['halo'][:]
+        pos = snap.pos['halo']
+        index = np.sort(np.random.choice(len(full), 1000, replace=False))
+        assert np.array_equal(pos[100:2000:3], full[100:2000:3])
+        assert np.array_equal(pos[index, 0], full[index, 0])
+        assert np.array_equal(pos[index[::-1]], full[index[::-1]])
+        assert not pos.loaded
+
+
+    def test_iter_chunks(self):
+        snap = snapshot.Snapshot('tests/galaxies0.hdf5')
+        total = np.zeros(3)
+        npart = 0
+        for chunk in snap.iter_chunks(['halo', 'stars'], ['pos', 'ids'], chunk_size=7000):
+            assert len(chunk['pos']) == len(chunk['ids']) <= 7000
+            total += chunk['pos'].sum(axis=0, dtype=np.float64)
+            npart += len(chunk['ids'])
+        full = np.append(self.snap.pos['halo'], self.snap.pos['stars'], axis=0)
+        assert npart == len(full)
+        assert np.allclose(total, full.sum(axis=0, dtype=np.float64))
+        assert not snap.pos['halo'].loaded
+
+
+    def test_bin_chunks(self):
+        from snaptools import utils
+        snap = snapshot.Snapshot('tests/galaxies0.hdf5')
+        settings = utils.make_settings(panel_mode='three', xlen=100, ylen=100, zlen=100, NBINS=64)
+        full = snap.bin_snap(settings)
+        chunked = snap.bin_snap(settings, chunk_size=3000)
+        for key in ['Z2', 'H', 'H2']:
+            assert np.allclose(full[key], chunked[key], equal_nan=True, rtol=1e-4)
+            assert np.array_equal(full[key + 'x'], chunked[key + 'x'])
+
+        # centered on the (float64) streaming center of mass, particles may land in the next bin
+        settings = utils.make_settings(xlen=100, ylen=100, NBINS=64, com=True, gal_num=0)
+        full = snap.bin_snap(settings, doLog=False)
+        chunked = snap.bin_snap(settings, doLog=False, chunk_size=3000)
+        assert np.isclose(full['Z2'].sum(), chunked['Z2'].sum(), rtol=1e-4)
+        assert np.mean(np.isclose(full['Z2'], chunked['Z2'], rtol=1e-4)) > 0.99
+
+
+    def test_constant_masses(self):
+        from snaptools import manipulate as man
+        from snaptools import utils
+        # eager snapshots have ordinary (writable) mass arrays
+        snap = snapshot.Snapshot('tests/galaxies0.hdf5', lazy=False)
+        snap.masses['stars'] *= 2
+        assert np.allclose(snap.masses['stars'], 2*snap.header['massarr'][2])
+        snap = snapshot.Snapshot('tests/galaxies0.hdf5')
+        mass = snap.masses['stars']
+        assert mass.strides == (0,)
+        assert utils.constant_value(mass) == snap.header['massarr'][2]
+        pos = snap.pos['stars']
+        Z2 = man.bin_particles(pos[:, 0], pos[:, 1], 50, 50, mass, 64)[0]
+        weighted = man.bin_particles(pos[:, 0], pos[:, 1], 50, 50, np.array(mass), 64)[0]
+        assert np.allclose(Z2, weighted, rtol=1e-5)
+        assert np.array_equal(snap.split_galaxies('stars')[0], np.arange(20000))
+        # lazy constant masses become an ordinary array when they are changed
+        snap.masses['stars'] *= 2
+        assert np.allclose(snap.masses['stars'], 2*snap.header['massarr'][2])
+        assert utils.constant_value(snap.masses['stars']) is None
+        snap.masses['stars'][:10] = 1
+        assert np.all(snap.masses['stars'][:10] == 1)
+        assert np.allclose(snap.masses['stars'][10:], 2*snap.header['massarr'][2])
+        snap = snapshot.Snapshot('tests/galaxies0.hdf5')
+        snap.masses['stars'][0] = 1
+        assert snap.masses['stars'][0] == 1
+        assert snap.masses['stars'][1] == snap.header['massarr'][2]
+
+
+    def test_fits_products(self):
+        snap = snapshot.Snapshot('tests/galaxies0.hdf5')
+        pos = np.array(snap.pos['stars'])
+        H, edges = snap.to_cube(theta=90, lengthX=200, lengthY=200, BINS=64, write=False)
+        assert H.shape == (64, 64, 100)
+        assert np.array_equal(snap.pos['stars'], pos)  # rotating doesn't change the snapshot
+        rotated, vel, mass = snap._rotated('stars', theta=90)
+        assert np.allclose(rotated[:, 0], pos[:, 2], atol=1e-4)
+        assert np.allclose(rotated[:, 2], -pos[:, 0], atol=1e-4)
+
+
+    def test_memory_budget(self):
+        snap = snapshot.Snapshot('tests/galaxies0.hdf5')
+        nbytes = 40000*3*4
+        snap.set_memory_budget(int(1.5*nbytes))
+        np.asarray(snap.pos['halo'])
+        assert snap.resident_bytes() == nbytes
+        np.asarray(snap.vel['halo'])  # least recently used (pos['halo']) is evicted
+        assert snap.resident_bytes() == nbytes
+        assert snap.pos.states['halo'] == 'defined'
+        assert np.array_equal(snap.pos['halo'], self.snap.pos['halo'])
+        assert snap.vel.states['halo'] == 'defined'
+        # changed datablocks are kept
+        snap.pos['halo'][:, 0] -= 1000
+        np.asarray(snap.vel['halo'])
+        np.asarray(snap.vel['stars'])
+        assert snap.pos.states['halo'] == 'evaluated'
+        assert np.allclose(snap.pos['halo'][:, 0], self.snap.pos['halo'][:, 0] - 1000)
+        # arrays handed out are read-only views, copies, or kept in memory
+        with pytest.raises(ValueError):
+            np.asarray(snap.vel['halo'])[:] = 0
+        column = snap.vel['halo'][:, 0]
+        column[:] = 0
+        assert not np.any(snap.vel['halo'][:, 0] == 0)
+        vel = snap.vel['stars'].materialize()
+        vel[:] = 0
+        np.asarray(snap.pos['stars'])
+        np.asarray(snap.vel['halo'])
+        assert snap.vel.states['stars'] == 'evaluated'
+        assert np.all(snap.vel['stars'] == 0)
+        snap.close()
+        assert snap.memory_budget.resident_bytes() == 0
+
+
+    def test_prefetch(self):
+        snap = snapshot.Snapshot('tests/galaxies0.hdf5')
+        futures = snap.prefetch(fields=['pos', 'vel'], parttypes=['halo'])
+        assert len(futures) == 2
+        for future in futures:
+            future.result()
+        assert snap.pos['halo'].loaded and snap.vel['halo'].loaded
+        assert not snap.pos['stars'].loaded
+        assert np.array_equal(snap.vel['halo'], self.snap.vel['halo'])
+        snap.close()
+        # find_centers only reads the datablocks it uses
+        snap = snapshot.Snapshot('tests/galaxies0.hdf5')
+        snap.set_settings(halo_center_method='com')
+        snap.find_centers()
+        assert snap.stats().keys() == {'pos', 'masses'}
+        # nothing is read ahead of chunked or budgeted reads
+        for chunked in [True, False]:
+            snap = snapshot.Snapshot('tests/galaxies0.hdf5')
+            snap.set_settings(halo_center_method='com')
+            if chunked:
+                snap.set_settings(chunk_size=10000)
+            else:
+                snap.set_memory_budget(10**7)
+            snap.find_centers()
+            assert getattr(snap, 'prefetch_pool', None) is None
+
+
+    def test_stats(self):
+        snap = snapshot.Snapshot('tests/galaxies0.hdf5')
+        snap.pos['halo'][:1000]
+        np.asarray(snap.pos['halo'])
+        snap.masses['stars']
+        stats = snap.stats()
+        assert stats['pos']['halo']['loads'] == 2
+        assert stats['pos']['halo']['bytes'] == 1000*12 + 40000*12
+        assert stats['pos']['halo']['resident_bytes'] == 40000*12
+        assert stats['pos']['halo']['sources'] == ['tests/galaxies0.hdf5']
+        assert stats['masses']['stars']['loads'] == 1
+        assert stats['masses']['stars']['bytes'] == 0  # from the header
+        assert 'vel' not in stats
+        stats = snapshot.Snapshot('tests/galaxies0.hdf5', lazy=False).stats()
+        assert stats['vel']['stars']['bytes'] == 20000*12
+
+
+    def test_derived(self):
+        snap = snapshot.Snapshot('tests/galaxies0.hdf5')
+        pos = np.array(snap.pos['stars'])
+        r = snap.derived['r']['stars']
+        assert np.allclose(r, np.sqrt(np.sum(pos**2, axis=1)))
+        assert snap.derived['r']['stars'] is r  # cached
+        ke = snap.derived['ke']['stars']
+        snap.derived.set_center([10, 0, 0])
+        assert np.allclose(snap.derived['r']['stars'], np.sqrt(np.sum((pos - [10, 0, 0])**2, axis=1)))
+        assert snap.derived['ke']['stars'] is ke  # doesn't depend on the center
+        snap.vel['stars'] = np.array(snap.vel['stars'])*2
+        assert np.allclose(snap.derived['ke']['stars'], 4*ke)
+        assert list(snap.derived['binding_energy'].keys()) == []  # no potential
+        snap.derived.set_center([0, 0, 0])
+        for shift in [5, 10]:  # replaced datablocks are never mistaken for the old ones
+            snap.pos['stars'] = snap.pos['stars'] + 5
+            assert np.allclose(snap.derived['r']['stars'],
+                               np.sqrt(np.sum((pos + shift)**2, axis=1)), atol=1e-4)
+        # lazily loaded datablocks changed in place
+        r = snap.derived['r']['halo']
+        snap.pos['halo'][:, 0] += 10
+        assert np.allclose(snap.derived['r']['halo'],
+                           np.sqrt(np.sum((self.snap.pos['halo'] + [10, 0, 0])**2, axis=1)), atol=1e-4)
+        # values measured from a temporary center are dropped, the others are kept
+        r = snap.derived['r']['halo']
+        with snap.derived.centered([1, 2, 3]):
+            snap.derived['r']['stars']
+            rows = np.arange(0, 20000, 7)
+            selected = snap.derived.select('stars', rows)['r']
+            assert np.allclose(selected, snap.derived['r']['stars'][rows])
+        assert ('r', 'stars') not in snap.derived.stamps
+        assert snap.derived['r']['halo'] is r
+        assert not r.flags.writeable
+        snap.set_memory_budget(0)  # cached values count towards the snapshot's budget
+        assert snap.derived.values['r'].states['halo'] == 'defined'
+        assert np.array_equal(snap.derived['r']['halo'], r)
+
+
+    def test_segment_galaxies(self):
+        snap = snapshot.Snapshot()
+        pos = self.snap.pos['stars']
+        snap.pos = {'stars': pos, 'halo': self.snap.pos['halo']}
+        snap.masses = {'stars': np.repeat([2.0, 1.0], 10000),
+                       'halo': np.tile([3.0, 3.0, 1.0], len(self.snap.pos['halo'])//3)}
+        gals = snap.segment_galaxies('stars')
+        assert gals == [slice(0, 10000), slice(10000, 20000)]
+        assert snap.segment_galaxies('stars')[0] is gals[0]  # cached
+        assert np.array_equal(snap.split_galaxies('stars')[1], np.arange(10000, 20000))
+        assert np.allclose(snap.measure_com('stars', gals[0]),
+                           [-9.39480209e+01, -3.41116142e+01, -1.63059831e-02])
+        # interleaved galaxies are returned as rows
+        halo = snap.segment_galaxies('halo')
+        assert np.array_equal(halo[0], np.flatnonzero(snap.masses['halo'] == 3.0))
+        both = snap.segment_galaxies(['stars', 'halo'])
+        assert np.array_equal(both[1], np.append(np.arange(10000, 20000), 20000 + halo[1]))
+        # replacing the masses drops the cached segmentation
+        snap.masses['stars'] = np.repeat([1.0, 2.0], 10000)
+        assert snap.segment_galaxies('stars') == [slice(10000, 20000), slice(0, 10000)]
+        snap.masses['stars'] = np.repeat([2.0, 1.0], 10000)
+        assert snap.segment_galaxies('stars') == [slice(0, 10000), slice(10000, 20000)]
+
+
+    def test_galaxy_view(self):
+        snap = snapshot.Snapshot('tests/galaxies0.hdf5', lazy=False)
+        snap.masses['stars'] = np.repeat([2.0, 1.0], 10000)
+        gal = snap.galaxy(1)
+        assert list(gal.pos.keys()) == ['stars']  # the halo is all one galaxy
+        assert gal.header['nall'][2] == 10000
+        assert np.shares_memory(gal.pos['stars'], snap.pos['stars'])
+        assert np.allclose(gal.center, [9.40026627e+01, 3.41231651e+01, -5.44914752e-02])
+        assert np.allclose(gal.measure_com('stars', [np.arange(10000)]), [gal.center])
+        assert np.allclose(gal.derived['r']['stars'],
+                           np.linalg.norm(snap.pos['stars'][10000:] - gal.center, axis=1))
+        gal.set_settings(com=True, NBINS=64)
+        settings = copy.deepcopy(snap.settings)
+        settings.update(gal_num=1, com=True, NBINS=64)
+        assert np.allclose(gal.bin_snap()['Z2'], snap.bin_snap(settings)['Z2'])
+        Z2 = gal.to_velfield(lengthX=100, lengthY=100, BINS=32, write=False)[0]
+        assert Z2.shape == (32, 32)
+
+
+    def test_measure_centers(self):
+        from snaptools import manipulate as man
+        snap = snapshot.Snapshot('tests/galaxies0.hdf5')
+        snap.masses['stars'] = np.repeat([2.0, 1.0], 10000)
+        com = snap.measure_centers('stars')
+        assert np.allclose(com, [[-9.39480209e+01, -3.41116142e+01, -1.63059831e-02],
+                                 [9.40026627e+01, 3.41231651e+01, -5.44914752e-02]], atol=1e-3)
+        vel = np.asarray(snap.vel['stars'], dtype=np.float64)
+        assert np.allclose(snap.measure_centers('stars', field='vel'),
+                           [vel[:10000].mean(axis=0), vel[10000:].mean(axis=0)])
+        # mass weighted over particle types
+        both = snap.measure_centers(['halo', 'stars'])
+        pos = np.append(snap.pos['halo'], snap.pos['stars'][:10000], axis=0)
+        mass = np.append(snap.masses['halo'], snap.masses['stars'][:10000])
+        assert np.allclose(both[0], np.average(pos, axis=0, weights=mass), atol=1e-3)
+        # the shrinking sphere ends close to the densest part of the galaxy
+        shrink = snap.measure_centers('stars', method='shrink', min_particles=500)
+        center, rows = man.shrinking_sphere(snap.pos['stars'][:10000], min_particles=500)
+        assert np.allclose(shrink[0], center)
+        assert len(rows) >= 500
+        r = np.linalg.norm(snap.pos['stars'][:10000][rows] - center, axis=1)
+        assert np.linalg.norm(np.mean(snap.pos['stars'][:10000][rows], axis=0) - center) < 1e-3*r.max()
+
+
+    def test_galaxy(self):
+        import h5py
+        import os
+        import tempfile
+        id_file = os.path.join(tempfile.mkdtemp(), 'ids.hdf5')
+        with h5py.File(id_file, 'w') as f:
+            f.create_dataset('gal1/stars', data=self.snap.ids['stars'][:10000])
+        for lazy in [True, False, True]:  # second lazy load uses the cached rows
+            snap = snapshot.Snapshot('tests/galaxies0.hdf5', lazy=lazy,
+                                     galaxy='gal1', id_file=id_file)
+            assert snap.header['nall'][1] == 0
+            assert len(snap.masses['stars']) == 10000
+            com = snap.measure_com('stars', [np.arange(10000)])
+            assert np.allclose(com[0], [-9.39480209e+01, -3.41116142e+01, -1.63059831e-02])
+        assert os.path.exists(id_file.replace('.hdf5', '.rows.hdf5'))
+        # the cached rows are not used once the id file is rewritten
+        with h5py.File(id_file, 'w') as f:
+            f.create_dataset('gal1/stars', data=self.snap.ids['stars'][:5000])
+        snap = snapshot.Snapshot('tests/galaxies0.hdf5', galaxy='gal1', id_file=id_file)
+        assert len(snap.masses['stars']) == 5000
+
+
+    def test_mmap(self):
+        for lazy in [True, False]:
+            snap = snapshot.Snapshot('tests/galaxies0.hdf5', lazy=lazy, mmap=True)
+            assert isinstance(snap.pos['stars'][:], np.memmap)
+            assert np.array_equal(snap.pos['stars'][10:20], self.snap.pos['stars'][10:20])
+            # memory maps are read when used, not when they are made
+            assert snap.stats().get('pos', {}).get('stars', {'bytes': 0})['bytes'] == 0
+
+
+    def test_cache(self):
+        import os
+        import shutil
+        import tempfile
+        from snaptools import simulation
+        folder = tempfile.mkdtemp() + '/'
+        shutil.copy('tests/galaxies0.hdf5', folder)
+        sim = simulation.Simulation(folder, snapbase='galaxies')
+        assert sim.build_cache(workers=1) == [folder + 'galaxies0.snapcache']
+        snap = snapshot.Snapshot(folder + 'galaxies0.hdf5')
+        assert snap.cache == folder + 'galaxies0.snapcache'
+        assert isinstance(snap.pos['stars'], np.memmap)
+        assert np.array_equal(snap.pos['stars'], self.snap.pos['stars'])
+        assert np.allclose(snap.masses['halo'], self.snap.masses['halo'])
+        assert np.allclose(snap.header['massarr'], self.snap.header['massarr'])
+        # datablocks from the cache can be changed in place, the cache itself is unchanged
+        snap.pos['stars'] += 100
+        assert np.allclose(snap.pos['stars'], self.snap.pos['stars'] + 100)
+        assert np.array_equal(snapshot.Snapshot(folder + 'galaxies0.hdf5').pos['stars'],
+                              self.snap.pos['stars'])
+        eager = snapshot.Snapshot(folder + 'galaxies0.hdf5', lazy=False)
+        assert not isinstance(eager.pos['stars'], np.memmap)
+        eager.pos['stars'][:, 0] -= 1
+        assert not snapshot.Snapshot(folder + 'galaxies0.hdf5', mmap=True).pos['stars'].flags.writeable
+        # the cache is not used once the source changes
+        os.utime(folder + 'galaxies0.hdf5', (0, 0))
+        assert not hasattr(snapshot.Snapshot(folder + 'galaxies0.hdf5'), 'cache')
+        shutil.rmtree(folder)
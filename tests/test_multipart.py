@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+import h5py
+import numpy as np
+from snaptools import snapshot
+
+
+def split_snapshot(fname, base, nparts):
+    """
+    Write the snapshot in fname out as nparts files named base.N.hdf5
+    """
+    with h5py.File(fname, 'r') as s:
+        nall = s['Header'].attrs['NumPart_Total']
+        for n in range(nparts):
+            with h5py.File('{:s}.{:d}.hdf5'.format(base, n), 'w') as f:
+                npart = np.zeros(len(nall), dtype=np.int32)
+                grp = f.create_group('Header')
+                for key, val in s['Header'].attrs.items():
+                    grp.attrs[key] = val
+                for i, ntot in enumerate(nall):
+                    bounds = np.linspace(0, ntot, nparts+1).astype(int)
+                    npart[i] = bounds[n+1] - bounds[n]
+                    if ntot == 0:
+                        continue
+                    part = f.create_group('PartType%d' % i)
+                    for key, dset in s['PartType%d' % i].items():
+                        part.create_dataset(key, data=dset[bounds[n]:bounds[n+1]])
+                grp.attrs['NumPart_ThisFile'] = npart
+                grp.attrs['NumFilesPerSnapshot'] = nparts
+
+
+class TestMultipart():
+
+    @classmethod
+    def setup_class(self):
+        self.folder = tempfile.mkdtemp()
+        self.base = os.path.join(self.folder, 'parts')
+        split_snapshot('tests/galaxies0.hdf5', self.base, 12)
+        self.single = snapshot.Snapshot('tests/galaxies0.hdf5')
+
+    @classmethod
+    def teardown_class(self):
+        shutil.rmtree(self.folder)
+
+    def test_load(self):
+        snap = snapshot.Snapshot(self.base)
+        for ptype in ['halo', 'stars']:
+            assert np.array_equal(snap.pos[ptype], self.single.pos[ptype])
+            assert np.array_equal(snap.ids[ptype], self.single.ids[ptype])
+
+    def test_file_pool(self):
+        with snapshot.Snapshot(self.base, max_open_files=2) as snap:
+            snap.pos['stars']
+            snap.vel['halo']
+            assert len(snap.file_pool) == 2
+        assert len(snap.file_pool) == 0
+        # closed files are reopened when needed
+        assert np.array_equal(snap.ids['stars'], self.single.ids['stars'])
+
+    def test_parallel_read(self):
+        import multiprocessing
+        snap = snapshot.Snapshot(self.base, workers=3)
+        for ptype in ['halo', 'stars']:
+            assert np.array_equal(snap.vel[ptype], self.single.vel[ptype])
+        # one set of reader processes for the whole snapshot
+        pool = snap.read_pool.pool
+        assert pool is not None
+        assert np.array_equal(snap.pos['halo'], self.single.pos['halo'])
+        assert snap.read_pool.pool is pool
+        snap.vel['halo'] += 1
+        assert np.allclose(snap.vel['halo'], self.single.vel['halo'] + 1)
+        snap.close()
+        assert snap.read_pool.pool is None
+        # daemonic processes can't start readers, they read the parts one after another
+        multiprocessing.current_process().daemon = True
+        try:
+            snap = snapshot.Snapshot(self.base, workers=3)
+            assert np.array_equal(snap.pos['stars'], self.single.pos['stars'])
+            assert snap.read_pool.pool is None
+        finally:
+            multiprocessing.current_process().daemon = False
+
+    def test_manifest(self):
+        snap = snapshot.Snapshot(self.base, lazy=False)
+        assert os.path.exists(self.base + '.manifest.h5')
+        assert not [f for f in os.listdir(self.folder) if f.endswith('.tmp')]
+        assert len(snapshot.Snapshot(self.base).filename) == 12
+        for ptype in ['halo', 'stars']:
+            assert np.array_equal(snap.pos[ptype], self.single.pos[ptype])
+            assert np.array_equal(snap.masses[ptype], self.single.masses[ptype])
+        assert np.array_equal(snap.header['npart'], self.single.header['npart'])
+
+    def test_read_header(self):
+        base = os.path.join(tempfile.mkdtemp(), 'parts')
+        split_snapshot('tests/galaxies0.hdf5', base, 3)
+        header = snapshot.read_header(base)
+        assert np.array_equal(header['nall'], self.single.header['nall'])
+        assert header['time'] == self.single.header['time']
+        # the parts are not scanned for a manifest
+        assert not os.path.exists(base + '.manifest.h5')
@@ -15,4 +15,4 @@ class TestPlots():
 
     def test_plot_loop(self):
         figs = plot_tools.plot_loop(self.sim.snaps)
-        assert figs is not None
\ No newline at end of file
+        assert figs is not None
@@ -1,3 +1,4 @@
+import numpy as np
 from snaptools import snapshot
 
 class TestSnapshot():
@@ -20,4 +21,59 @@ class TestSnapshot():
                 self.snap.pos[ptype] += 100
                 self.snap.vel[ptype] += 10
 
-        self.snap.save('tests/galaxies1.hdf5')
\ No newline at end of file
+        self.snap.save('tests/galaxies1.hdf5')
+
+    def test_compressed(self):
+        import os
+        import tempfile
+        fname = os.path.join(tempfile.mkdtemp(), 'compressed.hdf5')
+        self.snap.save(fname, compression='gzip', shuffle=True, chunks=1000,
+                       single_precision=True, workers=2)
+        snap = snapshot.Snapshot(fname)
+        for ptype in ['halo', 'stars']:
+            assert np.allclose(snap.pos[ptype], self.snap.pos[ptype], rtol=1e-6)
+            assert np.array_equal(snap.ids[ptype], self.snap.ids[ptype])
+            assert snap.pos[ptype].dtype == np.float32
+        os.remove(fname)
+
+    def test_edited_masses(self):
+        import os
+        import tempfile
+        fname = os.path.join(tempfile.mkdtemp(), 'masses.hdf5')
+        for lazy in [True, False]:
+            snap = snapshot.Snapshot('tests/galaxies0.hdf5', lazy=lazy)
+            mass = snap.header['massarr'][2]
+            snap.masses['stars'][:100] = 2*mass
+            snap.save(fname)
+            for lazy_load in [True, False]:
+                saved = snapshot.Snapshot(fname, lazy=lazy_load)
+                assert saved.header['massarr'][2] == 0
+                assert np.allclose(saved.masses['stars'][:100], 2*mass)
+                assert np.allclose(saved.masses['stars'][100:], mass)
+                # unchanged masses stay in the MassTable
+                assert saved.header['massarr'][1] == snap.header['massarr'][1]
+            os.remove(fname)
+
+    def test_csv(self):
+        import os
+        import tempfile
+        folder = tempfile.mkdtemp()
+        self.snap.write_csv(ptypes=['stars', 'halo'], stepsize=7, fname=os.path.join(folder, 'snap.csv'))
+        self.snap.write_csv(ptypes=['stars', 'halo'], stepsize=7, compress=True, chunk_size=1000,
+                            fname=os.path.join(folder, 'snap.csv.gz'))
+        ids = np.append(self.snap.ids['stars'], self.snap.ids['halo'])
+        vel = np.append(self.snap.vel['stars'], self.snap.vel['halo'], axis=0)
+        selected = np.arange(0, len(ids), 7)
+        order = selected[np.argsort(ids[selected])]
+        for name in ['snap.csv', 'snap.csv.gz']:
+            data = np.loadtxt(os.path.join(folder, name), delimiter=',', skiprows=1)
+            assert data.shape == (len(order), 6)
+            assert np.allclose(data[:, 3:], vel[order], atol=1e-3)
+        # ids are written exactly, even past float64 precision
+        snap = snapshot.Snapshot()
+        snap.ids = {'stars': 2**60 + np.arange(10, dtype=np.int64)[::-1]}
+        snap.vel = {'stars': np.zeros((10, 3))}
+        snap.write_csv(stepsize=3, columns=['ids', 'vel'], fname=os.path.join(folder, 'ids.csv'))
+        data = np.loadtxt(os.path.join(folder, 'ids.csv'), delimiter=',', skiprows=1, usecols=0,
+                          dtype=np.int64)
+        assert np.array_equal(data, np.sort(snap.ids['stars'][::3]))
@@ -1,5 +1,6 @@
 import numpy as np
 from snaptools import simulation
+from snaptools import snapshot
 
 class TestSimulation():
 
@@ -43,3 +44,45 @@ class TestSimulation():
     def test_measure_centers(self):
         centers = self.sim.measure_centers()
 
+
+    def test_catalog(self):
+        import os
+        import time
+        cat = self.sim.catalog()
+        assert os.path.exists(self.sim.catalog_name())
+        assert np.array_equal(cat['nall'][0], [0, 40000, 20000, 0, 0, 0])
+        assert np.all(cat['time'] == 0)
+        start = time.time()
+        cached = self.sim.catalog()
+        assert time.time() - start < 1
+        for key in ['time', 'redshift', 'nall', 'size']:
+            assert np.array_equal(cat[key], cached[key])
+        os.remove(self.sim.catalog_name())
+
+
+    def test_export_fits(self):
+        import os
+        import tempfile
+        import pytest
+        pytest.importorskip('astropy')
+        folder = tempfile.mkdtemp()
+        written = self.sim.export_fits(angles=[0, 45], folder=folder, BINS=32, workers=2)
+        assert len(written) == self.sim.nsnaps
+        assert all(os.path.exists(f) for files in written for f in files)
+
+
+    def test_stats(self):
+        def measure(snap):
+            return snap.pos['stars'][:10].mean()
+        results, stats = self.sim.apply_function(measure, parttypes=['stars'], stats=True)
+        assert len(results) == self.sim.nsnaps
+        assert stats['pos']['stars']['loads'] == self.sim.nsnaps
+        assert len(stats['pos']['stars']['sources']) == self.sim.nsnaps
+        assert self.sim.stats()['pos']['stars']['loads'] == self.sim.nsnaps
+
+        # the function still gets the snapshot filename, the snapshots it opens are counted
+        def measure_file(snapname):
+            return snapshot.Snapshot(snapname).pos['halo'][:10].mean()
+        results, stats = self.sim.apply_function(measure_file, stats=True)
+        assert len(results) == self.sim.nsnaps
+        assert stats['pos']['halo']['bytes'] == self.sim.nsnaps*10*12